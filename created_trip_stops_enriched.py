@@ -4,9 +4,15 @@ import pandas as pd
 import numpy as np
 import helper_files.single_stop_enrichment as sse
 import helper_files.trips_enriched as te
+import helper_files.shape_cache as shape_cache
+import helper_files.fuel_model as fuel_model
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import helper_files.logger as logger
+import helper_files.spatial_dedup as spatial_dedup
+import helper_files.rate_limit as rate_limit
 import atexit
 
 tqdm.pandas()
@@ -16,10 +22,20 @@ def enrich_generated_trip_data(
     stops_csv_path,
     output_enriched_stops_csv = None,
     output_enriched_trip_csv = None,
+    dedup_tolerance_m = spatial_dedup.DEFAULT_TOLERANCE_M,
+    max_workers = 1,
+    save_shape_cache = True,
+    progress = None,
+    vehicle_profiles = None,
 ):
     """
     Enriches generated shape and stop data with geographic, census, and cluster info,
     and estimates fuel usage for the trip.
+    Stops within dedup_tolerance_m of each other are enriched once and share the result.
+    max_workers > 1 enriches the stops with concurrent API requests.
+    progress, if given, is called with the number of stops enriched as the work advances.
+    vehicle_profiles is the (profiles_df, assignments, default_profile) tuple from
+    fuel_model.load_vehicle_profiles; it is loaded here when not given.
     """
     logger.log(f"\n--- Processing Trip Data Pair ---")
     logger.log(f"Loading shape data from: {shape_csv_path}")
@@ -36,29 +52,59 @@ def enrich_generated_trip_data(
         logger.log(f"Error: Stops CSV file not found at {stops_csv_path}. Skipping this pair.")
         return None, None
 
-    logger.log("Enriching individual stops with geographic and census data (this may take a while)...")
-    enriched_stops_list = []
-    for index, row in tqdm(stops_df.iterrows(), total=stops_df.shape[0], desc="Enriching Stops"):
-        enriched_stop = sse.enriched_record_from_lat_lon(row['stop_lat'], row['stop_lon'])
-        enriched_stop['stop_id'] = row['stop_id']
-        enriched_stops_list.append(enriched_stop)
+    enriched_stops_df, enriched_trip_df = enrich_generated_trip_frames(shapes_df, stops_df, dedup_tolerance_m, max_workers, save_shape_cache, progress, vehicle_profiles)
+
+    if output_enriched_stops_csv:
+        enriched_stops_df.to_csv(output_enriched_stops_csv)
+        logger.log(f"Enriched stops saved to: {output_enriched_stops_csv}")
+
+    if output_enriched_trip_csv:
+        enriched_trip_df.to_csv(output_enriched_trip_csv, index=False)
+        logger.log(f"Enriched trip (shape) data with fuel estimation saved to: {output_enriched_trip_csv}")
+
+    logger.log("--- Trip Data Pair Processing Complete ---")
+    return enriched_stops_df, enriched_trip_df
+
+
+def enrich_generated_trip_frames(shapes_df, stops_df, dedup_tolerance_m = spatial_dedup.DEFAULT_TOLERANCE_M, max_workers = 1, save_shape_cache = True, progress = None,
+                                 vehicle_profiles = None):
+    """
+    Enriches already loaded generated shape and stop DataFrames (as produced by route_maker.html)
+    and estimates fuel usage for the trip. Returns (enriched_stops_df, enriched_trip_df).
+    With save_shape_cache False the caller saves the shape distance cache once its batch is done.
+    progress, if given, is called with the number of stops enriched as the work advances.
+    vehicle_profiles is the tuple from fuel_model.load_vehicle_profiles; batch callers load it
+    once and pass it in, otherwise it is loaded for this call.
+    """
+    stops_df = stops_df.copy()
+
+    logger.log("Enriching stops with geographic and census data in one batch...")
+    representative_of = spatial_dedup.cluster_points(stops_df['stop_lat'].tolist(), stops_df['stop_lon'].tolist(), dedup_tolerance_m)
+    representatives = sorted(set(representative_of))
+    representative_rows = {representative: row for row, representative in enumerate(representatives)}
+
+    enriched_representatives = sse.enriched_records_from_lat_lons(
+        zip(stops_df['stop_lat'].iloc[representatives], stops_df['stop_lon'].iloc[representatives]),
+        max_workers=max_workers,
+        progress=progress,
+    )
+    if progress is not None:
+        progress(len(stops_df) - len(representatives))
+    enriched_stops_df = enriched_representatives.iloc[[representative_rows[rep] for rep in representative_of]].reset_index(drop=True)
+    enriched_stops_df['stop_lat'] = stops_df['stop_lat'].to_numpy()
+    enriched_stops_df['stop_lon'] = stops_df['stop_lon'].to_numpy()
+    enriched_stops_df['stop_id'] = stops_df['stop_id'].to_numpy()
+    spatial_dedup.report_savings("Generated stop enrichment", len(stops_df), len(representatives), dedup_tolerance_m)
     
     stops_df['trip_id'] = stops_df['shape_id']
     
-    enriched_stops_df = pd.DataFrame(enriched_stops_list)
     enriched_stops_df = enriched_stops_df.set_index('stop_id')
-    
-    if output_enriched_stops_csv:
-        enriched_stops_df.to_csv(output_enriched_stops_csv)
-        logger.log(f"Enriched stops saved to: {output_enriched_stops_csv}")
 
     logger.log("Calculating total distance for the shape...")
     if shapes_df['shape_id'].nunique() > 1:
         logger.log("Warning: Multiple shape_ids found in the shape file. Calculating distance for each.")
     
-    shapes_sorted = shapes_df.sort_values(by=['shape_id', 'shape_pt_sequence'])
-    
-    shape_distances = shapes_sorted.groupby('shape_id').progress_apply(te.calculate_shape_distance).reset_index(name='total_distance_km')
+    shape_distances = shape_cache.cached_shape_distances_km(shapes_df, save=save_shape_cache)
     
     logger.log("Estimating fuel usage for the trip...")
     enriched_trip_df = shape_distances.copy()
@@ -69,34 +115,79 @@ def enrich_generated_trip_data(
     
     stop_times_df = stops_df[['trip_id', 'stop_id']]
     
-    enriched_trip_df['estimated_total_idle_seconds'] = enriched_trip_df.progress_apply(
-        lambda row: te.calculate_estimated_idle_time(
-            row,
-            all_stop_times_df=stop_times_df,
-            enriched_stops_df=enriched_stops_df
-        ), axis=1
-    )
+    idle_seconds_by_trip = te.estimate_idle_seconds_by_trip(stop_times_df, enriched_stops_df)
+    enriched_trip_df['estimated_total_idle_seconds'] = idle_seconds_by_trip.reindex(enriched_trip_df['trip_id'], fill_value=0.0).to_numpy()
 
     enriched_trip_df['total_idle_seconds'] = enriched_trip_df['scheduled_total_idle_seconds'] + enriched_trip_df['estimated_total_idle_seconds']
     
-    enriched_trip_df['estimated_fuel_usage_liters'] = enriched_trip_df.progress_apply(
-        lambda row: te.estimate_fuel(row), axis=1
+    if vehicle_profiles is None:
+        vehicle_profiles = fuel_model.load_vehicle_profiles()
+    trip_fuel = fuel_model.estimate_trip_fuel(enriched_trip_df, *vehicle_profiles)
+    enriched_trip_df['estimated_fuel_usage_liters'] = trip_fuel['estimated_fuel_usage_liters']
+
+    return enriched_stops_df, enriched_trip_df
+
+
+def process_route_pair(directory, shape_file, max_workers = 1, progress = None, vehicle_profiles = None):
+    """
+    Enriches one generated shape/stops pair found in directory and saves the enriched data.
+    Returns True if the pair was enriched, False if it failed and None if it has no stops file.
+    The shape distance cache is not saved here; process_all_generated_routes saves it once at the end.
+    """
+    shape_id = shape_file.replace('_generated_shape.csv', '')
+    
+    stops_file = f"{shape_id}_generated_stops.csv"
+    stops_csv_path = os.path.join(directory, stops_file)
+    shape_csv_path = os.path.join(directory, shape_file)
+
+    if not os.path.exists(stops_csv_path):
+        logger.log(f"Warning: Found shape file '{shape_file}' but no matching stops file '{stops_file}'. Skipping.")
+        return None
+
+    logger.log(f"\nFound matching pair for Shape ID: '{shape_id}'")
+    
+    output_enriched_stops = os.path.join(directory, f"{shape_id}_enriched_stops.csv")
+    output_enriched_trip = os.path.join(directory, f"{shape_id}_enriched_trip.csv")
+
+    enriched_stops, enriched_trip = enrich_generated_trip_data(
+        shape_csv_path=shape_csv_path,
+        stops_csv_path=stops_csv_path,
+        output_enriched_stops_csv=output_enriched_stops,
+        output_enriched_trip_csv=output_enriched_trip,
+        max_workers=max_workers,
+        save_shape_cache=False,
+        progress=progress,
+        vehicle_profiles=vehicle_profiles,
     )
+    
+    if enriched_stops is not None and enriched_trip is not None:
+        logger.log(f"Successfully enriched data for Shape ID: '{shape_id}'")
+        return True
+    logger.log(f"Failed to enrich data for Shape ID: '{shape_id}'. See errors above.")
+    return False
 
-    if output_enriched_trip_csv:
-        enriched_trip_df.to_csv(output_enriched_trip_csv, index=False)
-        logger.log(f"Enriched trip (shape) data with fuel estimation saved to: {output_enriched_trip_csv}")
 
-    logger.log("--- Trip Data Pair Processing Complete ---")
-    return enriched_stops_df, enriched_trip_df
+def count_stops(directory, shape_file):
+    """Counts the stop rows in the stops file paired with a shape file, or 0 if there is none."""
+    stops_csv_path = os.path.join(directory, shape_file.replace('_generated_shape.csv', '_generated_stops.csv'))
+    if not os.path.exists(stops_csv_path):
+        return 0
+    with open(stops_csv_path) as f:
+        return max(sum(1 for _ in f) - 1, 0)
 
 
 def process_all_generated_routes(
     directory = "created_route_data/",
+    max_workers = 1,
+    stop_workers = 1,
 ):
     """
     Scans a specified directory for generated shape and stop CSV files,
     enriches them, and saves the enriched data.
+    max_workers route pairs are enriched at the same time, each sending up to stop_workers
+    concurrent API requests; the external APIs are paced by the shared limits in rate_limit, which
+    also caps how many Overpass requests are in flight across all workers.
+    Each pair writes its own output files, so a concurrent run produces the same files as a serial one.
     """
     if not os.path.isdir(directory):
         logger.log(f"Error: Directory '{directory}' not found. Please create it or provide a valid path.")
@@ -104,48 +195,61 @@ def process_all_generated_routes(
 
     logger.log(f"Scanning directory: '{directory}' for generated route data...")
     
-    shape_files = [f for f in os.listdir(directory) if f.endswith('_generated_shape.csv')]
-    
-    processed_count = 0
-    for shape_file in shape_files:
-        shape_id = shape_file.replace('_generated_shape.csv', '')
-        
-        stops_file = f"{shape_id}_generated_stops.csv"
-        stops_csv_path = os.path.join(directory, stops_file)
-        shape_csv_path = os.path.join(directory, shape_file)
-
-        if os.path.exists(stops_csv_path):
-            logger.log(f"\nFound matching pair for Shape ID: '{shape_id}'")
-            
-            output_enriched_stops = os.path.join(directory, f"{shape_id}_enriched_stops.csv")
-            output_enriched_trip = os.path.join(directory, f"{shape_id}_enriched_trip.csv")
-
-            enriched_stops, enriched_trip = enrich_generated_trip_data(
-                shape_csv_path=shape_csv_path,
-                stops_csv_path=stops_csv_path,
-                output_enriched_stops_csv=output_enriched_stops,
-                output_enriched_trip_csv=output_enriched_trip,
-            )
-            
-            if enriched_stops is not None and enriched_trip is not None:
-                processed_count += 1
-                logger.log(f"Successfully enriched data for Shape ID: '{shape_id}'")
-            else:
-                logger.log(f"Failed to enrich data for Shape ID: '{shape_id}'. See errors above.")
-        else:
-            logger.log(f"Warning: Found shape file '{shape_file}' but no matching stops file '{stops_file}'. Skipping.")
+    shape_files = sorted(f for f in os.listdir(directory) if f.endswith('_generated_shape.csv'))
+    vehicle_profiles = fuel_model.load_vehicle_profiles()
     
+    if max_workers <= 1:
+        results = [process_route_pair(directory, shape_file, stop_workers, None, vehicle_profiles) for shape_file in shape_files]
+    else:
+        logger.log(f"Enriching {len(shape_files)} route pairs with {max_workers} workers...")
+        stop_counts = {shape_file: count_stops(directory, shape_file) for shape_file in shape_files}
+        stops_reported = dict.fromkeys(shape_files, 0)
+        progress_lock = threading.Lock()
+        results = [None] * len(shape_files)
+        completed = 0
+
+        def route_progress(shape_file):
+            """Advances the shared bar by stops enriched in one route, called from that route's workers."""
+            def advance(stops):
+                with progress_lock:
+                    stops = min(stops, stop_counts[shape_file] - stops_reported[shape_file])
+                    stops_reported[shape_file] += stops
+                    progress.update(stops)
+            return advance
+
+        with tqdm(total=sum(stop_counts.values()), unit='stop', desc='Enriching routes') as progress, \
+             ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(process_route_pair, directory, shape_file, stop_workers, route_progress(shape_file), vehicle_profiles): position
+                for position, shape_file in enumerate(shape_files)
+            }
+            for future in as_completed(futures):
+                position = futures[future]
+                try:
+                    results[position] = future.result()
+                except Exception as e:
+                    logger.log(f"Error enriching '{shape_files[position]}': {e}")
+                    results[position] = False
+                completed += 1
+                route_progress(shape_files[position])(stop_counts[shape_files[position]])
+                progress.set_postfix(routes=f"{completed}/{len(shape_files)}")
+
+    shape_cache.get_cache().save()
+    processed_count = sum(1 for result in results if result)
     logger.log(f"\nFinished processing. Total {processed_count} route pairs enriched.")
-
+    logger.log(f"API rate limiting: {rate_limit.all_stats()}")
 
 
 LOG_FILE_NAME = "custom_application_activity.log"
 LOG_FILE_MODE = "w" # 'a' will append to the file if it exists, 'w' will overwrite it
+ROUTE_WORKERS = 4 # route pairs enriched at the same time, 1 processes them one after another
+STOP_WORKERS = 2 # API requests per route; Overpass stays at rate_limit.DEFAULT_CONCURRENCY in flight overall
 
-print(f"Initializing application logger to '{LOG_FILE_NAME}'...")
-logger.initialize_logger(LOG_FILE_NAME, mode=LOG_FILE_MODE)
+if __name__ == "__main__":
+    print(f"Initializing application logger to '{LOG_FILE_NAME}'...")
+    logger.initialize_logger(LOG_FILE_NAME, mode=LOG_FILE_MODE)
 
-atexit.register(logger.close_logger)
-print("Logger setup complete. Proceeding with application tasks.")
+    atexit.register(logger.close_logger)
+    print("Logger setup complete. Proceeding with application tasks.")
 
-process_all_generated_routes()
+    process_all_generated_routes(max_workers=ROUTE_WORKERS, stop_workers=STOP_WORKERS)
@@ -0,0 +1,139 @@
+# enrichment_benchmark.py
+
+import argparse
+import atexit
+import json
+import time
+import numpy as np
+import helper_files.logger as logger
+import helper_files.api_client as api_client
+import helper_files.rate_limit as rate_limit
+import helper_files.providers as providers
+import helper_files.standin_apis as standin_apis
+import helper_files.single_stop_enrichment as sse
+import helper_files.enrichment_pipeline as enrichment_pipeline
+
+
+LOG_FILE_NAME = "enrichment_benchmark_activity.log"
+LOG_FILE_MODE = "w" # 'a' will append to the file if it exists, 'w' will overwrite it
+
+parser = argparse.ArgumentParser(description="Benchmarks batch enrichment against local stand-ins for the external APIs.")
+parser.add_argument("--recordings", default=standin_apis.DEFAULT_RECORDINGS_PATH, help="Recorded API responses to replay.")
+parser.add_argument("--record", type=int, default=0, metavar="N",
+                    help="Record real API responses for the first N stops in the stops table, then exit.")
+parser.add_argument("--stops", type=int, default=500, help="Coordinates per run (recorded ones first, then a synthetic grid).")
+parser.add_argument("--workers", default="1,2,4", help="Comma separated max_workers values to run.")
+parser.add_argument("--mode", choices=["providers", "records"], default="providers",
+                    help="'providers' times the geocoding, shops and raster calls; 'records' runs the full "
+                         "enriched_records_from_lat_lons batch, which also needs the database and models.")
+parser.add_argument("--latency-ms", type=float, default=80.0, help="Stand-in latency per request.")
+parser.add_argument("--jitter-ms", type=float, default=20.0, help="Stand-in latency varies by up to this much either way.")
+parser.add_argument("--per-item-ms", type=float, default=0.5, help="Extra stand-in latency per coordinate in a request.")
+parser.add_argument("--error-rate", type=float, default=0.02, help="Fraction of stand-in requests that fail.")
+parser.add_argument("--error-status", type=int, default=503)
+parser.add_argument("--max-retries", type=int, default=3)
+parser.add_argument("--retry-delay", type=float, default=0.1, help="Initial retry delay in seconds (doubles per retry).")
+parser.add_argument("--rate-limits", action="store_true",
+                    help="Keep the real APIs' rate limits instead of lifting them for the stand-ins.")
+parser.add_argument("--output", default=None, help="Also write the results to this JSON file.")
+args = parser.parse_args()
+
+print(f"Initializing application logger to '{LOG_FILE_NAME}'...")
+logger.initialize_logger(LOG_FILE_NAME, mode=LOG_FILE_MODE)
+
+atexit.register(logger.close_logger)
+print("Logger setup complete.")
+
+def benchmark_coordinates(recordings, count):
+    """Returns count coordinates: the recorded ones first, then a grid over Leeds for the rest."""
+    coordinates = standin_apis.recorded_coordinates(recordings)[:count]
+    side = int(np.ceil(np.sqrt(max(count - len(coordinates), 0))))
+    for row in range(side):
+        for col in range(side):
+            if len(coordinates) >= count:
+                break
+            coordinates.append((round(53.70 + row * 0.2 / side, 6), round(-1.70 + col * 0.3 / side, 6)))
+    return coordinates
+
+def run_once(coordinates, max_workers):
+    """Runs one benchmark pass and returns seconds per stage."""
+    timings = {}
+    if args.mode == "records":
+        start_time = time.perf_counter()
+        sse.enriched_records_from_lat_lons(coordinates, max_workers=max_workers)
+        timings['records'] = time.perf_counter() - start_time
+        return timings
+
+    start_time = time.perf_counter()
+    providers.get_provider('geocoding').postcodes(coordinates, max_workers=max_workers)
+    timings['postcodes'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    providers.get_provider('shops').shop_counts(coordinates, max_workers=max_workers)
+    timings['overpass'] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    providers.get_provider('raster').sample([lon for _, lon in coordinates], [lat for lat, _ in coordinates])
+    timings['raster'] = time.perf_counter() - start_time
+    return timings
+
+if args.record:
+    stops = enrichment_pipeline.load_stops()
+    if stops is None:
+        raise SystemExit("Could not load stops to record responses for.")
+    stops = stops.head(args.record)
+    standin_apis.record_responses(zip(stops['stop_lat'], stops['stop_lon']), args.recordings)
+    raise SystemExit(0)
+
+recordings = standin_apis.load_recordings(args.recordings)
+coordinates = benchmark_coordinates(recordings, args.stops)
+server = standin_apis.StandinAPIServer(recordings, latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                       per_item_ms=args.per_item_ms, error_rate=args.error_rate,
+                                       error_status=args.error_status)
+server.start()
+standin_apis.use_standins(server, max_retries=args.max_retries, initial_delay=args.retry_delay)
+if not args.rate_limits:
+    for name in ['postcodes', 'overpass']:
+        rate_limit.set_rate(name, 1e6, 1000)
+        rate_limit.set_concurrency(name, None)
+
+results = []
+try:
+    for max_workers in [int(value) for value in args.workers.split(",")]:
+        api_client.reset_stats()
+        timings = run_once(coordinates, max_workers)
+        api_stats = api_client.stats()
+        # In 'records' mode every API is timed against the whole batch.
+        stage_seconds = timings if args.mode == "providers" else {name: timings['records'] for name in api_stats}
+        for stage, seconds in stage_seconds.items():
+            stage_stats = api_stats.get(stage, {})
+            row = {
+                'max_workers': max_workers,
+                'stage': stage,
+                'seconds': round(seconds, 3),
+                'stops_per_second': round(len(coordinates) / seconds, 1) if seconds else None,
+                'requests': stage_stats.get('requests', 0),
+                'requests_per_second': round(stage_stats.get('requests', 0) / seconds, 1) if seconds else None,
+                'p50_ms': stage_stats.get('p50_ms'),
+                'p99_ms': stage_stats.get('p99_ms'),
+                'retries': stage_stats.get('retries', 0),
+                'errors': stage_stats.get('errors', 0),
+            }
+            results.append(row)
+            logger.log(f"Benchmark: {row}")
+finally:
+    server.stop()
+
+header = f"{'workers':>7} {'stage':<10} {'secs':>8} {'stops/s':>9} {'reqs':>6} {'req/s':>7} {'p50 ms':>8} {'p99 ms':>8} {'retries':>7} {'errors':>6}"
+print(f"\n{len(coordinates)} coordinates, stand-in latency {args.latency_ms}ms +/- {args.jitter_ms}ms, error rate {args.error_rate}")
+print(header)
+for row in results:
+    print(f"{row['max_workers']:>7} {row['stage']:<10} {row['seconds']:>8.3f} {row['stops_per_second'] or 0:>9.1f} "
+          f"{row['requests']:>6} {row['requests_per_second'] or 0:>7.1f} {row['p50_ms'] or 0:>8.1f} {row['p99_ms'] or 0:>8.1f} "
+          f"{row['retries']:>7} {row['errors']:>6}")
+print(f"Stand-in server: {server.stats()}")
+
+if args.output:
+    with open(args.output, 'w') as f:
+        json.dump({'coordinates': len(coordinates), 'settings': vars(args), 'results': results, 'standin': server.stats()}, f, indent=2)
+    print(f"Results written to '{args.output}'.")
@@ -0,0 +1,44 @@
+# enrichment_server.py
+
+import argparse
+import atexit
+import helper_files.logger as logger
+import helper_files.enrichment_service as enrichment_service
+import helper_files.stops_enrichment_postcode as postcode_enrich
+import helper_files.stops_enrichment_shops as shop_enrich
+import created_trip_stops_enriched as created_trip
+
+
+LOG_FILE_NAME = "enrichment_server_activity.log"
+LOG_FILE_MODE = "a" # 'a' will append to the file if it exists, 'w' will overwrite it
+
+parser = argparse.ArgumentParser(description="Local enrichment service for what-if stop and route queries.")
+parser.add_argument("--host", default=enrichment_service.DEFAULT_HOST)
+parser.add_argument("--port", type=int, default=enrichment_service.DEFAULT_PORT)
+parser.add_argument("--max-concurrency", type=int, default=4, help="Requests enriched at the same time.")
+parser.add_argument("--max-queue", type=int, default=32, help="Requests allowed to wait before returning 503.")
+parser.add_argument("--postcodes-url", default=postcode_enrich.DEFAULT_POSTCODES_API_URL,
+                    help="postcodes.io base URL, e.g. a local stand-in for testing.")
+parser.add_argument("--overpass-url", default=shop_enrich.DEFAULT_OVERPASS_API_URL,
+                    help="Overpass interpreter URL, e.g. a local stand-in for testing.")
+parser.add_argument("--no-warm", action="store_true", help="Skip loading models and caches at start-up.")
+args = parser.parse_args()
+
+print(f"Initializing application logger to '{LOG_FILE_NAME}'...")
+logger.initialize_logger(LOG_FILE_NAME, mode=LOG_FILE_MODE)
+
+atexit.register(logger.close_logger)
+print("Logger setup complete. Starting enrichment service.")
+
+postcode_enrich.DEFAULT_POSTCODES_API_URL = args.postcodes_url
+shop_enrich.DEFAULT_OVERPASS_API_URL = args.overpass_url
+
+print(f"Serving on http://{args.host}:{args.port} (Ctrl+C to stop).")
+enrichment_service.run_service(
+    host=args.host,
+    port=args.port,
+    route_enricher=created_trip.enrich_generated_trip_frames,
+    max_concurrency=args.max_concurrency,
+    max_queue=args.max_queue,
+    warm=not args.no_warm,
+)
@@ -0,0 +1,69 @@
+# api_client.py
+
+import threading
+import time
+from collections import deque
+import numpy as np
+import requests
+import helper_files.rate_limit as rate_limit
+
+MAX_SAMPLES = 100000
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _entry(name):
+    entry = _stats.get(name)
+    if entry is None:
+        entry = {'requests': 0, 'errors': 0, 'retries': 0, 'latencies': deque(maxlen=MAX_SAMPLES)}
+        _stats[name] = entry
+    return entry
+
+def send(name, method, url, **kwargs):
+    """
+    Sends one request to an external API while holding one of its concurrent slots and after
+    waiting for its rate limiter, and records how long it took and whether it failed. Takes the
+    same keyword arguments as requests.request and returns the response, raising as requests does
+    (an HTTP error status is not raised here).
+    """
+    with rate_limit.slot(name):
+        rate_limit.acquire(name)
+        start_time = time.perf_counter()
+        error = True
+        try:
+            response = requests.request(method, url, **kwargs)
+            error = response.status_code >= 400
+            return response
+        finally:
+            elapsed = time.perf_counter() - start_time
+            with _stats_lock:
+                entry = _entry(name)
+                entry['requests'] += 1
+                entry['errors'] += int(error)
+                entry['latencies'].append(elapsed)
+
+def record_retry(name):
+    """Counts a retried request to the named API."""
+    with _stats_lock:
+        _entry(name)['retries'] += 1
+
+def stats(name=None):
+    """
+    Returns request, error and retry counts and p50/p99/max request latency in milliseconds,
+    for one API or (by default) every API called so far.
+    """
+    with _stats_lock:
+        snapshot = {api: (entry['requests'], entry['errors'], entry['retries'], np.array(entry['latencies']))
+                    for api, entry in _stats.items() if name is None or api == name}
+
+    result = {}
+    for api, (request_count, errors, retries, latencies) in snapshot.items():
+        result[api] = {'requests': request_count, 'errors': errors, 'retries': retries}
+        for label, percentile in [('p50_ms', 50), ('p99_ms', 99), ('max_ms', 100)]:
+            result[api][label] = round(float(np.percentile(latencies, percentile)) * 1000, 2) if len(latencies) else None
+    return result if name is None else result.get(name)
+
+def reset_stats():
+    """Clears the recorded counts and latencies, e.g. between benchmark runs."""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,212 @@
+# artifacts.py
+
+import json
+import os
+import pandas as pd
+import helper_files.logger as logger
+
+COLUMNAR_FORMATS = {'.parquet', '.feather'}
+EXPORT_FORMATS = {'csv', 'json'}
+COMPRESSION = 'zstd'
+
+_STOP_COLUMNS = {
+    'stop_id': 'string',
+    'stop_name': 'string',
+    'stop_lon': 'float64',
+    'stop_lat': 'float64',
+}
+_OA_COLUMNS = {
+    'postcode': 'string',
+    'oa21cd': 'string',
+    'lsoa21cd': 'string',
+    'lsoa21nm': 'string',
+}
+_ENRICHED_COLUMNS = {
+    'shops_nearby_count': 'Int64',
+    'population_density': 'float64',
+    'oa21pop': 'Int64',
+    'postcode_pop': 'Int64',
+    'employed_total': 'Int64',
+    'bus_commute_total': 'Int64',
+    'avg_weekly_frequency_per_hour': 'float64',
+    'customer_convenience_score': 'float64',
+    'commute_opportunity_score': 'float64',
+}
+
+# Declared column types for each artifact. Columns are written in this order, followed by any others.
+SCHEMAS = {
+    'stops_postcode': {**_STOP_COLUMNS, 'postcode': 'string'},
+    'stops_oas': {**_STOP_COLUMNS, **_OA_COLUMNS},
+    'stops_shops': {**_STOP_COLUMNS, **_OA_COLUMNS, 'shops_nearby_count': 'Int64'},
+    'stops_enriched': {
+        'stop_id': 'string', 'stop_name': 'string', 'stop_lat': 'float64', 'stop_lon': 'float64',
+        **_OA_COLUMNS, **_ENRICHED_COLUMNS,
+    },
+    # kmeans_model imputes shops_nearby_count, oa21pop and employed_total with medians, which may be fractional.
+    'stops_enriched_with_clusters': {
+        'stop_id': 'string', 'stop_name': 'string', 'stop_lat': 'float64', 'stop_lon': 'float64',
+        **_OA_COLUMNS, **_ENRICHED_COLUMNS,
+        'shops_nearby_count': 'float64', 'oa21pop': 'float64', 'employed_total': 'float64',
+        'cluster': 'Int64', 'cluster_category': 'string',
+    },
+    'trip_segments': {
+        'trip_id': 'string', 'route_id': 'string', 'service_id': 'string', 'direction_id': 'Int8', 'shape_id': 'string',
+        'segment_index': 'Int16', 'from_stop_id': 'string', 'to_stop_id': 'string',
+        'departure_seconds': 'Int32', 'run_seconds': 'Int32', 'distance_km': 'float32', 'speed_kmh': 'float32',
+        'distance_source': 'string',
+    },
+    # Only the columns read back from trips_enriched.csv are declared, so ids stay strings.
+    'trips_enriched': {
+        'trip_id': 'string', 'route_id': 'string', 'service_id': 'string', 'direction_id': 'Int8', 'shape_id': 'string', 'block_id': 'string',
+    },
+    'trip_cube': {
+        'route_id': 'string', 'route_short_name': 'string', 'direction_id': 'Int8', 'day_of_week': 'string', 'departure_hour': 'Int8',
+        'trips': 'Int32', 'total_distance_km': 'float64', 'estimated_fuel_usage_liters': 'float64', 'total_idle_seconds': 'float64',
+        'scored_trips': 'Int32', 'trip_convenience_score': 'float64',
+    },
+}
+
+def apply_schema(df, schema_name, columns=None):
+    """
+    Casts a DataFrame's columns to the types declared for an artifact and puts the declared
+    columns first. Declared columns missing from df are added as all missing, unless columns
+    restricts the frame to a subset.
+    """
+    schema = SCHEMAS[schema_name]
+    wanted = [column for column in schema if columns is None or column in columns]
+    for column in wanted:
+        dtype = schema[column]
+        if column not in df:
+            df[column] = pd.Series(pd.NA, index=df.index, dtype=object)
+        values = df[column]
+        if dtype == 'string' and pd.api.types.infer_dtype(values, skipna=True) in ('string', 'empty'):
+            df[column] = values.astype('string')
+        elif dtype == 'string':
+            df[column] = values.astype(object).where(values.notna(), None).map(lambda value: value if value is None else str(value)).astype('string')
+        else:
+            numeric = pd.to_numeric(values.astype(object).where(values.notna(), None), errors='coerce')
+            if dtype == 'Int64':
+                numeric = numeric.round()
+            df[column] = numeric.astype(dtype)
+    return df[wanted + [column for column in df.columns if column not in schema]]
+
+def _records_frame(data):
+    """Converts a stop_id-keyed dict of records (the legacy enrich/*.json layout) to a DataFrame."""
+    df = pd.DataFrame.from_dict(data, orient='index')
+    if 'stop_id' not in df:
+        df.insert(0, 'stop_id', list(data.keys()))
+    return df.reset_index(drop=True)
+
+def _resolve(path):
+    """
+    Returns path if it exists, otherwise the first existing file with the same stem and a
+    columnar or legacy extension, or None.
+    """
+    if os.path.exists(path):
+        return path
+    stem = os.path.splitext(path)[0]
+    for extension in ['.parquet', '.feather', '.json', '.csv']:
+        candidate = stem + extension
+        if os.path.exists(candidate):
+            logger.log(f"'{os.path.basename(path)}' not found, reading '{os.path.basename(candidate)}' instead.")
+            return candidate
+    return None
+
+def export_artifact(df, path, export_formats):
+    """
+    Writes CSV and/or JSON copies of an artifact next to it. JSON uses the legacy layout,
+    a dict keyed by stop_id with indent=2.
+    """
+    stem = os.path.splitext(path)[0]
+    for export_format in export_formats:
+        if export_format not in EXPORT_FORMATS:
+            logger.log(f"Warning: Unknown export format '{export_format}'. Use one of {sorted(EXPORT_FORMATS)}.")
+            continue
+        export_path = f"{stem}.{export_format}"
+        if export_format == 'csv':
+            df.to_csv(export_path, index=False, lineterminator='\n')
+        else:
+            with open(export_path, 'w') as f:
+                json.dump(frame_to_records(df), f, indent=2)
+        logger.log(f"Exported '{export_path}'.")
+
+def write_artifact(df, path, schema_name=None, export_formats=()):
+    """
+    Writes a DataFrame as a compressed Parquet or Feather file (chosen by the path's extension),
+    after casting it to the declared schema if one is named. A '.csv' or '.json' path writes
+    that format instead. export_formats also writes 'csv' and/or 'json' copies alongside.
+    Returns the written DataFrame.
+    """
+    if schema_name:
+        df = apply_schema(df.copy(), schema_name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension in COLUMNAR_FORMATS:
+        tmp_path = path + ".tmp"
+        if extension == '.parquet':
+            df.to_parquet(tmp_path, index=False, compression=COMPRESSION)
+        else:
+            df.reset_index(drop=True).to_feather(tmp_path, compression=COMPRESSION)
+        os.replace(tmp_path, path)
+    elif extension == '.csv':
+        df.to_csv(path, index=False, lineterminator='\n')
+    elif extension == '.json':
+        with open(path, 'w') as f:
+            json.dump(frame_to_records(df), f, indent=2)
+    else:
+        raise ValueError(f"Unsupported artifact extension '{extension}' for '{path}'.")
+
+    export_artifact(df, path, [export_format for export_format in export_formats if not path.endswith(f".{export_format}")])
+    return df
+
+def read_artifact(path, columns=None, schema_name=None):
+    """
+    Reads an artifact, loading only the requested columns where the format allows it.
+    If path does not exist, a file with the same stem in another supported format is read
+    instead, so trees with only the legacy JSON/CSV files keep working.
+    Raises FileNotFoundError if no such file exists.
+    """
+    resolved = _resolve(path)
+    if resolved is None:
+        raise FileNotFoundError(f"Artifact '{path}' not found.")
+
+    extension = os.path.splitext(resolved)[1].lower()
+    if extension == '.parquet':
+        df = pd.read_parquet(resolved, columns=columns)
+    elif extension == '.feather':
+        df = pd.read_feather(resolved, columns=columns)
+    elif extension == '.csv':
+        string_columns = [column for column, dtype in SCHEMAS.get(schema_name, {}).items() if dtype == 'string']
+        df = pd.read_csv(resolved, usecols=columns, dtype={column: 'string' for column in string_columns})
+    elif extension == '.json':
+        with open(resolved, 'r') as f:
+            df = _records_frame(json.load(f))
+        if columns is not None:
+            df = df[[column for column in columns if column in df]]
+    else:
+        raise ValueError(f"Unsupported artifact extension '{extension}' for '{resolved}'.")
+
+    if schema_name:
+        df = apply_schema(df, schema_name, columns=list(df.columns))
+    return df
+
+def frame_to_records(df):
+    """
+    Converts a DataFrame of stops to a dict of plain-Python records keyed by stop_id,
+    with None for missing values.
+    """
+    records = df.astype(object).where(df.notna(), None).to_dict(orient='records')
+    return {str(record['stop_id']): record for record in records}
+
+def read_stop_records(path, schema_name=None):
+    """Reads a stops artifact as a dict of records keyed by stop_id, in file order."""
+    return frame_to_records(read_artifact(path, schema_name=schema_name))
+
+def write_stop_records(records, path, schema_name=None, export_formats=()):
+    """
+    Writes a list of stop records (dicts) as an artifact. Returns the number of records written.
+    """
+    df = pd.DataFrame(list(records))
+    write_artifact(df, path, schema_name, export_formats)
+    return len(df)
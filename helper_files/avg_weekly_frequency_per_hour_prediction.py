@@ -11,6 +11,8 @@ import json
 import math
 import helper_files.helper as helper
 import helper_files.logger as logger
+import helper_files.model_registry as model_registry
+import helper_files.artifacts as artifacts
 from sklearn.model_selection import train_test_split
 from sklearn.impute import SimpleImputer
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
@@ -52,16 +54,17 @@ def run_prediction_model(model_dir=helper.affix_root_path("models")):
     Loads data, preprocesses it, trains a Gradient Boosting Regressor model,
     and then saves the model and all necessary preprocessors to disk.
     """
-    dataset_path = helper.affix_root_path("data/stops_enriched_with_clusters.csv")
-    dataset = pd.read_csv(dataset_path)
+    X_features = ['shops_nearby_count', 'population_density', 'oa21pop', 'employed_total', 'bus_commute_total', 'customer_convenience_score', 'commute_opportunity_score']
+
+    dataset_path = helper.affix_root_path("data/stops_enriched_with_clusters.parquet")
+    dataset = artifacts.read_artifact(dataset_path, columns=X_features + ['avg_weekly_frequency_per_hour'],
+                                      schema_name='stops_enriched_with_clusters').astype('float64')
 
     if not os.path.exists(model_dir):
         os.makedirs(model_dir)
 
     calculate_and_save_min_max_values(dataset, model_dir)
 
-    X_features = ['shops_nearby_count', 'population_density', 'oa21pop', 'employed_total', 'bus_commute_total', 'customer_convenience_score', 'commute_opportunity_score']
-    
     X = dataset[X_features]
     y = dataset['avg_weekly_frequency_per_hour']
 
@@ -112,29 +115,37 @@ def run_prediction_model(model_dir=helper.affix_root_path("models")):
 
 def predict_on_new_data(new_data_row):
     """
-    Loads a saved model and its preprocessors to make a prediction
-    on a new, single row of data.
+    Loads a saved model and its preprocessors (through the model registry, so each is
+    only read from disk once) to make a prediction on a new, single row of data.
+    """
+    predictions = predict_on_new_data_batch(new_data_row)
+    if isinstance(predictions, str):
+        return predictions
+    return predictions[0]
+
+
+def predict_on_new_data_batch(new_data):
+    """
+    Makes predictions for every row of a DataFrame with a single imputer, scaler and model call.
+    Returns an array of predictions in row order.
     """
     model_dir = helper.affix_root_path("models")
 
     try:
-        loaded_model = joblib.load(os.path.join(model_dir, 'gradient_boosting_model.joblib'))
-        loaded_imputer_X = joblib.load(os.path.join(model_dir, 'imputer_X.joblib'))
-        loaded_scaler_X = joblib.load(os.path.join(model_dir, 'scaler_X.joblib'))
-        loaded_scaler_y = joblib.load(os.path.join(model_dir, 'scaler_y.joblib'))
+        loaded_model = model_registry.load_joblib(os.path.join(model_dir, 'gradient_boosting_model.joblib'))
+        loaded_imputer_X = model_registry.load_joblib(os.path.join(model_dir, 'imputer_X.joblib'))
+        loaded_scaler_X = model_registry.load_joblib(os.path.join(model_dir, 'scaler_X.joblib'))
+        loaded_scaler_y = model_registry.load_joblib(os.path.join(model_dir, 'scaler_y.joblib'))
     except FileNotFoundError:
         return "Error: Saved model or preprocessors not found. Please run run_prediction_model() first."
 
     new_data_imputed = pd.DataFrame(
-        loaded_imputer_X.transform(new_data_row),
-        columns=new_data_row.columns
+        loaded_imputer_X.transform(new_data),
+        columns=new_data.columns
     )
     
     new_data_scaled = loaded_scaler_X.transform(new_data_imputed)
 
     scaled_prediction = loaded_model.predict(new_data_scaled)
     
-    original_prediction = loaded_scaler_y.inverse_transform(scaled_prediction.reshape(-1, 1)).flatten()
-    
-    return original_prediction[0]
-
+    return loaded_scaler_y.inverse_transform(scaled_prediction.reshape(-1, 1)).flatten()
@@ -0,0 +1,154 @@
+# census_features.py
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+
+DEFAULT_INDEX_DIR = helper.affix_root_path("data/census_features")
+MANIFEST_FILE = "manifest.json"
+FEATURE_COLUMNS = ['oa21pop', 'employed_total', 'bus_commute_total']
+
+_loaded_index = None
+_loaded_index_key = None
+# Index dirs whose on-demand build has failed in this process; get_* does not retry them.
+_failed_builds = set()
+
+def build_census_feature_index(config=helper.affix_root_path("config.json"),
+                               index_dir=DEFAULT_INDEX_DIR,
+                               CENSUS_FEATURES="census_features"):
+    """
+    Reads the census_features table (one row per OA, built by build_census_features.sql)
+    and writes it to disk as a sorted array of OA codes and a float array of feature values,
+    with NaN for missing values. Returns True on success.
+    """
+    logger.log(f"Building census feature index from '{CENSUS_FEATURES}'...")
+    start_time = time.time()
+
+    try:
+        with open(config) as json_file:
+            db_config = json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config}' not found for census feature index build.")
+        return False
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config}' for census feature index build.")
+        return False
+
+    conn, dict_cursor = dp.connect_to_mysql(db_config)
+    if not conn:
+        return False
+    dict_cursor.close()
+
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT oa21cd, {', '.join(FEATURE_COLUMNS)} FROM {CENSUS_FEATURES} ORDER BY oa21cd")
+        rows = cursor.fetchall()
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during census feature index build: {err}")
+        if err.errno == 1146:
+            logger.log("Run sql_scripts/build_census_features.sql once to create the census_features table.")
+        return False
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    rows = [row for row in rows if row[0]]
+    if not rows:
+        logger.log(f"No rows found in '{CENSUS_FEATURES}'. Census feature index not built.")
+        return False
+
+    oa_codes = np.array([row[0].encode('utf-8') for row in rows])
+    values = np.array([[np.nan if value is None else float(value) for value in row[1:]] for row in rows], dtype=np.float64)
+    order = np.argsort(oa_codes, kind='stable')
+
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "oa_codes.npy"), oa_codes[order])
+    np.save(os.path.join(tmp_dir, "values.npy"), values[order])
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'source_table': CENSUS_FEATURES, 'columns': FEATURE_COLUMNS, 'oas': len(rows),
+                   'built_at': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+    logger.log(f"Census feature index with {len(rows)} OAs written to '{index_dir}' in {time.time() - start_time:.1f}s.")
+    return True
+
+def load_census_feature_index(index_dir=DEFAULT_INDEX_DIR):
+    """
+    Loads the census feature index into memory along with a dict from OA code to row,
+    reusing the already loaded index unless it has been rebuilt since.
+    Returns None if no index has been built.
+    """
+    global _loaded_index, _loaded_index_key
+
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    index_key = (os.path.abspath(index_dir), os.path.getmtime(manifest_path))
+    if _loaded_index is not None and _loaded_index_key == index_key:
+        return _loaded_index
+
+    oa_codes = np.load(os.path.join(index_dir, "oa_codes.npy"))
+    values = np.load(os.path.join(index_dir, "values.npy"))
+    values.setflags(write=False)
+    index = {
+        'rows': {code.decode('utf-8'): row for row, code in enumerate(oa_codes.tolist())},
+        'values': values,
+    }
+
+    _loaded_index = index
+    _loaded_index_key = index_key
+    logger.log(f"Loaded census feature index with {len(values)} OAs from '{index_dir}'.")
+    return index
+
+def get_census_feature_index(config=helper.affix_root_path("config.json"), index_dir=DEFAULT_INDEX_DIR, CENSUS_FEATURES="census_features"):
+    """
+    Returns the census feature index, building it from the database first if it does not exist yet.
+    A failed build is not retried in this process, so callers go straight to their fallback;
+    call build_census_feature_index directly to try again.
+    """
+    index = load_census_feature_index(index_dir)
+    build_key = os.path.abspath(index_dir)
+    if index is None and build_key not in _failed_builds:
+        logger.log(f"No census feature index found at '{index_dir}'. Building it now...")
+        if build_census_feature_index(config=config, index_dir=index_dir, CENSUS_FEATURES=CENSUS_FEATURES):
+            index = load_census_feature_index(index_dir)
+        else:
+            _failed_builds.add(build_key)
+            logger.log("Could not build the census feature index. Not retrying in this process.")
+    return index
+
+def lookup_census_features(index, oa_codes):
+    """
+    Looks up many OA codes at once. Returns a float array of shape (len(oa_codes), len(FEATURE_COLUMNS))
+    aligned to the input, with NaN for codes that are missing or not found.
+    """
+    rows = index['rows']
+    positions = np.array([rows.get(code, -1) if isinstance(code, str) else -1 for code in oa_codes], dtype=np.int64)
+    features = np.full((len(positions), len(FEATURE_COLUMNS)), np.nan)
+    found = positions >= 0
+    features[found] = index['values'][positions[found]]
+    return features
+
+def lookup_census_record(index, oa21cd):
+    """
+    Returns the census features for one OA code as a dict of ints (None where missing),
+    or None if the OA is not in the index.
+    """
+    row = index['rows'].get(oa21cd)
+    if row is None:
+        return None
+    return {column: None if np.isnan(value) else int(value) for column, value in zip(FEATURE_COLUMNS, index['values'][row].tolist())}
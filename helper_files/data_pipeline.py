@@ -8,10 +8,14 @@ from mysql.connector import Error
 from tqdm import tqdm
 import helper_files.logger as logger
 import helper_files.helper as helper
+import helper_files.postcode_oa_index as postcode_oa_index
+import helper_files.census_features as census_features
+import helper_files.stop_index as stop_index
 
-def connect_to_mysql(config_data):
+def connect_to_mysql(config_data, **connect_args):
     """
     Establishes a connection to the MySQL database using provided configuration data.
+    Any connect_args (e.g. allow_local_infile=True) are passed on to mysql.connector.connect.
     Returns the connection object and a dictionary cursor.
     """
     conn = None
@@ -21,7 +25,8 @@ def connect_to_mysql(config_data):
             host=config_data["host"],
             user=config_data["user"],
             password=config_data["password"],
-            database=config_data["database"]
+            database=config_data["database"],
+            **connect_args
         )
         cursor = conn.cursor(dictionary=True)
         logger.log(f"Successfully connected to MySQL database: {config_data['database']}")
@@ -235,10 +240,20 @@ def run_initial_build():
                         'build_load_postcode_estimates.sql',
                         'build_tables.sql',
                         'load_census_data.sql',
+                        'build_census_features.sql',
                         'load_data.sql',
                         'load_oa_lookup.sql']
 
     success = load_data_pipeline(SOURCE_CSV_FOLDER, SQL_SCRIPTS_FOLDER, SQL_SCRIPT_FILES)
+    if success and 'load_oa_lookup.sql' in SQL_SCRIPT_FILES:
+        logger.log("Building postcode to OA index from the freshly loaded oa_lookup table...")
+        success = postcode_oa_index.build_postcode_oa_index()
+    if success and 'build_census_features.sql' in SQL_SCRIPT_FILES:
+        logger.log("Building census feature index from the freshly built census_features table...")
+        success = census_features.build_census_feature_index()
+    if success and 'load_data.sql' in SQL_SCRIPT_FILES:
+        logger.log("Building stop spatial index from the freshly loaded stops table...")
+        success = stop_index.build_stop_index()
     if success:
         logger.log("Full data load process finished successfully.")
     else:
@@ -0,0 +1,78 @@
+# enrichment_checkpoint.py
+
+import json
+import os
+import helper_files.logger as logger
+import helper_files.artifacts as artifacts
+
+# Passed as failure_value to the single-stop fetchers so a lookup that failed (retries exhausted,
+# bad response) can be told apart from a real zero or no-match and left out of the checkpoint.
+LOOKUP_FAILED = object()
+
+def checkpoint_path_for(output_file_path):
+    """
+    Returns the JSONL checkpoint log path that sits alongside a final enrichment artifact.
+    """
+    return os.path.splitext(output_file_path)[0] + ".jsonl"
+
+def load_checkpoint(checkpoint_path):
+    """
+    Reads a JSONL checkpoint log and returns the records already completed, keyed by stop_id.
+    Unreadable lines (e.g. a half-written line from a crash) are skipped.
+    """
+    completed = {}
+    if not os.path.exists(checkpoint_path):
+        return completed
+
+    with open(checkpoint_path, 'r') as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+                completed[str(record['stop_id'])] = record
+            except (json.JSONDecodeError, KeyError, TypeError):
+                logger.log(f"Warning: Skipping unreadable line {line_number} in checkpoint '{checkpoint_path}'.")
+
+    logger.log(f"Loaded {len(completed)} completed records from checkpoint '{checkpoint_path}'.")
+    return completed
+
+def open_checkpoint(checkpoint_path, resume=True):
+    """
+    Opens a checkpoint log for appending. If resume is False any existing log is discarded.
+    A trailing partial line left by a crash is terminated so new records start on a fresh line.
+    """
+    os.makedirs(os.path.dirname(checkpoint_path) or ".", exist_ok=True)
+
+    if not resume and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+        logger.log(f"Discarded existing checkpoint '{checkpoint_path}'.")
+
+    needs_newline = False
+    if os.path.exists(checkpoint_path) and os.path.getsize(checkpoint_path) > 0:
+        with open(checkpoint_path, 'rb') as f:
+            f.seek(-1, os.SEEK_END)
+            needs_newline = f.read(1) != b'\n'
+
+    checkpoint_file = open(checkpoint_path, 'a')
+    if needs_newline:
+        checkpoint_file.write('\n')
+    return checkpoint_file
+
+def append_checkpoint(checkpoint_file, record):
+    """
+    Appends a single completed record to the checkpoint log and flushes it to disk,
+    so a crash loses at most the record currently being processed.
+    """
+    checkpoint_file.write(json.dumps(record) + '\n')
+    checkpoint_file.flush()
+    os.fsync(checkpoint_file.fileno())
+
+def write_final_records(completed, stop_id_order, output_file_path, schema_name=None, export_formats=()):
+    """
+    Writes the completed records to the final enrichment artifact in the original stop order.
+    The format follows output_file_path's extension (Parquet, Feather, or legacy JSON keyed by stop_id).
+    """
+    ordered = [completed[stop_id] for stop_id in stop_id_order if stop_id in completed]
+    return artifacts.write_stop_records(ordered, output_file_path, schema_name, export_formats)
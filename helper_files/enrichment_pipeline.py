@@ -0,0 +1,310 @@
+# enrichment_pipeline.py
+
+import json
+import os
+import time
+import numpy as np
+import pandas as pd
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.artifacts as artifacts
+import helper_files.spatial_dedup as spatial_dedup
+import helper_files.stops_enrichment_oas as SEO
+import helper_files.providers as providers
+import helper_files.single_stop_enrichment as sse
+import helper_files.table_loader as table_loader
+
+DEFAULT_INTERMEDIATE_DIR = helper.affix_root_path("enrich/pipeline")
+STOPS_ENRICHED_TABLE = "stops_enriched"
+STOPS_ENRICHED_INDEX_COLUMNS = ['stop_id']
+# build_load_stops_enriched.sql stores both scores as DECIMAL(5, 4).
+SCORE_DECIMALS = 4
+INTERMEDIATE_FORMATS = {'parquet', 'feather'}
+
+STOPS_ENRICHED_COLUMNS = [
+    'stop_id', 'stop_name', 'stop_lat', 'stop_lon', 'postcode', 'oa21cd', 'lsoa21cd', 'lsoa21nm',
+    'shops_nearby_count', 'population_density', 'oa21pop', 'postcode_pop', 'employed_total',
+    'bus_commute_total', 'avg_weekly_frequency_per_hour', 'customer_convenience_score', 'commute_opportunity_score'
+]
+
+def _read_config(config_path):
+    try:
+        with open(config_path) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config_path}' not found.")
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config_path}'.")
+    return None
+
+def _query(sql, params, config_path):
+    """
+    Runs one query and returns its rows as a list of dicts, or None if the database is unavailable.
+    """
+    config_data = _read_config(config_path)
+    if config_data is None:
+        return None
+    conn, cursor = dp.connect_to_mysql(config_data)
+    if not conn:
+        return None
+    try:
+        cursor.execute(sql, params or None)
+        return cursor.fetchall()
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during enrichment pipeline query: {err}")
+        return None
+    finally:
+        cursor.close()
+        if conn.is_connected():
+            conn.close()
+
+def _lookup_by_location(df, fetch, dedup_tolerance_m):
+    """
+    Calls fetch once with the (lat, lon) pairs of one representative per cluster of nearby stops,
+    and returns fetch's results fanned back out to every row of df.
+    """
+    lats = df['stop_lat'].astype(float).tolist()
+    lons = df['stop_lon'].astype(float).tolist()
+    representative_of = spatial_dedup.cluster_points(lats, lons, dedup_tolerance_m)
+    representatives = sorted(set(representative_of))
+    representative_rows = {representative: row for row, representative in enumerate(representatives)}
+
+    values = fetch([(lats[r], lons[r]) for r in representatives])
+    spatial_dedup.report_savings("Pipeline lookup", len(df), len(representatives), dedup_tolerance_m)
+    return [values[representative_rows[r]] for r in representative_of]
+
+def load_stops(config_path=helper.affix_root_path("config.json"), STOPS_TABLE="stops"):
+    """
+    Loads the stops table into a DataFrame to start the pipeline from.
+    """
+    rows = _query(f"SELECT stop_id, stop_name, stop_lat, stop_lon FROM {STOPS_TABLE}", (), config_path)
+    if rows is None:
+        return None
+    return pd.DataFrame(rows, columns=['stop_id', 'stop_name', 'stop_lat', 'stop_lon'])
+
+def postcode_stage(df, settings):
+    """Adds a postcode column from the geocoding provider (the Postcodes.io bulk reverse geocoder by default)."""
+    fetch = lambda coords: providers.get_provider('geocoding').postcodes(coords, max_workers=settings['max_workers'])
+    df['postcode'] = pd.Series(_lookup_by_location(df, fetch, settings['dedup_tolerance_m']), index=df.index, dtype=object)
+    return df
+
+def oa_stage(df, settings):
+    """Adds oa21cd, lsoa21cd and lsoa21nm columns from the postcode index."""
+    oa_df = SEO.get_oa_lsoa_details_batch(df['postcode'].tolist(), settings['config_path'])
+    for column in ['oa21cd', 'lsoa21cd', 'lsoa21nm']:
+        df[column] = pd.Series([value if isinstance(value, str) else None for value in oa_df[column]], index=df.index, dtype=object)
+    return df
+
+def shops_stage(df, settings):
+    """Adds a shops_nearby_count column from the shops provider (batched Overpass queries by default)."""
+    fetch = lambda coords: providers.get_provider('shops').shop_counts(coords, max_workers=settings['max_workers'])
+    df['shops_nearby_count'] = pd.Series(_lookup_by_location(df, fetch, settings['dedup_tolerance_m']), index=df.index, dtype='Int64')
+    return df
+
+def density_stage(df, settings):
+    """
+    Adds a population_density column sampled from the density raster, with 0.0 outside it.
+    density_tif_path None uses the raster provider.
+    """
+    raster = providers.DensityRasterProvider(settings['density_tif_path']) if settings['density_tif_path'] else providers.get_provider('raster')
+    df['population_density'] = raster.sample(pd.to_numeric(df['stop_lon'], errors='coerce').to_numpy(dtype=float),
+                                             pd.to_numeric(df['stop_lat'], errors='coerce').to_numpy(dtype=float))
+    return df
+
+def census_stage(df, settings):
+    """Adds oa21pop, employed_total and bus_commute_total columns from the census feature index."""
+    census_df = sse.census_return_batch(df['oa21cd'].tolist(), settings['config_path'])
+    for column in ['oa21pop', 'employed_total', 'bus_commute_total']:
+        df[column] = pd.to_numeric(census_df[column], errors='coerce').round().astype('Int64').set_axis(df.index)
+    return df
+
+def postcode_population_stage(df, settings):
+    """
+    Adds a postcode_pop column from postcode_estimates, normalising postcodes the same way
+    as build_load_stops_enriched.sql (spaces are removed only from 8 character postcodes).
+    """
+    keys = [(postcode.replace(' ', '') if len(postcode) > 7 else postcode) if isinstance(postcode, str) else None
+            for postcode in df['postcode'].tolist()]
+    distinct_keys = sorted({key for key in keys if key})
+    populations = {}
+    if distinct_keys:
+        placeholders = ', '.join(['%s'] * len(distinct_keys))
+        rows = _query(f"SELECT postcode, total FROM postcode_estimates WHERE postcode IN ({placeholders})",
+                      tuple(distinct_keys), settings['config_path'])
+        for row in rows or []:
+            populations.setdefault(row['postcode'], row['total'])
+    df['postcode_pop'] = pd.array([populations.get(key) for key in keys], dtype='Int64')
+    return df
+
+def frequency_stage(df, settings):
+    """
+    Adds avg_weekly_frequency_per_hour for each stop by running avg_service_per_hour_by_week.sql.
+    """
+    with open(helper.affix_root_path("sql_scripts/avg_service_per_hour_by_week.sql")) as f:
+        query = f.read().strip().rstrip(';')
+    rows = _query(query, (), settings['config_path'])
+    frequency = {row['stop_id']: row['avg_weekly_frequency_per_hour'] for row in rows or []}
+    df['avg_weekly_frequency_per_hour'] = [np.nan if frequency.get(stop_id) is None else float(frequency[stop_id]) for stop_id in df['stop_id']]
+    return df
+
+def score_min_max_values(df):
+    """
+    Returns min/max values of the log-transformed score features across all stops, with missing
+    values counted as 0 as in build_load_stops_enriched.sql, in the format of min_max_values.json.
+    """
+    min_max_values = {}
+    for column in sse.CONVENIENCE_FEATURES:
+        values = pd.to_numeric(df[column], errors='coerce').astype(float).fillna(0) if column in df else pd.Series(0.0, index=df.index)
+        log_values = np.log1p(values.where(values >= 0))
+        min_max_values[column] = {'min': float(log_values.min()) if log_values.notna().any() else 0.0,
+                                  'max': float(log_values.max()) if log_values.notna().any() else 0.0}
+    return min_max_values
+
+def score_stage(df, settings):
+    """
+    Adds customer_convenience_score and commute_opportunity_score, normalised against this
+    frame's own min/max values and rounded to 4 places as build_load_stops_enriched.sql does.
+    Rows with none of a score's features score 0.
+    """
+    df = sse.calculate_scores_batch(df, score_min_max_values(df))
+    for score, features in [('customer_convenience_score', sse.CONVENIENCE_FEATURES), ('commute_opportunity_score', sse.COMMUTE_FEATURES)]:
+        present = [feature for feature in features if feature in df]
+        no_features = df[present].isna().all(axis=1) if present else pd.Series(True, index=df.index)
+        df.loc[no_features, score] = 0.0
+        df[score] = df[score].round(SCORE_DECIMALS)
+    return df
+
+STAGES = [
+    ('postcode', postcode_stage, ['stop_lat', 'stop_lon']),
+    ('oa', oa_stage, ['postcode']),
+    ('shops', shops_stage, ['stop_lat', 'stop_lon']),
+    ('density', density_stage, ['stop_lat', 'stop_lon']),
+    ('census', census_stage, ['oa21cd']),
+    ('postcode_population', postcode_population_stage, ['postcode']),
+    ('frequency', frequency_stage, ['stop_id']),
+    ('score', score_stage, ['shops_nearby_count', 'employed_total', 'bus_commute_total', 'avg_weekly_frequency_per_hour', 'population_density']),
+]
+STAGE_NAMES = [name for name, _, _ in STAGES]
+
+def default_settings(**overrides):
+    """Returns the settings passed to every stage, with any overrides applied."""
+    settings = {
+        'config_path': helper.affix_root_path("config.json"),
+        'density_tif_path': None,
+        'dedup_tolerance_m': spatial_dedup.DEFAULT_TOLERANCE_M,
+        'max_workers': 1,
+    }
+    settings.update(overrides)
+    return settings
+
+def intermediate_path(intermediate_dir, stage_name, intermediate_format='parquet'):
+    return os.path.join(intermediate_dir, f"stops_{stage_name}.{intermediate_format}")
+
+def write_intermediate(df, intermediate_dir, stage_name, intermediate_format='parquet'):
+    """
+    Writes a stage's output frame as a compressed columnar file. Returns the path, or None if it could not be written.
+    """
+    if intermediate_format not in INTERMEDIATE_FORMATS:
+        logger.log(f"Error: Unknown intermediate format '{intermediate_format}'. Use one of {sorted(INTERMEDIATE_FORMATS)}.")
+        return None
+    path = intermediate_path(intermediate_dir, stage_name, intermediate_format)
+    try:
+        artifacts.write_artifact(df, path)
+    except ImportError as e:
+        logger.log(f"Warning: Could not write {intermediate_format} intermediate for stage '{stage_name}': {e}")
+        return None
+    return path
+
+def read_intermediate(intermediate_dir, stage_name, intermediate_format='parquet', columns=None):
+    """
+    Reads a stage's saved output frame, or only the given columns of it. Returns None if it does not exist.
+    """
+    path = intermediate_path(intermediate_dir, stage_name, intermediate_format)
+    if not os.path.exists(path):
+        logger.log(f"Error: No saved output for stage '{stage_name}' at '{path}'.")
+        return None
+    return artifacts.read_artifact(path, columns=columns)
+
+def run_stage(stage_name, df, settings=None):
+    """
+    Runs a single stage on a frame in place. Returns (df, seconds), or (None, seconds) if the
+    frame is missing a column the stage needs.
+    """
+    settings = settings or default_settings()
+    _, stage, required_columns = STAGES[STAGE_NAMES.index(stage_name)]
+    missing = [column for column in required_columns if column not in df]
+    if missing:
+        logger.log(f"Error: Stage '{stage_name}' needs columns {missing}. Run the earlier stages first.")
+        return None, 0.0
+
+    start_time = time.perf_counter()
+    df = stage(df, settings)
+    elapsed = time.perf_counter() - start_time
+    logger.log(f"Stage '{stage_name}' finished in {elapsed:.2f}s for {len(df)} stops.")
+    return df, elapsed
+
+def run_pipeline(df=None, stages=None, start_at=None, intermediate_dir=None, intermediate_format='parquet', **settings):
+    """
+    Runs enrichment stages in order on one in-memory DataFrame of stops, starting from the
+    stops table if df is None. stages limits which stages run (default: all, in STAGES order).
+    If intermediate_dir is set, each stage's output is written there as a columnar file, and
+    start_at resumes from the saved output of the stage before it.
+    Returns (df, timings) where timings maps stage name to seconds, or (None, timings) on failure.
+    """
+    settings = default_settings(**settings)
+    stage_names = [name for name in STAGE_NAMES if stages is None or name in stages]
+    timings = {}
+
+    if start_at is not None:
+        stage_names = stage_names[stage_names.index(start_at):]
+        previous = STAGE_NAMES.index(start_at) - 1
+        if df is None and previous >= 0 and intermediate_dir:
+            df = read_intermediate(intermediate_dir, STAGE_NAMES[previous], intermediate_format)
+            if df is None:
+                return None, timings
+
+    if df is None:
+        df = load_stops(settings['config_path'])
+        if df is None:
+            logger.log("Error: Could not load stops for the enrichment pipeline.")
+            return None, timings
+    df = df.copy()
+
+    logger.log(f"Running enrichment pipeline stages {stage_names} on {len(df)} stops...")
+    for stage_name in stage_names:
+        df, timings[stage_name] = run_stage(stage_name, df, settings)
+        if df is None:
+            return None, timings
+        if intermediate_dir:
+            write_intermediate(df, intermediate_dir, stage_name, intermediate_format)
+
+    logger.log(f"Enrichment pipeline finished in {sum(timings.values()):.2f}s: " +
+               ", ".join(f"{name} {seconds:.2f}s" for name, seconds in timings.items()))
+    return df[[column for column in STOPS_ENRICHED_COLUMNS if column in df] +
+              [column for column in df.columns if column not in STOPS_ENRICHED_COLUMNS]], timings
+
+def build_stops_enriched(output_filename=helper.affix_root_path("data/stops_enriched.parquet"), intermediate_dir=None,
+                         export_formats=(), write_to_db=True, db_load_method='auto', **settings):
+    """
+    Runs the full pipeline from the stops table and writes the typed stops_enriched artifact, replacing the
+    postcode -> oas -> shops files and the stops_intermediate round trip through MySQL.
+    export_formats can include 'csv' and/or 'json' to also write those copies of the output.
+    With write_to_db, the MySQL stops_enriched table that trip enrichment reads is replaced with the
+    same rows (see table_loader.bulk_load_table). Returns the stage timings, or None on failure.
+    """
+    df, timings = run_pipeline(intermediate_dir=intermediate_dir, **settings)
+    if df is None:
+        logger.log(f"Error: Enrichment pipeline failed. '{output_filename}' not written.")
+        return None
+    artifacts.write_artifact(df, output_filename, 'stops_enriched', export_formats)
+    logger.log(f"Wrote {len(df)} enriched stops to '{output_filename}'.")
+
+    if write_to_db:
+        db_config = _read_config(default_settings(**settings)['config_path'])
+        if db_config is None or table_loader.bulk_load_table(db_config, df[[column for column in STOPS_ENRICHED_COLUMNS if column in df]],
+                                                              STOPS_ENRICHED_TABLE, STOPS_ENRICHED_INDEX_COLUMNS, db_load_method) is None:
+            logger.log(f"Error: Could not load the '{STOPS_ENRICHED_TABLE}' table. Trip enrichment would read stale stops.")
+            return None
+    return timings
@@ -0,0 +1,374 @@
+# enrichment_service.py
+
+import asyncio
+import io
+import json
+import math
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.single_stop_enrichment as sse
+import helper_files.raster_sampler as raster_sampler
+import helper_files.postcode_oa_index as postcode_oa_index
+import helper_files.census_features as census_features
+import helper_files.stop_index as stop_index
+import helper_files.model_registry as model_registry
+import helper_files.api_client as api_client
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 10 * 1024 * 1024
+LATENCY_WINDOW = 1000
+
+WARM_MODEL_FILES = ['kmeans_model.joblib', 'kmeans_scaler.joblib', 'gradient_boosting_model.joblib',
+                    'imputer_X.joblib', 'scaler_X.joblib', 'scaler_y.joblib']
+WARM_JSON_FILES = ['cluster_dict.json', 'min_max_values.json']
+
+HTTP_REASONS = {200: "OK", 204: "No Content", 400: "Bad Request", 404: "Not Found",
+                413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+
+class ServiceError(Exception):
+    """An error with an HTTP status code, returned to the client as a JSON error body."""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def _to_jsonable(value):
+    """
+    Converts NumPy/pandas scalars and containers into plain JSON-safe Python values,
+    mapping NaN and missing values to None.
+    """
+    if isinstance(value, dict):
+        return {str(k): _to_jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if value is pd.NA or value is pd.NaT:
+        return None
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+def _frame_to_records(df):
+    """Converts a DataFrame to a list of JSON-safe dicts."""
+    return json.loads(df.to_json(orient='records'))
+
+def nearby_stops(coords, k=1, radius_m=stop_index.DEFAULT_RADIUS_M):
+    """
+    For each (lat, lon), returns the k nearest existing stops (with their distance in metres)
+    and every existing stop within radius_m, nearest first.
+    """
+    index = stop_index.get_stop_index()
+    if index is None:
+        raise ServiceError(503, "Stop index is not available.")
+    lats = [lat for lat, _ in coords]
+    lons = [lon for _, lon in coords]
+    distances, positions = index.nearest(lats, lons, k=k)
+
+    def stop_record(position, distance):
+        return {'stop_id': index.stop_id(position), 'stop_name': index.stop_name(position),
+                'stop_lat': float(index.lats[position]), 'stop_lon': float(index.lons[position]),
+                'distance_m': round(float(distance), 1)}
+
+    xy = stop_index.project(lats, lons)
+    points = []
+    for point, within in enumerate(index.within_radius(lats, lons, radius_m)):
+        within_distances = np.hypot(*(index.xy[within] - xy[point]).T)
+        points.append({
+            'nearest': [stop_record(position, distance) for position, distance in zip(positions[point], distances[point]) if position >= 0],
+            'within_radius': [stop_record(position, distance) for position, distance in zip(within, within_distances)],
+        })
+    return points
+
+class LatencyMetrics:
+    """
+    Tracks request counts, errors and a rolling window of latencies per endpoint.
+    """
+    def __init__(self, window=LATENCY_WINDOW):
+        self.window = window
+        self.endpoints = {}
+
+    def record(self, endpoint, seconds, status):
+        stats = self.endpoints.setdefault(endpoint, {'count': 0, 'errors': 0, 'latencies': deque(maxlen=self.window)})
+        stats['count'] += 1
+        if status >= 400:
+            stats['errors'] += 1
+        stats['latencies'].append(seconds)
+
+    def snapshot(self):
+        snapshot = {}
+        for endpoint, stats in self.endpoints.items():
+            latencies_ms = np.array(stats['latencies'], dtype=float) * 1000
+            percentiles = np.percentile(latencies_ms, [50, 95, 99]).round(2).tolist() if len(latencies_ms) else [None] * 3
+            snapshot[endpoint] = {
+                'count': stats['count'],
+                'errors': stats['errors'],
+                'p50_ms': percentiles[0],
+                'p95_ms': percentiles[1],
+                'p99_ms': percentiles[2],
+                'max_ms': round(float(latencies_ms.max()), 2) if len(latencies_ms) else None,
+            }
+        return snapshot
+
+class EnrichmentService:
+    """
+    A small asyncio HTTP service that keeps models, the raster sampler and the postcode index
+    warm and answers single-stop, batch and generated-route enrichment requests.
+    Blocking enrichment work runs in a thread pool; at most max_concurrency requests run at
+    once and at most max_queue wait, beyond which requests are rejected with 503.
+
+    route_enricher is a callable taking (shapes_df, stops_df) and returning
+    (enriched_stops_df, enriched_trip_df), e.g. created_trip_stops_enriched.enrich_generated_trip_frames.
+    """
+    def __init__(self, route_enricher=None, max_concurrency=4, max_queue=32, model_dir=helper.affix_root_path("models")):
+        self.route_enricher = route_enricher
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.model_dir = model_dir
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency)
+        self.semaphore = None
+        self.metrics = LatencyMetrics()
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self.started_at = time.time()
+        self.routes = {
+            ('GET', '/health'): self.handle_health,
+            ('GET', '/metrics'): self.handle_metrics,
+            ('POST', '/enrich/stop'): self.handle_enrich_stop,
+            ('POST', '/enrich/stops'): self.handle_enrich_stops,
+            ('POST', '/enrich/route'): self.handle_enrich_route,
+            ('POST', '/stops/nearby'): self.handle_nearby_stops,
+        }
+
+    def warm_up(self):
+        """
+        Loads the prediction models, lookup indexes and raster sampler so the first request
+        does not pay for them. Missing artifacts are logged and loaded lazily later instead.
+        """
+        start_time = time.time()
+        for filename in WARM_MODEL_FILES:
+            try:
+                model_registry.load_joblib(f"{self.model_dir}/{filename}")
+            except Exception as e:
+                logger.log(f"Warning: Could not warm model '{filename}': {e}")
+        for filename in WARM_JSON_FILES:
+            try:
+                model_registry.load_json(f"{self.model_dir}/{filename}")
+            except Exception as e:
+                logger.log(f"Warning: Could not warm '{filename}': {e}")
+        if postcode_oa_index.load_postcode_oa_index() is None:
+            logger.log("Warning: No postcode index found. OA lookups will fall back to the database.")
+        if census_features.load_census_feature_index() is None:
+            logger.log("Warning: No census feature index found. Census lookups will build it or fall back to the database.")
+        if stop_index.load_stop_index() is None:
+            logger.log("Warning: No stop index found. It will be built from the database on first use.")
+        try:
+            raster_sampler.get_sampler()
+        except Exception as e:
+            logger.log(f"Warning: Could not open population density raster: {e}")
+        logger.log(f"Enrichment service warm-up finished in {time.time() - start_time:.2f}s.")
+
+    async def run_blocking(self, func, *args):
+        """
+        Runs blocking work in the thread pool under the concurrency and queue limits.
+        """
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise ServiceError(503, "Server busy, try again later.")
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+        finally:
+            self.in_flight -= 1
+            self.semaphore.release()
+
+    async def handle_health(self, body):
+        return {'status': 'ok', 'uptime_seconds': round(time.time() - self.started_at, 1)}
+
+    async def handle_metrics(self, body):
+        try:
+            raster_stats = raster_sampler.get_sampler().cache_stats()
+        except Exception:
+            raster_stats = None
+        return {
+            'endpoints': self.metrics.snapshot(),
+            'in_flight': self.in_flight,
+            'waiting': self.waiting,
+            'rejected': self.rejected,
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'raster_cache': raster_stats,
+            'cached_models': len(model_registry.cached_paths()),
+            'external_apis': api_client.stats(),
+        }
+
+    async def handle_enrich_stop(self, body):
+        payload = self.parse_json(body)
+        try:
+            stop_lat = float(payload['stop_lat'])
+            stop_lon = float(payload['stop_lon'])
+        except (KeyError, TypeError, ValueError):
+            raise ServiceError(400, "Expected a JSON object with numeric 'stop_lat' and 'stop_lon'.")
+        record = await self.run_blocking(sse.enriched_record_from_lat_lon, stop_lat, stop_lon)
+        return _to_jsonable(record)
+
+    async def handle_enrich_stops(self, body):
+        payload = self.parse_json(body)
+        try:
+            coords = [(float(lat), float(lon)) for lat, lon in payload['coordinates']]
+        except (KeyError, TypeError, ValueError):
+            raise ServiceError(400, "Expected a JSON object with 'coordinates' as a list of [lat, lon] pairs.")
+        enriched_df = await self.run_blocking(sse.enriched_records_from_lat_lons, coords)
+        return {'stops': _frame_to_records(enriched_df)}
+
+    async def handle_enrich_route(self, body):
+        if self.route_enricher is None:
+            raise ServiceError(404, "Route enrichment is not enabled on this server.")
+        payload = self.parse_json(body)
+        try:
+            shapes_df = pd.read_csv(io.StringIO(payload['shape_csv']))
+            stops_df = pd.read_csv(io.StringIO(payload['stops_csv']))
+        except (KeyError, TypeError, ValueError, pd.errors.ParserError) as e:
+            raise ServiceError(400, f"Expected 'shape_csv' and 'stops_csv' CSV text from route_maker.html: {e}")
+        enriched_stops_df, enriched_trip_df = await self.run_blocking(self.route_enricher, shapes_df, stops_df)
+        return {
+            'stops': _frame_to_records(enriched_stops_df.reset_index()),
+            'trip': _frame_to_records(enriched_trip_df),
+        }
+
+    async def handle_nearby_stops(self, body):
+        payload = self.parse_json(body)
+        try:
+            coords = [(float(lat), float(lon)) for lat, lon in payload['coordinates']]
+            k = int(payload.get('k', 1))
+            radius_m = float(payload.get('radius_m', stop_index.DEFAULT_RADIUS_M))
+        except (KeyError, TypeError, ValueError):
+            raise ServiceError(400, "Expected a JSON object with 'coordinates' as a list of [lat, lon] pairs, "
+                                    "and optionally integer 'k' and numeric 'radius_m'.")
+        if k < 1 or radius_m < 0:
+            raise ServiceError(400, "'k' must be at least 1 and 'radius_m' must not be negative.")
+        return {'points': await self.run_blocking(nearby_stops, coords, k, radius_m)}
+
+    def parse_json(self, body):
+        try:
+            return json.loads(body or b'{}')
+        except (json.JSONDecodeError, UnicodeDecodeError):
+            raise ServiceError(400, "Request body is not valid JSON.")
+
+    async def handle_connection(self, reader, writer):
+        """
+        Reads one HTTP/1.1 request, dispatches it and writes a JSON response.
+        """
+        start_time = time.perf_counter()
+        endpoint = "invalid"
+        status = 500
+        response = None
+        request_read = False
+        try:
+            request_line = (await reader.readline()).decode('latin-1').strip()
+            if not request_line:
+                return
+            request_read = True
+            parts = request_line.split(' ')
+            if len(parts) < 2:
+                raise ServiceError(400, "Malformed request line.")
+            method, target = parts[:2]
+            path = target.split('?', 1)[0]
+            endpoint = f"{method} {path}"
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            content_length = int(headers.get('content-length', 0) or 0)
+            if content_length > MAX_BODY_BYTES:
+                raise ServiceError(413, f"Request body exceeds {MAX_BODY_BYTES} bytes.")
+            body = await reader.readexactly(content_length) if content_length else b''
+
+            if method == 'OPTIONS':
+                status = 204
+            else:
+                handler = self.routes.get((method, path))
+                if handler is None:
+                    raise ServiceError(404, f"No route for {method} {path}.")
+                response = await handler(body)
+                status = 200
+        except ServiceError as e:
+            status = e.status
+            response = {'error': str(e)}
+        except Exception as e:
+            logger.log(f"Enrichment service error handling '{endpoint}': {e}")
+            status = 500
+            response = {'error': str(e)}
+        finally:
+            # A connection that closed or idled out before sending a request line gets no response
+            # and is not counted, so keep-alive and health-check probes do not show up as errors.
+            if request_read:
+                elapsed = time.perf_counter() - start_time
+                self.metrics.record(endpoint, elapsed, status)
+                try:
+                    await self.write_response(writer, status, response, elapsed)
+                except ConnectionError:
+                    pass
+            else:
+                writer.close()
+
+    async def write_response(self, writer, status, response, elapsed):
+        body = json.dumps(response).encode('utf-8') if response is not None else b''
+        header_lines = [
+            f"HTTP/1.1 {status} {HTTP_REASONS.get(status, 'Unknown')}",
+            "Content-Type: application/json",
+            f"Content-Length: {len(body)}",
+            "Access-Control-Allow-Origin: *",
+            "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            "Access-Control-Allow-Headers: Content-Type",
+            f"X-Response-Time-Ms: {elapsed * 1000:.1f}",
+            "Connection: close",
+        ]
+        writer.write(("\r\n".join(header_lines) + "\r\n\r\n").encode('latin-1') + body)
+        await writer.drain()
+        writer.close()
+
+    async def serve(self, host=DEFAULT_HOST, port=DEFAULT_PORT, ready=None):
+        """
+        Starts the server and serves until cancelled. If ready is an asyncio.Event it is set
+        once the socket is listening; self.port holds the bound port (useful with port 0).
+        """
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        self.port = server.sockets[0].getsockname()[1]
+        logger.log(f"Enrichment service listening on http://{host}:{self.port}")
+        if ready is not None:
+            ready.set()
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.executor.shutdown(wait=False)
+
+def run_service(host=DEFAULT_HOST, port=DEFAULT_PORT, route_enricher=None, max_concurrency=4, max_queue=32, warm=True):
+    """
+    Creates an EnrichmentService, warms its caches and serves until interrupted.
+    """
+    service = EnrichmentService(route_enricher=route_enricher, max_concurrency=max_concurrency, max_queue=max_queue)
+    if warm:
+        service.warm_up()
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        logger.log("Enrichment service stopped.")
@@ -0,0 +1,173 @@
+# fuel_model.py
+
+import json
+import numpy as np
+import pandas as pd
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.artifacts as artifacts
+
+DEFAULT_PROFILES_PATH = helper.affix_root_path("vehicle_profiles.json")
+
+# Fuel rates per vehicle type: fuel_rate_moving in L/km, fuel_rate_idling in L/h.
+# diesel_double_deck matches the rates trips_enriched has always used, so it is the default.
+DEFAULT_PROFILES = {
+    'diesel_single_deck': {'fuel_rate_moving': 0.38, 'fuel_rate_idling': 1.6},
+    'diesel_double_deck': {'fuel_rate_moving': 0.47, 'fuel_rate_idling': 2.0},
+    'hybrid_double_deck': {'fuel_rate_moving': 0.33, 'fuel_rate_idling': 0.6},
+}
+DEFAULT_PROFILE = 'diesel_double_deck'
+
+def load_vehicle_profiles(path=DEFAULT_PROFILES_PATH):
+    """
+    Loads the vehicle profile table and the route/block assignments from a JSON file of the form
+    {"default_profile": name, "profiles": {name: {"fuel_rate_moving": L/km, "fuel_rate_idling": L/h}},
+     "assignments": {"route_id": {route_id: name}, "block_id": {block_id: name}}}.
+    Returns (profiles_df indexed by profile name, assignments dict, default profile name), using the
+    built-in profiles for anything the file does not define.
+    """
+    profiles = {name: dict(rates) for name, rates in DEFAULT_PROFILES.items()}
+    assignments = {'route_id': {}, 'block_id': {}}
+    default_profile = DEFAULT_PROFILE
+
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+        profiles.update(data.get('profiles', {}))
+        for key in assignments:
+            assignments[key].update({str(k): v for k, v in data.get('assignments', {}).get(key, {}).items()})
+        default_profile = data.get('default_profile', default_profile)
+    except FileNotFoundError:
+        logger.log(f"No vehicle profile file at '{path}'. Using the built-in profiles.")
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode vehicle profiles from '{path}'. Using the built-in profiles.")
+
+    profiles_df = pd.DataFrame.from_dict(profiles, orient='index')[['fuel_rate_moving', 'fuel_rate_idling']].astype(float)
+    profiles_df.index.name = 'vehicle_profile'
+
+    unknown = {name for mapping in assignments.values() for name in mapping.values()} - set(profiles_df.index)
+    if default_profile not in profiles_df.index:
+        unknown.add(default_profile)
+        default_profile = DEFAULT_PROFILE
+    if unknown:
+        logger.log(f"Warning: Unknown vehicle profiles {sorted(unknown)} are assigned. Those trips use '{default_profile}'.")
+    return profiles_df, assignments, default_profile
+
+def assign_profiles(trips_df, assignments, default_profile=DEFAULT_PROFILE, profiles_df=None):
+    """
+    Returns the vehicle profile of every trip: the block_id assignment if there is one, otherwise
+    the route_id assignment, otherwise default_profile. Assignments to profiles missing from
+    profiles_df fall back to default_profile.
+    """
+    profile = pd.Series(np.nan, index=trips_df.index, dtype=object)
+    for key in ['block_id', 'route_id']:
+        if key in trips_df and assignments.get(key):
+            keys = trips_df[key].astype(str).where(trips_df[key].notna())
+            profile = profile.fillna(keys.map(assignments[key]))
+    if profiles_df is not None:
+        profile = profile.where(profile.isin(profiles_df.index))
+    return profile.fillna(default_profile).rename('vehicle_profile')
+
+def fuel_liters(distance_km, idle_seconds, fuel_rate_moving, fuel_rate_idling):
+    """
+    Moving and idling fuel in litres, broadcasting NumPy-style over any mix of scalars and arrays.
+    Returns (moving_fuel, idling_fuel).
+    """
+    moving_fuel = np.asarray(distance_km, dtype=float) * np.asarray(fuel_rate_moving, dtype=float)
+    idling_fuel = np.asarray(idle_seconds, dtype=float) / 3600 * np.asarray(fuel_rate_idling, dtype=float)
+    return moving_fuel, idling_fuel
+
+def estimate_trip_fuel(trips_df, profiles_df=None, assignments=None, default_profile=DEFAULT_PROFILE,
+                       fuel_rate_moving=None, fuel_rate_idling=None):
+    """
+    Estimates fuel for every trip at once from total_distance_km and total_idle_seconds.
+    Each trip uses the rates of its assigned vehicle profile. A given fuel_rate_moving or
+    fuel_rate_idling overrides that rate for every trip and those trips are labelled
+    '<profile>+override'; with both given, no profile is used and trips are labelled 'custom'.
+    Returns a DataFrame aligned to trips_df with vehicle_profile, moving_fuel_liters,
+    idling_fuel_liters and estimated_fuel_usage_liters.
+    """
+    if fuel_rate_moving is not None and fuel_rate_idling is not None:
+        profile = pd.Series('custom', index=trips_df.index, name='vehicle_profile')
+        moving_rates, idling_rates = fuel_rate_moving, fuel_rate_idling
+    else:
+        if profiles_df is None:
+            profiles_df, assignments, default_profile = load_vehicle_profiles()
+        profile = assign_profiles(trips_df, assignments or {}, default_profile, profiles_df)
+        rates = profiles_df.reindex(profile)
+        moving_rates = rates['fuel_rate_moving'].to_numpy() if fuel_rate_moving is None else fuel_rate_moving
+        idling_rates = rates['fuel_rate_idling'].to_numpy() if fuel_rate_idling is None else fuel_rate_idling
+        if fuel_rate_moving is not None or fuel_rate_idling is not None:
+            profile = profile + '+override'
+
+    moving_fuel, idling_fuel = fuel_liters(trips_df['total_distance_km'], trips_df['total_idle_seconds'], moving_rates, idling_rates)
+    return pd.DataFrame({
+        'vehicle_profile': profile.to_numpy(),
+        'moving_fuel_liters': moving_fuel,
+        'idling_fuel_liters': idling_fuel,
+        'estimated_fuel_usage_liters': moving_fuel + idling_fuel,
+    }, index=trips_df.index)
+
+def profile_scenarios(profiles_df, moving_multipliers=(1.0,), idling_multipliers=(1.0,)):
+    """
+    Builds a scenario table with one row for every profile and rate multiplier combination,
+    named like 'hybrid_double_deck' or 'hybrid_double_deck_x1.1_x0.5'.
+    Returns a DataFrame indexed by scenario with fuel_rate_moving and fuel_rate_idling.
+    """
+    rows = {}
+    for profile, rates in profiles_df.iterrows():
+        for moving_multiplier in moving_multipliers:
+            for idling_multiplier in idling_multipliers:
+                name = profile if (moving_multiplier, idling_multiplier) == (1.0, 1.0) else f"{profile}_x{moving_multiplier:g}_x{idling_multiplier:g}"
+                rows[name] = {'fuel_rate_moving': rates['fuel_rate_moving'] * moving_multiplier,
+                              'fuel_rate_idling': rates['fuel_rate_idling'] * idling_multiplier}
+    scenarios = pd.DataFrame.from_dict(rows, orient='index')
+    scenarios.index.name = 'scenario'
+    return scenarios
+
+def scenario_matrix(trips_df, scenarios_df):
+    """
+    Estimates total fuel in litres for every trip under every scenario in one broadcast:
+    (trips x 1) distances and idle hours against (1 x scenarios) rates. scenarios_df is indexed by
+    scenario name with fuel_rate_moving and fuel_rate_idling columns (e.g. from profile_scenarios).
+    Returns a trips x scenarios DataFrame indexed by trip_id.
+    """
+    distance_km = pd.to_numeric(trips_df['total_distance_km'], errors='coerce').to_numpy(dtype=float)[:, None]
+    idle_seconds = pd.to_numeric(trips_df['total_idle_seconds'], errors='coerce').to_numpy(dtype=float)[:, None]
+    moving_fuel, idling_fuel = fuel_liters(distance_km, idle_seconds,
+                                           scenarios_df['fuel_rate_moving'].to_numpy(dtype=float)[None, :],
+                                           scenarios_df['fuel_rate_idling'].to_numpy(dtype=float)[None, :])
+    return pd.DataFrame(moving_fuel + idling_fuel, index=pd.Index(trips_df['trip_id'], name='trip_id'),
+                        columns=pd.Index(scenarios_df.index, name='scenario'))
+
+def scenario_summary(matrix_df):
+    """Totals a scenario matrix per scenario, with the change against the first scenario."""
+    totals = matrix_df.sum(axis=0).rename('total_fuel_liters').to_frame()
+    totals['change_vs_first'] = totals['total_fuel_liters'] - totals['total_fuel_liters'].iloc[0]
+    return totals
+
+def evaluate_scenarios(scenarios_df=None,
+                       trips_enriched_path=helper.affix_root_path("data/trips_enriched.csv"),
+                       output_filename=helper.affix_root_path("data/fuel_scenarios.parquet"),
+                       export_formats=()):
+    """
+    Re-prices already enriched trips under many fuel scenarios without re-running the trip pipeline.
+    Reads only trip_id, total_distance_km and total_idle_seconds from trips_enriched, builds the
+    trips x scenarios matrix (every vehicle profile by default) and writes it with one column per scenario.
+    Returns the per-scenario totals, or None if the trips file cannot be read.
+    """
+    try:
+        trips_df = artifacts.read_artifact(trips_enriched_path, columns=['trip_id', 'total_distance_km', 'total_idle_seconds'])
+    except (FileNotFoundError, ValueError, KeyError) as e:
+        logger.log(f"Error: Could not read enriched trips from '{trips_enriched_path}': {e}")
+        return None
+
+    if scenarios_df is None:
+        scenarios_df = profile_scenarios(load_vehicle_profiles()[0])
+    matrix_df = scenario_matrix(trips_df, scenarios_df)
+    artifacts.write_artifact(matrix_df.reset_index(), output_filename, export_formats=export_formats)
+
+    summary = scenario_summary(matrix_df)
+    logger.log(f"Fuel scenarios for {len(matrix_df)} trips written to '{output_filename}':")
+    logger.log(summary)
+    return summary
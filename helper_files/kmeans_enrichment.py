@@ -1,25 +1,167 @@
 # kmeans_enrichment.py
 
 import pandas as pd
+import numpy as np
 from sklearn.preprocessing import StandardScaler
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.metrics import silhouette_score
+from scipy.optimize import linear_sum_assignment
+from scipy.spatial.distance import cdist
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
 import helper_files.logger as logger
+import helper_files.artifacts as artifacts
 import joblib
 import json
+import hashlib
+import time
+import sklearn
 import helper_files.helper as helper
 import os
 
-
-def kmeans_model(stops_enriched_csv_path = helper.affix_root_path("data/stops_enriched.csv"), 
-                 output_filename = helper.affix_root_path("data/stops_enriched_with_clusters.csv"),
-                 model_dir = helper.affix_root_path("models")
+CLUSTER_METHODS = ('auto', 'kmeans', 'minibatch')
+# 'auto' switches to MiniBatchKMeans above this many stops (roughly a national stops table).
+MINIBATCH_THRESHOLD = 100000
+MINIBATCH_SIZE = 4096
+DEFAULT_K_VALUES = (2, 3, 4, 5, 6)
+DEFAULT_SEEDS = tuple(range(42, 47))
+SCORE_SAMPLE_SIZE = 5000
+SWEEP_CACHE_FILE = "kmeans_sweep_cache.joblib"
+
+def _fit_candidate(X, sample, k, seed, method, batch_size):
+    """Fits one (k, seed) candidate and scores it on the sample. Runs in a joblib worker."""
+    start_time = time.time()
+    if method == 'minibatch':
+        model = MiniBatchKMeans(n_clusters=k, random_state=seed, batch_size=batch_size, n_init=1)
+    else:
+        model = KMeans(n_clusters=k, random_state=seed, n_init=1)
+    model.fit(X)
+    sample_labels = model.predict(sample)
+    silhouette = silhouette_score(sample, sample_labels) if len(np.unique(sample_labels)) > 1 else np.nan
+    return model, {'k': k, 'seed': seed, 'sample_inertia': -model.score(sample),
+                   'silhouette': silhouette, 'seconds': round(time.time() - start_time, 2)}
+
+def sweep_key(X, k_values, seeds, method, batch_size, sample_size):
+    """Hash of the scaled feature matrix and sweep settings; a cached sweep is reused only on a match."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(X, dtype=np.float64).tobytes())
+    digest.update(repr((sorted(k_values), sorted(seeds), method, batch_size, sample_size, sklearn.__version__)).encode())
+    return digest.hexdigest()
+
+def sweep_kmeans(X, k_values=DEFAULT_K_VALUES, seeds=DEFAULT_SEEDS, method='kmeans',
+                 batch_size=MINIBATCH_SIZE, sample_size=SCORE_SAMPLE_SIZE, n_jobs=-1, cache_path=None):
+    """
+    Fits one model per (k, seed) in parallel and scores each on the same random sample of at most
+    sample_size rows: inertia (lower is better) and silhouette (higher is better), so scoring stays
+    cheap however many stops there are. With cache_path, a sweep over the same data and settings is
+    loaded rather than refitted. Returns (scores DataFrame, {(k, seed): fitted model}).
+    """
+    key = sweep_key(X, k_values, seeds, method, batch_size, sample_size)
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            cached = joblib.load(cache_path)
+            if cached.get('key') == key:
+                logger.log(f"Loaded k-means sweep of {len(cached['models'])} models from '{cache_path}'.")
+                return cached['scores'], cached['models']
+        except (OSError, EOFError, ValueError, KeyError, AttributeError) as e:
+            logger.log(f"Warning: Could not read k-means sweep cache '{cache_path}': {e}. Refitting.")
+
+    start_time = time.time()
+    rng = np.random.default_rng(0)
+    sample = X[np.sort(rng.choice(len(X), size=min(len(X), sample_size), replace=False))]
+    candidates = [(k, seed) for k in k_values for seed in seeds if k < len(X)]
+    results = joblib.Parallel(n_jobs=n_jobs)(
+        joblib.delayed(_fit_candidate)(X, sample, k, seed, method, batch_size) for k, seed in candidates)
+    models = {(row['k'], row['seed']): model for model, row in results}
+    scores = pd.DataFrame([row for _, row in results])
+    logger.log(f"K-means sweep of {len(models)} {method} models over k={list(k_values)} took {time.time() - start_time:.1f}s.")
+
+    if cache_path is not None:
+        temp_path = cache_path + ".tmp"
+        joblib.dump({'key': key, 'scores': scores, 'models': models}, temp_path)
+        os.replace(temp_path, cache_path)
+    return scores, models
+
+def select_model(scores, n_clusters=None):
+    """
+    Picks the lowest-inertia seed for n_clusters, or, with n_clusters None, for the k whose best
+    seed has the highest silhouette. Returns the chosen (k, seed).
+    """
+    best_per_k = scores.sort_values(['sample_inertia', 'seed']).drop_duplicates('k').set_index('k')
+    if n_clusters is None:
+        n_clusters = best_per_k['silhouette'].idxmax()
+    elif n_clusters not in best_per_k.index:
+        raise ValueError(f"k={n_clusters} is not part of the sweep (k={sorted(best_per_k.index)}).")
+    return n_clusters, int(best_per_k.loc[n_clusters, 'seed'])
+
+def stable_label_order(centers, reference_centers=None):
+    """
+    Returns order such that centers[order] keeps the previous model's cluster ids: new clusters are
+    matched to the reference centers by minimum total distance (Hungarian assignment) and keep their
+    ids, and any clusters left over take the remaining ids sorted by their centers. Without a reference
+    every cluster is sorted by its center, so the ids do not depend on the seed.
+    """
+    k = len(centers)
+    order = np.full(k, -1)
+    unmatched = np.arange(k)
+    if reference_centers is not None and len(reference_centers):
+        reference = np.asarray(reference_centers, dtype=float)[:k]
+        rows, cols = linear_sum_assignment(cdist(reference, centers))
+        order[rows] = cols
+        unmatched = np.setdiff1d(unmatched, cols)
+    unmatched = unmatched[np.lexsort(centers[unmatched].T[::-1])]
+    order[order == -1] = unmatched
+    return order
+
+def relabel(model, order):
+    """Reorders a fitted (MiniBatch)KMeans in place so that new cluster i is old cluster order[i]; predict follows."""
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+    model.cluster_centers_ = model.cluster_centers_[order]
+    model.labels_ = inverse[model.labels_]
+    if hasattr(model, '_counts'):
+        model._counts = model._counts[order]
+    return model
+
+def reference_centers(model_dir, scaler):
+    """
+    Centers of the previously saved model mapped into the new scaler's space, or None if there is
+    no previous model. Matching against these keeps cluster ids (and so cluster_dict.json) stable.
+    """
+    try:
+        previous_model = joblib.load(os.path.join(model_dir, "kmeans_model.joblib"))
+        previous_scaler = joblib.load(os.path.join(model_dir, "kmeans_scaler.joblib"))
+        raw_centers = previous_model.cluster_centers_ * previous_scaler.scale_ + previous_scaler.mean_
+        return (raw_centers - scaler.mean_) / scaler.scale_
+    except (OSError, EOFError, ValueError, AttributeError) as e:
+        logger.log(f"No previous k-means model to align cluster ids with ({e}). Ordering clusters by center.")
+        return None
+
+
+def kmeans_model(stops_enriched_csv_path = helper.affix_root_path("data/stops_enriched.parquet"), 
+                 output_filename = helper.affix_root_path("data/stops_enriched_with_clusters.parquet"),
+                 model_dir = helper.affix_root_path("models"),
+                 export_formats = (),
+                 n_clusters = 3,
+                 k_values = DEFAULT_K_VALUES,
+                 seeds = DEFAULT_SEEDS,
+                 method = 'auto',
+                 n_jobs = -1,
+                 use_cache = True
                  ):
     """
-    Creates and saves a kmeans model, and adds two new fields to the csv. (cluster and cluster_category)
+    Creates and saves a kmeans model, and adds two new fields to the stops artifact. (cluster and cluster_category)
+    export_formats can include 'csv' and/or 'json' to also write those copies of the output.
+    Every k in k_values is fitted with every seed in parallel (see sweep_kmeans) and the best seed for
+    n_clusters is kept; n_clusters None picks k by silhouette. method 'minibatch' uses MiniBatchKMeans,
+    'auto' does so above MINIBATCH_THRESHOLD stops. Cluster ids are aligned with the previous model so
+    cluster_dict.json keeps describing the same clusters. Returns the sweep scores.
     """
-    df = pd.read_csv(stops_enriched_csv_path)
+    if method not in CLUSTER_METHODS:
+        raise ValueError(f"Unknown clustering method '{method}'. Use one of {list(CLUSTER_METHODS)}.")
+    start_time = time.time()
+    df = artifacts.read_artifact(stops_enriched_csv_path, schema_name='stops_enriched')
+    df[['shops_nearby_count', 'oa21pop', 'employed_total']] = df[['shops_nearby_count', 'oa21pop', 'employed_total']].astype('float64')
 
     logger.log("DataFrame before imputation:")
     logger.log(df)
@@ -49,10 +191,21 @@ def kmeans_model(stops_enriched_csv_path = helper.affix_root_path("data/stops_en
     scaler = StandardScaler()
     X_scaled = scaler.fit_transform(X)
 
-    num_clusters = 3
-    kmeans = KMeans(n_clusters=num_clusters, random_state=42, n_init=10)
+    if method == 'auto':
+        method = 'minibatch' if len(X_scaled) > MINIBATCH_THRESHOLD else 'kmeans'
+    k_values = sorted(set(k_values) | ({n_clusters} if n_clusters is not None else set()))
+    cache_path = os.path.join(model_dir, SWEEP_CACHE_FILE) if use_cache else None
+    scores, models = sweep_kmeans(X_scaled, k_values, seeds, method, n_jobs=n_jobs, cache_path=cache_path)
+    logger.log("\nK-means sweep scores (best seed per k):")
+    logger.log(scores.sort_values(['sample_inertia', 'seed']).drop_duplicates('k').sort_values('k'))
+
+    num_clusters, seed = select_model(scores, n_clusters)
+    kmeans = models[(num_clusters, seed)]
+    order = stable_label_order(kmeans.cluster_centers_, reference_centers(model_dir, scaler))
+    kmeans = relabel(kmeans, order)
+    logger.log(f"Selected {method} model with k={num_clusters}, seed={seed}; cluster order {order.tolist()}.")
 
-    df['cluster'] = kmeans.fit_predict(X_scaled)
+    df['cluster'] = kmeans.predict(X_scaled)
 
     try:
         with open(os.path.join(model_dir, "cluster_dict.json"), 'r') as f:
@@ -62,11 +215,13 @@ def kmeans_model(stops_enriched_csv_path = helper.affix_root_path("data/stops_en
     except FileNotFoundError:
         logger.log("\nError: 'cluster_mapping.json' not found. Using default mapping.")
         cluster_mapping = {0: "Cluster 0", 1: "Cluster 1", 2: "Cluster 2"}
+    if set(cluster_mapping) != set(range(num_clusters)):
+        logger.log(f"Warning: cluster_dict.json names clusters {sorted(cluster_mapping)} but the model has {num_clusters}. Unnamed clusters use 'Cluster <id>'.")
 
-    df['cluster_category'] = df['cluster'].map(cluster_mapping)
+    df['cluster_category'] = df['cluster'].map(lambda cluster: cluster_mapping.get(cluster, f"Cluster {cluster}"))
     logger.log("Added 'cluster_category' column to the DataFrame.")
 
-    df.to_csv(output_filename, index=False)
+    artifacts.write_artifact(df, output_filename, 'stops_enriched_with_clusters', export_formats)
 
     joblib.dump(kmeans, os.path.join(model_dir, "kmeans_model.joblib"))
     logger.log("K-Means model saved to 'kmeans_model.joblib'")
@@ -80,4 +235,6 @@ def kmeans_model(stops_enriched_csv_path = helper.affix_root_path("data/stops_en
 
     cluster_summary = df.groupby('cluster')[features].mean()
     logger.log("\nCluster Summary (Mean values for each feature):")
-    logger.log(cluster_summary)
\ No newline at end of file
+    logger.log(cluster_summary)
+    logger.log(f"K-means clustering took {time.time() - start_time:.1f}s.")
+    return scores
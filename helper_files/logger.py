@@ -1,6 +1,9 @@
 # logger.py
 
+import threading
+
 _log_file = None
+_log_lock = threading.Lock()
 
 def initialize_logger(filename="application.log", mode="a"):
     global _log_file
@@ -18,8 +21,9 @@ def log(message):
     global _log_file
     if _log_file:
         try:
-            _log_file.write(str(message) + '\n')
-            _log_file.flush()
+            with _log_lock:
+                _log_file.write(str(message) + '\n')
+                _log_file.flush()
         except Exception as e:
             print(f"Error writing to log file: {e} - Message: {message}")
     else:
@@ -0,0 +1,62 @@
+# model_registry.py
+
+import json
+import os
+import threading
+import joblib
+import helper_files.logger as logger
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _file_signature(path):
+    """
+    Returns the modification time and size of a file, used to detect when it has been rewritten.
+    Raises FileNotFoundError if the file does not exist.
+    """
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+def _get_or_load(path, loader):
+    """
+    Returns the cached object for a file, loading it with loader(path) on first use
+    or whenever the file has changed on disk since it was last loaded.
+    """
+    key = os.path.abspath(path)
+    signature = _file_signature(path)
+    with _registry_lock:
+        entry = _registry.get(key)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+
+        loaded = loader(path)
+        _registry[key] = (signature, loaded)
+        logger.log(f"Model registry {'reloaded' if entry else 'loaded'} '{os.path.basename(path)}'.")
+        return loaded
+
+def load_joblib(path):
+    """
+    Returns a joblib artifact, loaded once per process and reloaded only when the file changes.
+    NumPy arrays inside uncompressed artifacts are memory-mapped read-only rather than copied.
+    """
+    return _get_or_load(path, lambda p: joblib.load(p, mmap_mode='r'))
+
+def load_json(path):
+    """
+    Returns a parsed JSON file, loaded once per process and reloaded only when the file changes.
+    The returned object is shared, so callers must not modify it.
+    """
+    def read_json(p):
+        with open(p, 'r') as f:
+            return json.load(f)
+    return _get_or_load(path, read_json)
+
+def cached_paths():
+    """Returns the paths of all artifacts currently held in the registry."""
+    with _registry_lock:
+        return list(_registry.keys())
+
+def clear_registry():
+    """Drops every cached artifact, forcing the next request for each to reload from disk."""
+    with _registry_lock:
+        _registry.clear()
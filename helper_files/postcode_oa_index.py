@@ -0,0 +1,206 @@
+# postcode_oa_index.py
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+
+DEFAULT_INDEX_DIR = helper.affix_root_path("data/postcode_oa_index")
+MANIFEST_FILE = "manifest.json"
+FETCH_BATCH_SIZE = 50000
+
+_loaded_index = None
+_loaded_index_key = None
+# Index dirs whose on-demand build has failed in this process; get_* does not retry them.
+_failed_builds = set()
+
+def normalize_postcode(postcode):
+    """
+    Normalises a postcode to the index key format: upper case with all spaces removed.
+    """
+    if not isinstance(postcode, str):
+        return ""
+    return str(postcode).replace(' ', '').upper()
+
+def _encode(values):
+    """
+    Encodes a list of strings to a fixed-width UTF-8 bytes array, which NumPy can memory-map.
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    width = max((len(value) for value in encoded), default=1) or 1
+    return np.array(encoded, dtype=f"S{width}")
+
+def build_postcode_oa_index(config=helper.affix_root_path("config.json"),
+                            index_dir=DEFAULT_INDEX_DIR,
+                            OA_LOOKUP="oa_lookup"):
+    """
+    Reads the oa_lookup table once and writes a compact index of normalised postcodes to disk.
+    Postcodes are stored as a sorted fixed-width array (for binary search) with integer codes
+    into small tables of distinct OA and LSOA values. Returns True on success.
+    """
+    logger.log(f"Building postcode to OA index from '{OA_LOOKUP}'...")
+    start_time = time.time()
+
+    try:
+        with open(config) as json_file:
+            db_config = json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config}' not found for postcode index build.")
+        return False
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config}' for postcode index build.")
+        return False
+
+    conn, dict_cursor = dp.connect_to_mysql(db_config)
+    if not conn:
+        return False
+    dict_cursor.close()
+
+    postcodes = []
+    oa_codes = []
+    lsoa_codes = []
+    lsoa_names = {}
+    cursor = None
+
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT pcds, oa21cd, lsoa21cd, lsoa21nm FROM {OA_LOOKUP}")
+        while True:
+            rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            for pcds, oa21cd, lsoa21cd, lsoa21nm in rows:
+                if not pcds:
+                    continue
+                postcodes.append(normalize_postcode(pcds))
+                oa_codes.append(oa21cd or "")
+                lsoa_codes.append(lsoa21cd or "")
+                lsoa_names.setdefault(lsoa21cd or "", lsoa21nm or "")
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during postcode index build: {err}")
+        return False
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    if not postcodes:
+        logger.log(f"No postcodes found in '{OA_LOOKUP}'. Postcode index not built.")
+        return False
+
+    postcode_array = _encode(postcodes)
+    oa_table, oa_idx = np.unique(np.array(oa_codes), return_inverse=True)
+    lsoa_table, lsoa_idx = np.unique(np.array(lsoa_codes), return_inverse=True)
+
+    # A stable sort keeps the last row for a duplicated postcode, matching the old dict build.
+    order = np.argsort(postcode_array, kind='stable')
+    postcode_array = postcode_array[order]
+    keep = np.ones(len(postcode_array), dtype=bool)
+    keep[:-1] = postcode_array[1:] != postcode_array[:-1]
+
+    arrays = {
+        'postcodes': postcode_array[keep],
+        'oa_idx': oa_idx[order][keep].astype(np.int32),
+        'lsoa_idx': lsoa_idx[order][keep].astype(np.int32),
+        'oa_codes': _encode(oa_table.tolist()),
+        'lsoa_codes': _encode(lsoa_table.tolist()),
+        'lsoa_names': _encode([lsoa_names.get(code, "") for code in lsoa_table.tolist()]),
+    }
+
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, f"{name}.npy"), array)
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'source_table': OA_LOOKUP, 'postcodes': int(keep.sum()), 'built_at': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+    logger.log(f"Postcode index with {int(keep.sum())} postcodes written to '{index_dir}' in {time.time() - start_time:.1f}s.")
+    return True
+
+def load_postcode_oa_index(index_dir=DEFAULT_INDEX_DIR):
+    """
+    Memory-maps the postcode index from disk, reusing the already loaded index unless it
+    has been rebuilt since. Returns None if no index has been built.
+    """
+    global _loaded_index, _loaded_index_key
+
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    index_key = (os.path.abspath(index_dir), os.path.getmtime(manifest_path))
+    if _loaded_index is not None and _loaded_index_key == index_key:
+        return _loaded_index
+
+    index = {}
+    for name in ['postcodes', 'oa_idx', 'lsoa_idx']:
+        index[name] = np.load(os.path.join(index_dir, f"{name}.npy"), mmap_mode='r')
+    for name in ['oa_codes', 'lsoa_codes', 'lsoa_names']:
+        index[name] = np.load(os.path.join(index_dir, f"{name}.npy"))
+
+    _loaded_index = index
+    _loaded_index_key = index_key
+    logger.log(f"Loaded postcode index with {len(index['postcodes'])} postcodes from '{index_dir}'.")
+    return index
+
+def get_postcode_oa_index(config=helper.affix_root_path("config.json"), index_dir=DEFAULT_INDEX_DIR, OA_LOOKUP="oa_lookup"):
+    """
+    Returns the postcode index, building it from the database first if it does not exist yet.
+    A failed build is not retried in this process, so callers go straight to their fallback;
+    call build_postcode_oa_index directly to try again.
+    """
+    index = load_postcode_oa_index(index_dir)
+    build_key = os.path.abspath(index_dir)
+    if index is None and build_key not in _failed_builds:
+        logger.log(f"No postcode index found at '{index_dir}'. Building it now...")
+        if build_postcode_oa_index(config=config, index_dir=index_dir, OA_LOOKUP=OA_LOOKUP):
+            index = load_postcode_oa_index(index_dir)
+        else:
+            _failed_builds.add(build_key)
+            logger.log("Could not build the postcode index. Not retrying in this process.")
+    return index
+
+def lookup_postcodes(index, postcodes):
+    """
+    Looks up many postcodes at once with a binary search over the sorted index.
+    Returns a list of (oa21cd, lsoa21cd, lsoa21nm) tuples aligned to the input,
+    with (None, None, None) for postcodes that are missing or not found.
+    """
+    keys = [normalize_postcode(postcode).encode('utf-8') for postcode in postcodes]
+    if not keys:
+        return []
+
+    sorted_postcodes = index['postcodes']
+    query = np.array(keys, dtype=sorted_postcodes.dtype)
+    positions = np.searchsorted(sorted_postcodes, query)
+    in_range = positions < len(sorted_postcodes)
+    found = np.zeros(len(keys), dtype=bool)
+    found[in_range] = sorted_postcodes[positions[in_range]] == query[in_range]
+    # Keys wider than the index cannot match, but would be truncated by the dtype cast above.
+    found &= np.array([0 < len(key) <= sorted_postcodes.dtype.itemsize for key in keys])
+
+    oa_codes = index['oa_codes']
+    lsoa_codes = index['lsoa_codes']
+    lsoa_names = index['lsoa_names']
+
+    results = []
+    for position, is_found in zip(positions.tolist(), found.tolist()):
+        if not is_found:
+            results.append((None, None, None))
+            continue
+        oa = oa_codes[index['oa_idx'][position]].decode('utf-8') or None
+        lsoa_position = index['lsoa_idx'][position]
+        lsoa = lsoa_codes[lsoa_position].decode('utf-8') or None
+        lsoa_name = lsoa_names[lsoa_position].decode('utf-8') or None
+        results.append((oa, lsoa, lsoa_name))
+    return results
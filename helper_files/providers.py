@@ -0,0 +1,119 @@
+# providers.py
+
+import threading
+import numpy as np
+import helper_files.raster_sampler as raster_sampler
+import helper_files.stops_enrichment_postcode as SEP
+import helper_files.stops_enrichment_shops as SES
+
+PROVIDER_KINDS = ('geocoding', 'shops', 'raster')
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+class PostcodesIoProvider:
+    """
+    Geocoding provider backed by the Postcodes.io API (or anything serving the same endpoints,
+    such as a local stand-in). url None uses stops_enrichment_postcode.DEFAULT_POSTCODES_API_URL.
+    """
+    name = 'postcodes'
+
+    def __init__(self, url=None, radius=2000, batch_size=100, max_retries=3, initial_delay=1):
+        self.url = url
+        self.radius = radius
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+
+    def postcode(self, lat, lon):
+        """Returns the nearest postcode to one coordinate, or None."""
+        return SEP.reverse_geocode_postcode(lat, lon, POSTCODES_API_URL=self.url, radius=self.radius,
+                                            max_retries=self.max_retries, initial_delay=self.initial_delay)
+
+    def postcodes(self, coordinates, max_workers=1):
+        """Returns the nearest postcode to each (latitude, longitude) pair, with None where none was found."""
+        return SEP.reverse_geocode_postcodes_bulk(coordinates, POSTCODES_API_URL=self.url, radius=self.radius,
+                                                  batch_size=self.batch_size, max_retries=self.max_retries,
+                                                  initial_delay=self.initial_delay, max_workers=max_workers)
+
+class OverpassProvider:
+    """
+    Shops provider backed by the Overpass API (or a local stand-in).
+    url None uses stops_enrichment_shops.DEFAULT_OVERPASS_API_URL.
+    """
+    name = 'overpass'
+
+    def __init__(self, url=None, radius=500, batch_size=25, max_retries=3, initial_delay=1):
+        self.url = url
+        self.radius = radius
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.initial_delay = initial_delay
+
+    def shop_count(self, lat, lon):
+        """Returns the number of shops within radius of one coordinate."""
+        return SES.get_shop_count(lat, lon, radius=self.radius, max_retries=self.max_retries,
+                                  initial_delay=self.initial_delay, overpass_url=self.url)
+
+    def shop_counts(self, coordinates, max_workers=1, progress=None):
+        """
+        Returns the number of shops within radius of each (latitude, longitude) pair.
+        progress, if given, is called with the number of coordinates in each batch as it completes.
+        """
+        return SES.get_shop_counts(coordinates, radius=self.radius, batch_size=self.batch_size,
+                                   max_retries=self.max_retries, initial_delay=self.initial_delay,
+                                   overpass_url=self.url, max_workers=max_workers, progress=progress)
+
+class DensityRasterProvider:
+    """Raster provider sampling the population density GeoTIFF through the shared raster_sampler."""
+    name = 'raster'
+
+    def __init__(self, tif_path=raster_sampler.DEFAULT_DENSITY_TIF_PATH):
+        self.tif_path = tif_path
+
+    def sample_point(self, lon, lat):
+        """Returns the raster value at one WGS84 coordinate, or 0.0 outside the raster."""
+        return raster_sampler.get_sampler(self.tif_path).sample_point(lon, lat)
+
+    def sample(self, lons, lats):
+        """Returns an array of raster values for many WGS84 coordinates, with 0.0 outside the raster."""
+        values, _, _ = raster_sampler.get_sampler(self.tif_path).sample(np.asarray(lons, dtype=float), np.asarray(lats, dtype=float))
+        return values
+
+DEFAULT_PROVIDERS = {
+    'geocoding': PostcodesIoProvider,
+    'shops': OverpassProvider,
+    'raster': DensityRasterProvider,
+}
+
+def get_provider(kind):
+    """
+    Returns the process-wide provider for 'geocoding', 'shops' or 'raster', creating the
+    default one on first use.
+    """
+    if kind not in PROVIDER_KINDS:
+        raise ValueError(f"Unknown provider kind '{kind}'. Use one of {list(PROVIDER_KINDS)}.")
+    with _providers_lock:
+        provider = _providers.get(kind)
+        if provider is None:
+            provider = DEFAULT_PROVIDERS[kind]()
+            _providers[kind] = provider
+        return provider
+
+def set_provider(kind, provider):
+    """
+    Replaces the provider used for one kind of enrichment data, e.g. with one pointed at a
+    local stand-in. A provider needs the same methods as the default for its kind.
+    Returns the provider it replaced, or None.
+    """
+    if kind not in PROVIDER_KINDS:
+        raise ValueError(f"Unknown provider kind '{kind}'. Use one of {list(PROVIDER_KINDS)}.")
+    with _providers_lock:
+        previous = _providers.get(kind)
+        _providers[kind] = provider
+        return previous
+
+def reset_providers():
+    """Goes back to the default providers."""
+    with _providers_lock:
+        _providers.clear()
@@ -0,0 +1,156 @@
+# raster_sampler.py
+
+import math
+import os
+import threading
+from collections import OrderedDict
+import rasterio
+from rasterio.windows import Window
+import pyproj
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.stops_enrichment_population_density as sepd
+
+DEFAULT_DENSITY_TIF_PATH = helper.affix_root_path('data/population_density.tif')
+DEFAULT_MAX_CACHE_BYTES = 64 * 1024 * 1024
+
+_samplers = {}
+_samplers_lock = threading.Lock()
+
+class RasterSampler:
+    """
+    Keeps a raster open along with its coordinate transformer and an LRU cache of decoded
+    blocks, so repeated lookups neither reopen the file nor re-read blocks from disk.
+    The cache is bounded to max_cache_bytes of decoded block data.
+    """
+    def __init__(self, tif_path=DEFAULT_DENSITY_TIF_PATH, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+        if not os.path.exists(tif_path):
+            raise FileNotFoundError(f"Error: Density TIF file not found at '{tif_path}'")
+
+        self.tif_path = tif_path
+        self.mtime = os.path.getmtime(tif_path)
+        self.max_cache_bytes = max_cache_bytes
+        self.src = rasterio.open(tif_path)
+        self.transformer = pyproj.Transformer.from_crs("EPSG:4326", self.src.crs, always_xy=True)
+        self._inverse_transform = ~self.src.transform
+        self._block_height, self._block_width = self.src.block_shapes[0]
+
+        self._blocks = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        logger.log(f"Raster sampler opened '{os.path.basename(tif_path)}' (CRS {self.src.crs}, cache budget {max_cache_bytes} bytes).")
+
+    def _read_block(self, window):
+        """
+        Returns the decoded block for a window, reading it from disk only on a cache miss.
+        Least recently used blocks are evicted once the cache exceeds its memory budget.
+        """
+        key = (window.row_off, window.col_off)
+        block = self._blocks.get(key)
+        if block is not None:
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+        self.misses += 1
+        block = self.src.read(1, window=window)
+        block.setflags(write=False)
+        if block.nbytes > self.max_cache_bytes:
+            return block
+
+        self._blocks[key] = block
+        self._cache_bytes += block.nbytes
+        while self._cache_bytes > self.max_cache_bytes:
+            _, evicted = self._blocks.popitem(last=False)
+            self._cache_bytes -= evicted.nbytes
+            self.evictions += 1
+        return block
+
+    def sample(self, lons, lats):
+        """
+        Samples many WGS84 coordinates. Returns (values, in_bounds, valid) as for sepd.sample_raster.
+        """
+        with self._lock:
+            return sepd.sample_raster(self.src, self.transformer, lons, lats, read_block=self._read_block)
+
+    def sample_point(self, lon, lat):
+        """
+        Samples a single WGS84 coordinate, returning 0.0 if it is out of bounds or NoData.
+        """
+        if lon is None or lat is None:
+            return 0.0
+        easting, northing = self.transformer.transform(lon, lat)
+        inverse = self._inverse_transform
+        col = math.floor(inverse.a * easting + inverse.b * northing + inverse.c) if math.isfinite(easting) else -1
+        row = math.floor(inverse.d * easting + inverse.e * northing + inverse.f) if math.isfinite(northing) else -1
+        if not (0 <= row < self.src.height and 0 <= col < self.src.width):
+            return 0.0
+
+        row_off = (row // self._block_height) * self._block_height
+        col_off = (col // self._block_width) * self._block_width
+        window = Window(col_off, row_off,
+                        min(self._block_width, self.src.width - col_off),
+                        min(self._block_height, self.src.height - row_off))
+        with self._lock:
+            value = float(self._read_block(window)[row - row_off, col - col_off])
+
+        if math.isnan(value) or (self.src.nodata is not None and value == self.src.nodata):
+            return 0.0
+        return value
+
+    def cache_stats(self):
+        """
+        Returns hit/miss/eviction counts and the current size of the block cache.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'cached_blocks': len(self._blocks),
+                'cached_bytes': self._cache_bytes,
+                'max_cache_bytes': self.max_cache_bytes,
+            }
+
+    def clear_cache(self):
+        """Drops all cached blocks and resets the statistics."""
+        with self._lock:
+            self._blocks.clear()
+            self._cache_bytes = 0
+            self.hits = self.misses = self.evictions = 0
+
+    def close(self):
+        """Closes the underlying dataset and drops the cache."""
+        with self._lock:
+            self._blocks.clear()
+            self._cache_bytes = 0
+            self.src.close()
+
+def get_sampler(tif_path=DEFAULT_DENSITY_TIF_PATH, max_cache_bytes=DEFAULT_MAX_CACHE_BYTES):
+    """
+    Returns the process-wide sampler for a raster, opening it on first use and
+    reopening it if the file has changed on disk since.
+    """
+    key = os.path.abspath(tif_path)
+    with _samplers_lock:
+        sampler = _samplers.get(key)
+        if sampler is not None and os.path.exists(tif_path) and os.path.getmtime(tif_path) == sampler.mtime:
+            return sampler
+        if sampler is not None:
+            sampler.close()
+        sampler = RasterSampler(tif_path, max_cache_bytes)
+        _samplers[key] = sampler
+        return sampler
+
+def close_samplers():
+    """Closes every open sampler."""
+    with _samplers_lock:
+        for sampler in _samplers.values():
+            sampler.close()
+        _samplers.clear()
@@ -0,0 +1,104 @@
+# rate_limit.py
+
+import contextlib
+import threading
+import time
+
+# Requests per second and burst size for each external API, shared by every thread in the process.
+# These match the pacing of the serial enrichment loops (0.1s between Postcodes.io calls,
+# 0.3s between Overpass calls). A token bucket only limits how often requests start.
+DEFAULT_RATES = {
+    'postcodes': (10.0, 10),
+    'overpass': (3.0, 2),
+}
+
+# Requests that may be in flight at once for each API, whatever the number of worker threads.
+# Overpass gives each client two concurrent slots and answers 429 beyond them.
+DEFAULT_CONCURRENCY = {
+    'overpass': 2,
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_slots = {}
+_slots_lock = threading.Lock()
+
+class RateLimiter:
+    """
+    A thread-safe token bucket. Tokens refill at rate per second up to burst, and each
+    acquire() takes one token, sleeping until one is available.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.waited_seconds = 0.0
+
+    def acquire(self):
+        """Blocks until a request may be sent and returns the time spent waiting, in seconds."""
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+                self._last_refill = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    self.calls += 1
+                    self.waited_seconds += waited
+                    return waited
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def stats(self):
+        """Returns the number of acquired tokens and the total time callers spent waiting."""
+        with self._lock:
+            return {'rate': self.rate, 'burst': self.burst, 'calls': self.calls, 'waited_seconds': round(self.waited_seconds, 3)}
+
+def get_limiter(name):
+    """
+    Returns the process-wide limiter for an API, creating it from DEFAULT_RATES on first use.
+    """
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            rate, burst = DEFAULT_RATES.get(name, (1.0, 1))
+            limiter = RateLimiter(rate, burst)
+            _limiters[name] = limiter
+        return limiter
+
+def set_rate(name, rate, burst=1):
+    """Replaces the limiter for an API, e.g. to lift the limit when testing against a local stand-in."""
+    with _limiters_lock:
+        _limiters[name] = RateLimiter(rate, burst)
+
+def acquire(name):
+    """Waits for the named API's limiter. Returns the time spent waiting, in seconds."""
+    return get_limiter(name).acquire()
+
+def slot(name):
+    """
+    Returns a context manager that holds one of the named API's concurrent request slots
+    (a process-wide BoundedSemaphore from DEFAULT_CONCURRENCY), or does nothing if the API has no cap.
+    """
+    with _slots_lock:
+        if name not in _slots:
+            limit = DEFAULT_CONCURRENCY.get(name)
+            _slots[name] = threading.BoundedSemaphore(limit) if limit else None
+        semaphore = _slots[name]
+    return semaphore if semaphore is not None else contextlib.nullcontext()
+
+def set_concurrency(name, limit):
+    """Replaces the concurrent request cap for an API; None removes it (e.g. for a local stand-in)."""
+    with _slots_lock:
+        _slots[name] = threading.BoundedSemaphore(limit) if limit else None
+
+def all_stats():
+    """Returns stats for every limiter created so far."""
+    with _limiters_lock:
+        limiters = dict(_limiters)
+    return {name: limiter.stats() for name, limiter in limiters.items()}
@@ -0,0 +1,142 @@
+# shape_cache.py
+
+import hashlib
+import os
+import threading
+import numpy as np
+import pandas as pd
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.artifacts as artifacts
+import helper_files.shape_distance as shape_distance
+
+DEFAULT_CACHE_PATH = helper.affix_root_path("data/shape_distance_cache.parquet")
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def points_hash(lats, lons):
+    """blake2b digest of a shape's ordered coordinates, so any moved, added or reordered point changes it."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(np.ascontiguousarray(lats, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(lons, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+class ShapeDistanceCache:
+    """
+    Persistent per-shape distances keyed by shape_id and a hash of the shape's point sequence.
+    Each entry holds the total length and the cumulative distance to every point. An entry is
+    recomputed when its shape's points change or a different distance method is asked for.
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, method=shape_distance.DEFAULT_METHOD):
+        self.path = path
+        self.method = method
+        self.entries = {}
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+        self._lock = threading.Lock()
+        self.load()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def load(self):
+        """Reads the cache file, keeping only entries computed with this cache's method."""
+        if not os.path.exists(self.path):
+            return
+        try:
+            df = artifacts.read_artifact(self.path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.log(f"Warning: Could not read shape distance cache '{self.path}': {e}. Starting empty.")
+            return
+        df = df[df['method'] == self.method]
+        self.entries = {
+            shape_id: (points_key, float(total), np.asarray(cumulative, dtype=float))
+            for shape_id, points_key, total, cumulative in zip(df['shape_id'], df['points_hash'], df['total_distance_km'], df['cumulative_distance_km'])
+        }
+        logger.log(f"Loaded {len(self.entries)} cached shape distances from '{self.path}'.")
+
+    def save(self):
+        """Writes the cache file if anything has changed since it was loaded or last saved."""
+        with self._lock:
+            if not self.dirty:
+                return False
+            df = pd.DataFrame({
+                'shape_id': list(self.entries),
+                'points_hash': [entry[0] for entry in self.entries.values()],
+                'method': self.method,
+                'total_distance_km': [entry[1] for entry in self.entries.values()],
+                'cumulative_distance_km': [entry[2] for entry in self.entries.values()],
+            })
+            artifacts.write_artifact(df, self.path)
+            self.dirty = False
+        logger.log(f"Saved {len(df)} shape distances to '{self.path}'.")
+        return True
+
+    def distances(self, shapes_df):
+        """
+        Returns a DataFrame with shape_id and total_distance_km for every shape in a GTFS shapes
+        DataFrame (sorted by shape_id, like shape_distance.shape_distances_km), measuring only
+        shapes that are new or whose points have changed.
+        """
+        if shapes_df.empty:
+            return shape_distance.shape_distances_km(shapes_df)
+
+        shape_ids, offsets, lats, lons = shape_distance.ordered_shape_points(shapes_df)
+        hashes = [points_hash(lats[start:end], lons[start:end]) for start, end in zip(offsets[:-1], offsets[1:])]
+        totals = np.zeros(len(shape_ids))
+
+        with self._lock:
+            missing = []
+            for position, (shape_id, points_key) in enumerate(zip(shape_ids, hashes)):
+                entry = self.entries.get(shape_id)
+                if entry is not None and entry[0] == points_key:
+                    totals[position] = entry[1]
+                    self.hits += 1
+                else:
+                    if entry is not None:
+                        self.invalidated += 1
+                    missing.append(position)
+            self.misses += len(missing)
+
+        if missing:
+            missing = np.asarray(missing)
+            point_mask = np.repeat(np.isin(np.arange(len(shape_ids)), missing), np.diff(offsets))
+            missing_offsets = np.concatenate([[0], np.cumsum(np.diff(offsets)[missing])])
+            cumulative = shape_distance.cumulative_distances_km(missing_offsets, lats[point_mask], lons[point_mask], self.method)
+            with self._lock:
+                for position, start, end in zip(missing, missing_offsets[:-1], missing_offsets[1:]):
+                    totals[position] = cumulative[end - 1] if end > start else 0.0
+                    self.entries[shape_ids[position]] = (hashes[position], float(totals[position]), cumulative[start:end].copy())
+                self.dirty = True
+
+        return pd.DataFrame({'shape_id': shape_ids, 'total_distance_km': totals})
+
+    def cumulative_km(self, shape_id):
+        """Cumulative distance in km to each point of a cached shape, in sequence order, or None."""
+        entry = self.entries.get(shape_id)
+        return None if entry is None else entry[2]
+
+    def stats(self):
+        return {'shapes': len(self.entries), 'hits': self.hits, 'misses': self.misses, 'invalidated': self.invalidated}
+
+def get_cache(path=DEFAULT_CACHE_PATH, method=shape_distance.DEFAULT_METHOD):
+    """Returns the shared cache for a file and method, loading it on first use."""
+    key = (os.path.abspath(path), method)
+    with _caches_lock:
+        if key not in _caches:
+            _caches[key] = ShapeDistanceCache(path, method)
+        return _caches[key]
+
+def cached_shape_distances_km(shapes_df, path=DEFAULT_CACHE_PATH, method=shape_distance.DEFAULT_METHOD, save=True):
+    """
+    Drop-in for shape_distance.shape_distances_km that reuses the persistent cache at path.
+    With save=False the caller saves it (get_cache(path).save()) once a batch of calls is done.
+    """
+    cache = get_cache(path, method)
+    distances = cache.distances(shapes_df)
+    if save:
+        cache.save()
+    return distances
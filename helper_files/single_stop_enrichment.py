@@ -4,19 +4,39 @@ import helper_files.data_pipeline as dp
 import mysql.connector
 from mysql.connector import Error
 import json
-import joblib
+import helper_files.model_registry as model_registry
 import helper_files.logger as logger
-import helper_files.stops_enrichment_postcode as SEP
 import helper_files.stops_enrichment_oas as SEO
-import helper_files.stops_enrichment_shops as SES
-import helper_files.stops_enrichment_population_density as sepd
+import helper_files.providers as providers
+import helper_files.census_features as census_features
+import helper_files.stop_index as stop_index
 import pandas as pd
 import numpy as np
 import helper_files.helper as helper
 import os
 import math
+from concurrent.futures import ThreadPoolExecutor
 import helper_files.avg_weekly_frequency_per_hour_prediction as awfphp
 
+ORDERED_KEYS = [
+    'stop_lat', 'stop_lon', 'postcode', 'oa21cd', 'lsoa21cd', 'lsoa21nm',
+    'shops_nearby_count', 'population_density', 'oa21pop', 'employed_total',
+    'bus_commute_total', 'predicted_avg_weekly_frequency_per_hour',
+    'customer_convenience_score', 'commute_opportunity_score',
+    'cluster', 'cluster_category',
+    'nearest_stop_id', 'nearest_stop_name', 'nearest_stop_distance_m', 'nearby_stops_count'
+]
+
+NEAREST_STOP_KEYS = ['nearest_stop_id', 'nearest_stop_name', 'nearest_stop_distance_m', 'nearby_stops_count']
+
+KMEANS_FEATURES = ['oa21pop', 'shops_nearby_count', 'employed_total']
+
+X_FEATURES = ['shops_nearby_count', 'population_density', 'oa21pop', 'employed_total', 'bus_commute_total', 'customer_convenience_score', 'commute_opportunity_score']
+
+CONVENIENCE_FEATURES = ['shops_nearby_count', 'employed_total', 'bus_commute_total', 'avg_weekly_frequency_per_hour', 'population_density']
+
+COMMUTE_FEATURES = ['employed_total', 'bus_commute_total']
+
 def calculate_scores(enriched_record, min_max_values):
     """
     Calculates the customer_convenience_score and commute_opportunity_score
@@ -71,41 +91,39 @@ def enriched_record_from_lat_lon(stop_lat, stop_lon, model_dir=helper.affix_root
     stop_enriched["stop_lat"] = stop_lat
     stop_enriched["stop_lon"] = stop_lon
 
-    stop_enriched["postcode"] = SEP.reverse_geocode_postcode(stop_lat, stop_lon)
+    stop_enriched["postcode"] = providers.get_provider('geocoding').postcode(stop_lat, stop_lon)
 
     oa21cd, lsoa21cd, lsoa21nm = SEO.get_oa_lsoa_details(stop_enriched["postcode"])
     stop_enriched["oa21cd"] = oa21cd
     stop_enriched["lsoa21cd"] = lsoa21cd
     stop_enriched["lsoa21nm"] = lsoa21nm
-    stop_enriched["shops_nearby_count"] = SES.get_shop_count(stop_lat, stop_lon)
+    stop_enriched["shops_nearby_count"] = providers.get_provider('shops').shop_count(stop_lat, stop_lon)
 
     census = census_return(oa21cd)
     stop_enriched["oa21pop"] = census["oa21pop"]
     stop_enriched["employed_total"] = census["employed_total"]
     stop_enriched["bus_commute_total"] = census["bus_commute_total"]
     
-    stop_df = pd.DataFrame([stop_enriched])
-    stop_df = sepd.process_stops_data(stop_df)
-    stop_enriched["population_density"] = stop_df.iloc[0]['population_density']
+    stop_enriched["population_density"] = providers.get_provider('raster').sample_point(stop_lon, stop_lat)
+
+    stop_enriched.update(nearest_existing_stops([stop_lat], [stop_lon])[0])
 
     if oa21cd is None:
         stop_enriched["cluster"] = None
         stop_enriched["cluster_category"] = None
     else:
-        loaded_kmeans = joblib.load(os.path.join(model_dir, 'kmeans_model.joblib'))
-        loaded_scaler = joblib.load(os.path.join(model_dir, 'kmeans_scaler.joblib'))
+        loaded_kmeans = model_registry.load_joblib(os.path.join(model_dir, 'kmeans_model.joblib'))
+        loaded_scaler = model_registry.load_joblib(os.path.join(model_dir, 'kmeans_scaler.joblib'))
 
         df = pd.DataFrame([stop_enriched])
-        features = ['oa21pop', 'shops_nearby_count', 'employed_total']
-        df_features = df[features]
+        df_features = df[KMEANS_FEATURES]
         df_features['shops_nearby_count'] = df['shops_nearby_count'].replace(-1, 0)
         df_scaled = loaded_scaler.transform(df_features)
         predicted_cluster = loaded_kmeans.predict(df_scaled)
         stop_enriched["cluster"] = predicted_cluster[0]
 
         try:
-            with open(os.path.join(model_dir, "cluster_dict.json"), 'r') as f:
-                cluster_mapping = json.load(f)
+            cluster_mapping = model_registry.load_json(os.path.join(model_dir, "cluster_dict.json"))
             cluster_mapping = {int(k): v for k, v in cluster_mapping.items()}
             logger.log("\nLoaded cluster mapping from JSON.")
         except FileNotFoundError:
@@ -115,8 +133,7 @@ def enriched_record_from_lat_lon(stop_lat, stop_lon, model_dir=helper.affix_root
         stop_enriched["cluster_category"] = cluster_mapping.get(predicted_cluster[0])
 
     try:
-        with open(os.path.join(model_dir, "min_max_values.json"), 'r') as f:
-            min_max_values = json.load(f)
+        min_max_values = model_registry.load_json(os.path.join(model_dir, "min_max_values.json"))
         stop_enriched = calculate_scores(stop_enriched, min_max_values)
         logger.log("Calculated convenience and commute scores.")
     except FileNotFoundError:
@@ -125,34 +142,158 @@ def enriched_record_from_lat_lon(stop_lat, stop_lon, model_dir=helper.affix_root
         stop_enriched['commute_opportunity_score'] = 0.0
         
     prediction_df = pd.DataFrame([stop_enriched])
-    
-    X_features = ['shops_nearby_count', 'population_density', 'oa21pop', 'employed_total', 'bus_commute_total', 'customer_convenience_score', 'commute_opportunity_score']
-    prediction_df = prediction_df[X_features]
+    prediction_df = prediction_df[X_FEATURES]
 
     predicted_frequency = awfphp.predict_on_new_data(prediction_df)
     stop_enriched["predicted_avg_weekly_frequency_per_hour"] = predicted_frequency
 
-    ordered_keys = [
-        'stop_lat', 'stop_lon', 'postcode', 'oa21cd', 'lsoa21cd', 'lsoa21nm',
-        'shops_nearby_count', 'population_density', 'oa21pop', 'employed_total',
-        'bus_commute_total', 'predicted_avg_weekly_frequency_per_hour',
-        'customer_convenience_score', 'commute_opportunity_score',
-        'cluster', 'cluster_category'
-    ]
-
-    ordered_stop_enriched = {key: stop_enriched.get(key) for key in ordered_keys}
+    ordered_stop_enriched = {key: stop_enriched.get(key) for key in ORDERED_KEYS}
     
     return ordered_stop_enriched
 
 
+def nearest_existing_stops(lats, lons):
+    """
+    Returns the nearest existing stop (id, name and distance in metres) and the number of
+    existing stops within stop_index.DEFAULT_RADIUS_M for each coordinate, as a list of dicts.
+    Fields are None if the stop index is not available.
+    """
+    index = stop_index.get_stop_index()
+    if index is None:
+        logger.log("Warning: No stop index available. Nearest stop fields will be empty.")
+        return [dict.fromkeys(NEAREST_STOP_KEYS) for _ in range(len(lats))]
+    return stop_index.nearest_stop_features(index, lats, lons)
+
+
+def calculate_scores_batch(enriched_df, min_max_values):
+    """
+    Vectorised calculate_scores: adds customer_convenience_score and commute_opportunity_score
+    columns to a DataFrame of enriched records. Missing values (and the -1 failed shop lookup
+    marker) count as 0 after the log transform, as None does for a single record.
+    """
+    def normalised_mean(features):
+        total = pd.Series(0.0, index=enriched_df.index)
+        count = 0
+        for f in features:
+            min_val = min_max_values[f]['min']
+            max_val = min_max_values[f]['max']
+            if (max_val - min_val) > 0:
+                if f in enriched_df:
+                    values = pd.to_numeric(enriched_df[f], errors='coerce').astype(float)
+                    log_values = np.log1p(values.where(values >= 0)).fillna(0)
+                else:
+                    log_values = 0.0
+                total += (log_values - min_val) / (max_val - min_val)
+                count += 1
+        return total / count if count > 0 else total * 0
+
+    enriched_df['customer_convenience_score'] = normalised_mean(CONVENIENCE_FEATURES)
+    enriched_df['commute_opportunity_score'] = normalised_mean(COMMUTE_FEATURES)
+    return enriched_df
+
+
+def enriched_records_from_lat_lons(coords, model_dir=helper.affix_root_path("models"), max_workers=1, progress=None):
+    """
+    Batch version of enriched_record_from_lat_lon for many (latitude, longitude) pairs.
+    Every stage runs once over the whole batch: bulk reverse geocoding, one OA and one census
+    lookup, batched shop counts, vectorised raster sampling, and a single k-means and
+    gradient boosting predict. Returns a DataFrame with one row per coordinate in ORDERED_KEYS order.
+    With max_workers > 1 the shop counts are fetched alongside the postcode, OA and census lookups,
+    and each API sends up to max_workers batches at once; the result is the same as a serial run.
+    progress, if given, is called with a number of coordinates each time a batch of shop counts
+    (the slowest, most rate-limited stage) completes.
+    """
+    coords = [(float(lat), float(lon)) for lat, lon in coords]
+    if not coords:
+        return pd.DataFrame(columns=ORDERED_KEYS)
+
+    df = pd.DataFrame(coords, columns=['stop_lat', 'stop_lon'])
+    logger.log(f"Batch enriching {len(df)} coordinates...")
+
+    shops_provider = providers.get_provider('shops')
+    with ThreadPoolExecutor(max_workers=1) as shops_executor:
+        shop_counts_future = shops_executor.submit(shops_provider.shop_counts, coords, max_workers=max_workers, progress=progress) if max_workers > 1 else None
+
+        df['postcode'] = pd.Series(providers.get_provider('geocoding').postcodes(coords, max_workers=max_workers), dtype=object)
+
+        oa_df = SEO.get_oa_lsoa_details_batch(df['postcode'].tolist())
+        for column in ['oa21cd', 'lsoa21cd', 'lsoa21nm']:
+            df[column] = pd.Series([value if isinstance(value, str) else None for value in oa_df[column]], dtype=object)
+
+        census_df = census_return_batch(df['oa21cd'].tolist())
+
+        df['shops_nearby_count'] = shop_counts_future.result() if shop_counts_future else shops_provider.shop_counts(coords, progress=progress)
+
+    for column in ['oa21pop', 'employed_total', 'bus_commute_total']:
+        df[column] = pd.to_numeric(census_df[column], errors='coerce').to_numpy(dtype=float)
+
+    df['population_density'] = providers.get_provider('raster').sample(df['stop_lon'].to_numpy(), df['stop_lat'].to_numpy())
+
+    nearest_df = pd.DataFrame(nearest_existing_stops(df['stop_lat'].to_numpy(), df['stop_lon'].to_numpy()), columns=NEAREST_STOP_KEYS)
+    for column in ['nearest_stop_id', 'nearest_stop_name']:
+        df[column] = pd.Series(nearest_df[column].to_numpy(dtype=object), dtype=object)
+    df['nearest_stop_distance_m'] = pd.to_numeric(nearest_df['nearest_stop_distance_m'], errors='coerce').to_numpy(dtype=float)
+    df['nearby_stops_count'] = pd.array(nearest_df['nearby_stops_count'].tolist(), dtype='Int64')
+
+    df['cluster'] = pd.Series(pd.NA, index=df.index, dtype='Int64')
+    df['cluster_category'] = pd.Series(None, index=df.index, dtype=object)
+    df_features = df[KMEANS_FEATURES].copy()
+    df_features['shops_nearby_count'] = df_features['shops_nearby_count'].replace(-1, 0)
+    can_cluster = df['oa21cd'].notna() & df_features.notna().all(axis=1)
+    if can_cluster.any():
+        loaded_kmeans = model_registry.load_joblib(os.path.join(model_dir, 'kmeans_model.joblib'))
+        loaded_scaler = model_registry.load_joblib(os.path.join(model_dir, 'kmeans_scaler.joblib'))
+        predicted_clusters = loaded_kmeans.predict(loaded_scaler.transform(df_features[can_cluster]))
+        df.loc[can_cluster, 'cluster'] = predicted_clusters
+
+        try:
+            cluster_mapping = model_registry.load_json(os.path.join(model_dir, "cluster_dict.json"))
+            cluster_mapping = {int(k): v for k, v in cluster_mapping.items()}
+        except FileNotFoundError:
+            logger.log("\nError: 'cluster_mapping.json' not found. Using default mapping.")
+            cluster_mapping = {0: "Cluster 0", 1: "Cluster 1", 2: "Cluster 2"}
+        df.loc[can_cluster, 'cluster_category'] = [cluster_mapping.get(int(c)) for c in predicted_clusters]
+
+    try:
+        min_max_values = model_registry.load_json(os.path.join(model_dir, "min_max_values.json"))
+        df = calculate_scores_batch(df, min_max_values)
+    except FileNotFoundError:
+        logger.log("\nError: 'min_max_values.json' not found. Cannot calculate scores.")
+        df['customer_convenience_score'] = 0.0
+        df['commute_opportunity_score'] = 0.0
+
+    predictions = awfphp.predict_on_new_data_batch(df[X_FEATURES].astype(float))
+    if isinstance(predictions, str):
+        logger.log(predictions)
+        df['predicted_avg_weekly_frequency_per_hour'] = None
+    else:
+        df['predicted_avg_weekly_frequency_per_hour'] = predictions
+
+    for column in ['shops_nearby_count', 'oa21pop', 'employed_total', 'bus_commute_total']:
+        df[column] = df[column].round().astype('Int64')
+
+    logger.log(f"Batch enrichment of {len(df)} coordinates complete.")
+    return df[ORDERED_KEYS]
+
+
 def census_return(oa21cd, config_path = helper.affix_root_path("config.json")):
     """
     Takes an OA21 code and returns relevant census data in a dictionary.
+    Reads from the in-memory census feature index, falling back to the database if it is unavailable.
     """
     conn = None
     cursor = None
     if oa21cd is None:
         return {'oa21pop': None, 'employed_total': None, 'bus_commute_total': None}
+
+    index = census_features.get_census_feature_index(config_path)
+    if index is not None:
+        result = census_features.lookup_census_record(index, oa21cd)
+        if result is None:
+            logger.log(f"No result found for '{oa21cd}'.")
+            return {'oa21pop': None, 'employed_total': None, 'bus_commute_total': None}
+        return result
+
     try:
         with open(config_path, 'r') as f:
             config_data = json.load(f)
@@ -168,15 +309,11 @@ def census_return(oa21cd, config_path = helper.affix_root_path("config.json")):
             t61.travel_total_16_plus_employed AS employed_total,
             t61.travel_bus AS bus_commute_total
         FROM
-            oa_lookup AS oa
-        LEFT JOIN
-            ts001 AS t1 ON t1.geography = oa.oa21cd
+            ts001 AS t1
         LEFT JOIN
-            ts007a AS t7a ON t7a.geography = oa.oa21cd
-        LEFT JOIN
-            ts061 AS t61 ON t61.geography = oa.oa21cd
+            ts061 AS t61 ON t61.geography = t1.geography
         WHERE
-            oa.oa21cd = %s
+            t1.geography = %s
         LIMIT 1
         """
         
@@ -188,7 +325,7 @@ def census_return(oa21cd, config_path = helper.affix_root_path("config.json")):
             return result
         else:
             logger.log(f"No result found for '{oa21cd}'.")
-            return None
+            return {'oa21pop': None, 'employed_total': None, 'bus_commute_total': None}
 
     except FileNotFoundError:
         logger.log(f"Error: config.json not found.")
@@ -201,3 +338,62 @@ def census_return(oa21cd, config_path = helper.affix_root_path("config.json")):
             cursor.close()
         if conn and conn.is_connected():
             conn.close()
+
+
+def census_return_batch(oa_codes, config_path = helper.affix_root_path("config.json")):
+    """
+    Takes a list of OA21 codes and returns their census data from the in-memory census feature
+    index, or in a single query if the index is unavailable.
+    Returns a DataFrame with one row per input code, in input order; missing codes have NaN values.
+    """
+    oa_codes = [code if isinstance(code, str) else None for code in oa_codes]
+    columns = ['oa21pop', 'employed_total', 'bus_commute_total']
+    result_df = pd.DataFrame({'oa21cd': pd.Series(oa_codes, dtype=object)})
+
+    index = census_features.get_census_feature_index(config_path)
+    if index is not None:
+        features = census_features.lookup_census_features(index, oa_codes)
+        for position, column in enumerate(census_features.FEATURE_COLUMNS):
+            result_df[column] = features[:, position]
+        return result_df
+
+    distinct_codes = sorted({code for code in oa_codes if isinstance(code, str)})
+
+    census_df = pd.DataFrame(columns=['oa21cd'] + columns)
+    conn = None
+    cursor = None
+    try:
+        if distinct_codes:
+            with open(config_path, 'r') as f:
+                config_data = json.load(f)
+
+            conn, cursor = dp.connect_to_mysql(config_data)
+            if conn:
+                placeholders = ', '.join(['%s'] * len(distinct_codes))
+                query = f"""
+                SELECT
+                    t1.geography AS oa21cd,
+                    t1.total AS oa21pop,
+                    t61.travel_total_16_plus_employed AS employed_total,
+                    t61.travel_bus AS bus_commute_total
+                FROM
+                    ts001 AS t1
+                LEFT JOIN
+                    ts061 AS t61 ON t61.geography = t1.geography
+                WHERE
+                    t1.geography IN ({placeholders})
+                """
+                cursor.execute(query, tuple(distinct_codes))
+                census_df = pd.DataFrame(cursor.fetchall(), columns=['oa21cd'] + columns)
+    except FileNotFoundError:
+        logger.log(f"Error: config.json not found.")
+    except Exception as e:
+        logger.log(f"An error occurred in census_return_batch: {e}")
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    census_df = census_df.drop_duplicates(subset='oa21cd', keep='first')
+    return result_df.merge(census_df, on='oa21cd', how='left')
@@ -0,0 +1,74 @@
+# spatial_dedup.py
+
+import math
+import helper_files.logger as logger
+
+DEFAULT_TOLERANCE_M = 10
+EARTH_RADIUS_M = 6371008.8
+
+def _project(lat, lon):
+    """
+    Projects a WGS84 coordinate to local metres using an equirectangular approximation,
+    which is accurate to well under a metre at the few-metre scale used for deduplication.
+    """
+    lat_rad = math.radians(lat)
+    return EARTH_RADIUS_M * math.radians(lon) * math.cos(lat_rad), EARTH_RADIUS_M * lat_rad
+
+def cluster_points(lats, lons, tolerance_m=DEFAULT_TOLERANCE_M):
+    """
+    Clusters coordinates with a spatial hash so that points within tolerance_m of a cluster's
+    first point share it. Returns a list giving, for each input position, the position of
+    its cluster representative. A tolerance of 0 (or None) disables clustering.
+    """
+    representative_of = list(range(len(lats)))
+    if not tolerance_m:
+        return representative_of
+
+    grid = {}
+    projected = {}
+
+    for i, (lat, lon) in enumerate(zip(lats, lons)):
+        if lat is None or lon is None or math.isnan(lat) or math.isnan(lon):
+            continue
+
+        x, y = _project(float(lat), float(lon))
+        cell_x, cell_y = int(x // tolerance_m), int(y // tolerance_m)
+
+        found = None
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for j in grid.get((cell_x + dx, cell_y + dy), ()):
+                    rep_x, rep_y = projected[j]
+                    if math.hypot(x - rep_x, y - rep_y) <= tolerance_m:
+                        found = j
+                        break
+                if found is not None:
+                    break
+            if found is not None:
+                break
+
+        if found is None:
+            grid.setdefault((cell_x, cell_y), []).append(i)
+            projected[i] = (x, y)
+        else:
+            representative_of[i] = found
+
+    return representative_of
+
+def cluster_stop_ids(stop_ids, lats, lons, tolerance_m=DEFAULT_TOLERANCE_M):
+    """
+    Clusters stops by location and returns a dict mapping each stop_id to the stop_id
+    of its cluster representative.
+    """
+    stop_ids = list(stop_ids)
+    representative_of = cluster_points(list(lats), list(lons), tolerance_m)
+    return {stop_ids[i]: stop_ids[rep] for i, rep in enumerate(representative_of)}
+
+def report_savings(stage_name, total_stops, lookups_made, tolerance_m=DEFAULT_TOLERANCE_M):
+    """
+    Logs how many external lookups were avoided by sharing results between co-located stops.
+    """
+    saved = total_stops - lookups_made
+    logger.log(f"{stage_name}: {lookups_made} lookups for {total_stops} stops "
+               f"(tolerance {tolerance_m} m), {saved} calls saved.")
+    return saved
@@ -0,0 +1,256 @@
+# standin_apis.py
+
+import json
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import numpy as np
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.providers as providers
+
+DEFAULT_RECORDINGS_PATH = helper.affix_root_path("enrich/recordings/api_responses.json")
+RECORDING_KINDS = ['postcodes', 'shops', 'population_density']
+
+OVERPASS_POINT_PATTERN = re.compile(r'node\["shop"\]\(around:\d+,\s*([-\d.eE]+),\s*([-\d.eE]+)\)')
+
+def coordinate_key(lat, lon):
+    """Returns the key a coordinate's responses are recorded under."""
+    return f"{float(lat):.6f},{float(lon):.6f}"
+
+def load_recordings(path=DEFAULT_RECORDINGS_PATH):
+    """
+    Loads recorded responses, a dict of {'postcodes': {key: postcode}, 'shops': {key: count},
+    'population_density': {key: value}}. Returns empty recordings if the file does not exist.
+    """
+    recordings = {kind: {} for kind in RECORDING_KINDS}
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        logger.log(f"No recorded responses found at '{path}'.")
+        return recordings
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode recorded responses from '{path}'.")
+        return recordings
+    for kind in RECORDING_KINDS:
+        recordings[kind].update(data.get(kind, {}))
+    return recordings
+
+def recorded_coordinates(recordings):
+    """Returns the (latitude, longitude) pairs with a recorded postcode, in file order."""
+    return [tuple(float(value) for value in key.split(',')) for key in recordings['postcodes']]
+
+def record_responses(coordinates, path=DEFAULT_RECORDINGS_PATH, max_workers=1):
+    """
+    Fetches postcodes, shop counts and population density for the coordinates through the
+    current providers (the real APIs by default) and adds them to the recordings file.
+    Returns the number of coordinates recorded.
+    """
+    coordinates = [(float(lat), float(lon)) for lat, lon in coordinates]
+    recordings = load_recordings(path)
+    postcodes = providers.get_provider('geocoding').postcodes(coordinates, max_workers=max_workers)
+    shop_counts = providers.get_provider('shops').shop_counts(coordinates, max_workers=max_workers)
+    try:
+        densities = providers.get_provider('raster').sample([lon for _, lon in coordinates], [lat for lat, _ in coordinates])
+    except FileNotFoundError as e:
+        logger.log(f"Warning: {e}. Population density not recorded.")
+        densities = [None] * len(coordinates)
+
+    for (lat, lon), postcode, shop_count, density in zip(coordinates, postcodes, shop_counts, densities):
+        key = coordinate_key(lat, lon)
+        recordings['postcodes'][key] = postcode
+        recordings['shops'][key] = int(shop_count)
+        if density is not None:
+            recordings['population_density'][key] = float(density)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(recordings, f, indent=2)
+    os.replace(tmp_path, path)
+    logger.log(f"Recorded responses for {len(coordinates)} coordinates to '{path}'.")
+    return len(coordinates)
+
+def _synthetic(key, kind):
+    """A stable made-up response for a coordinate that has no recording."""
+    checksum = zlib.crc32(f"{kind}:{key}".encode('utf-8'))
+    if kind == 'postcodes':
+        return f"ZZ{checksum % 100} {checksum % 10}ZZ"
+    if kind == 'shops':
+        return checksum % 40
+    return float(checksum % 5000)
+
+class _StandinHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        standin = self.server.standin
+        url = urlparse(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ""
+
+        if url.path.rstrip('/') == '/postcodes':
+            if method == 'GET':
+                query = parse_qs(url.query)
+                points = [(query.get('lat', ['nan'])[0], query.get('lon', ['nan'])[0])]
+            else:
+                points = [(g.get('latitude'), g.get('longitude')) for g in json.loads(body or '{}').get('geolocations', [])]
+            status, payload = standin.respond('postcodes', points, bulk=(method == 'POST'))
+        elif url.path.rstrip('/') == '/api/interpreter' and method == 'POST':
+            status, payload = standin.respond('shops', OVERPASS_POINT_PATTERN.findall(body))
+        else:
+            status, payload = 404, {'status': 404, 'error': f"Unknown stand-in path '{url.path}'"}
+        self._send_json(status, payload)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+class StandinAPIServer:
+    """
+    A local HTTP server answering the Postcodes.io (single and bulk reverse geocoding) and
+    Overpass ('out count' shop queries) endpoints from recorded responses. Every request waits
+    latency_ms (plus up to jitter_ms either way and per_item_ms per coordinate) and fails
+    with error_status at error_rate. Coordinates with no recording get a stable made-up
+    response when synthesize_missing is set, otherwise no postcode and no shops.
+    """
+    def __init__(self, recordings=None, latency_ms=50.0, jitter_ms=0.0, per_item_ms=0.0, error_rate=0.0,
+                 error_status=503, synthesize_missing=True, seed=0, host="127.0.0.1", port=0):
+        self.recordings = recordings or {kind: {} for kind in RECORDING_KINDS}
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.per_item_ms = per_item_ms
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.synthesize_missing = synthesize_missing
+        self.host = host
+        self.port = port
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._httpd = None
+        self._thread = None
+        self.counts = {'requests': 0, 'errors': 0, 'items': 0, 'unrecorded': 0}
+
+    @property
+    def urls(self):
+        """The stand-in URLs to use in place of the real Postcodes.io and Overpass ones."""
+        base = f"http://{self.host}:{self.port}"
+        return {'postcodes': f"{base}/postcodes", 'overpass': f"{base}/api/interpreter"}
+
+    def lookup(self, kind, lat, lon):
+        """Returns the recorded (or synthesised) response for one coordinate, and whether it was recorded."""
+        key = coordinate_key(lat, lon)
+        values = self.recordings[kind]
+        if key in values:
+            return values[key], True
+        if self.synthesize_missing:
+            return _synthetic(key, kind), False
+        return (None if kind == 'postcodes' else 0), False
+
+    def respond(self, kind, points, bulk=True):
+        """Builds the (status, payload) for a request covering the given coordinates."""
+        with self._lock:
+            self.counts['requests'] += 1
+            failed = self._random.random() < self.error_rate
+            delay_ms = self.latency_ms + self._random.uniform(-self.jitter_ms, self.jitter_ms) + self.per_item_ms * len(points)
+            if failed:
+                self.counts['errors'] += 1
+        time.sleep(max(0.0, delay_ms) / 1000)
+        if failed:
+            return self.error_status, {'status': self.error_status, 'error': "Stand-in injected error"}
+
+        results = []
+        unrecorded = 0
+        for lat, lon in points:
+            try:
+                value, recorded = self.lookup(kind, lat, lon)
+            except (TypeError, ValueError):
+                value, recorded = (None if kind == 'postcodes' else 0), True
+            unrecorded += int(not recorded)
+            results.append(((lat, lon), value))
+        with self._lock:
+            self.counts['items'] += len(points)
+            self.counts['unrecorded'] += unrecorded
+
+        if kind == 'shops':
+            return 200, {'elements': [{'type': 'count', 'id': 0, 'tags': {'total': str(value)}} for _, value in results]}
+        if not bulk:
+            value = results[0][1] if results else None
+            return 200, {'status': 200, 'result': [{'postcode': value}] if value else None}
+        return 200, {'status': 200, 'result': [
+            {'query': {'latitude': lat, 'longitude': lon}, 'result': [{'postcode': value}] if value else None}
+            for (lat, lon), value in results
+        ]}
+
+    def start(self):
+        """Starts serving on a background thread. Returns the base URL."""
+        self._httpd = ThreadingHTTPServer((self.host, self.port), _StandinHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.standin = self
+        self.port = self._httpd.server_address[1]
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logger.log(f"Stand-in APIs serving on http://{self.host}:{self.port} "
+                   f"(latency {self.latency_ms}ms +/- {self.jitter_ms}ms, error rate {self.error_rate}).")
+        return f"http://{self.host}:{self.port}"
+
+    def stop(self):
+        """Stops the server."""
+        if self._httpd:
+            self._httpd.shutdown()
+            self._httpd.server_close()
+            self._httpd = None
+
+    def stats(self):
+        """Returns how many requests and coordinates were served, failed on purpose, or had no recording."""
+        with self._lock:
+            return dict(self.counts)
+
+class RecordedRasterProvider:
+    """Raster provider returning recorded population density values instead of reading the GeoTIFF."""
+    name = 'raster'
+
+    def __init__(self, recordings=None, synthesize_missing=True):
+        self.values = (recordings or {}).get('population_density', {})
+        self.synthesize_missing = synthesize_missing
+
+    def sample_point(self, lon, lat):
+        key = coordinate_key(lat, lon)
+        if key in self.values:
+            return float(self.values[key])
+        return _synthetic(key, 'population_density') if self.synthesize_missing else 0.0
+
+    def sample(self, lons, lats):
+        return np.array([self.sample_point(lon, lat) for lon, lat in zip(lons, lats)], dtype=float)
+
+def use_standins(server, max_retries=3, initial_delay=1):
+    """
+    Points the geocoding and shops providers at a running stand-in server and replaces the
+    raster provider with the server's recorded values. Returns the replaced providers so
+    they can be restored with providers.set_provider.
+    """
+    urls = server.urls
+    return {
+        'geocoding': providers.set_provider('geocoding', providers.PostcodesIoProvider(urls['postcodes'], max_retries=max_retries, initial_delay=initial_delay)),
+        'shops': providers.set_provider('shops', providers.OverpassProvider(urls['overpass'], max_retries=max_retries, initial_delay=initial_delay)),
+        'raster': providers.set_provider('raster', RecordedRasterProvider(server.recordings, server.synthesize_missing)),
+    }
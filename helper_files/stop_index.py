@@ -0,0 +1,242 @@
+# stop_index.py
+
+import json
+import os
+import shutil
+import time
+import numpy as np
+import pyproj
+import mysql.connector
+from scipy.spatial import cKDTree
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+
+DEFAULT_INDEX_DIR = helper.affix_root_path("data/stop_index")
+MANIFEST_FILE = "manifest.json"
+PROJECTED_CRS = "EPSG:27700"
+DEFAULT_RADIUS_M = 400
+FETCH_BATCH_SIZE = 50000
+
+_transformer = pyproj.Transformer.from_crs("EPSG:4326", PROJECTED_CRS, always_xy=True)
+
+_loaded_index = None
+_loaded_index_key = None
+# Index dirs whose on-demand build has failed in this process; get_* does not retry them.
+_failed_builds = set()
+
+def project(lats, lons):
+    """
+    Projects WGS84 coordinates to British National Grid metres. Returns an (n, 2) array of
+    (easting, northing), with NaN rows for missing or invalid coordinates.
+    """
+    lats = np.asarray(lats, dtype=float).reshape(-1)
+    lons = np.asarray(lons, dtype=float).reshape(-1)
+    eastings, northings = _transformer.transform(lons, lats)
+    xy = np.column_stack([np.asarray(eastings, dtype=float).reshape(-1), np.asarray(northings, dtype=float).reshape(-1)])
+    xy[~np.isfinite(xy).all(axis=1)] = np.nan
+    return xy
+
+class StopIndex:
+    """
+    A KD-tree over the projected positions of every stop, answering nearest-stop and
+    within-radius queries for batches of WGS84 points. Distances are in metres.
+    """
+    def __init__(self, stop_ids, stop_names, lats, lons, xy):
+        self.stop_ids = stop_ids
+        self.stop_names = stop_names
+        self.lats = lats
+        self.lons = lons
+        self.xy = xy
+        self.tree = cKDTree(xy)
+
+    def __len__(self):
+        return len(self.stop_ids)
+
+    def stop_id(self, position):
+        return self.stop_ids[position].decode('utf-8')
+
+    def stop_name(self, position):
+        return self.stop_names[position].decode('utf-8')
+
+    def nearest(self, lats, lons, k=1, max_distance_m=np.inf):
+        """
+        Finds the k nearest stops to each point. Returns (distances, positions), both of shape
+        (n, k) and sorted nearest first; where there is no stop (within max_distance_m, or for
+        an invalid point) the distance is inf and the position is -1.
+        """
+        xy = project(lats, lons)
+        distances = np.full((len(xy), k), np.inf)
+        positions = np.full((len(xy), k), -1, dtype=np.int64)
+        valid = ~np.isnan(xy).any(axis=1)
+        if valid.any() and len(self):
+            found_distances, found_positions = self.tree.query(xy[valid], k=k, distance_upper_bound=max_distance_m)
+            found_distances = np.asarray(found_distances, dtype=float).reshape(-1, k)
+            found_positions = np.asarray(found_positions, dtype=np.int64).reshape(-1, k)
+            found_positions[~np.isfinite(found_distances)] = -1
+            distances[valid] = found_distances
+            positions[valid] = found_positions
+        return distances, positions
+
+    def within_radius(self, lats, lons, radius_m=DEFAULT_RADIUS_M):
+        """
+        Finds every stop within radius_m of each point. Returns a list with, for each point,
+        an array of stop positions sorted nearest first (empty for an invalid point).
+        """
+        xy = project(lats, lons)
+        results = [np.array([], dtype=np.int64) for _ in range(len(xy))]
+        valid = np.flatnonzero(~np.isnan(xy).any(axis=1))
+        if len(valid) and len(self):
+            for point, found in zip(valid, self.tree.query_ball_point(xy[valid], r=radius_m)):
+                found = np.asarray(found, dtype=np.int64)
+                order = np.argsort(np.hypot(*(self.xy[found] - xy[point]).T), kind='stable')
+                results[point] = found[order]
+        return results
+
+    def count_within(self, lats, lons, radius_m=DEFAULT_RADIUS_M):
+        """Counts the stops within radius_m of each point, with 0 for an invalid point."""
+        xy = project(lats, lons)
+        counts = np.zeros(len(xy), dtype=np.int64)
+        valid = ~np.isnan(xy).any(axis=1)
+        if valid.any() and len(self):
+            counts[valid] = self.tree.query_ball_point(xy[valid], r=radius_m, return_length=True)
+        return counts
+
+def build_stop_index(config=helper.affix_root_path("config.json"),
+                     index_dir=DEFAULT_INDEX_DIR,
+                     STOPS_TABLE="stops"):
+    """
+    Reads every stop with a location from the stops table, projects it to British National Grid
+    and writes the stop ids, names, coordinates and projected positions to disk. Returns True on success.
+    """
+    logger.log(f"Building stop spatial index from '{STOPS_TABLE}'...")
+    start_time = time.time()
+
+    try:
+        with open(config) as json_file:
+            db_config = json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config}' not found for stop index build.")
+        return False
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config}' for stop index build.")
+        return False
+
+    conn, dict_cursor = dp.connect_to_mysql(db_config)
+    if not conn:
+        return False
+    dict_cursor.close()
+
+    rows = []
+    cursor = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT stop_id, stop_name, stop_lat, stop_lon FROM {STOPS_TABLE} "
+                       f"WHERE stop_lat IS NOT NULL AND stop_lon IS NOT NULL ORDER BY stop_id")
+        while True:
+            batch = cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not batch:
+                break
+            rows.extend(batch)
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during stop index build: {err}")
+        return False
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    lats = np.array([float(row[2]) for row in rows], dtype=np.float64)
+    lons = np.array([float(row[3]) for row in rows], dtype=np.float64)
+    xy = project(lats, lons)
+    valid = ~np.isnan(xy).any(axis=1)
+    if not valid.any():
+        logger.log(f"No stops with valid locations found in '{STOPS_TABLE}'. Stop index not built.")
+        return False
+
+    rows = [row for row, keep in zip(rows, valid) if keep]
+    stop_ids = np.array([str(row[0]).encode('utf-8') for row in rows])
+    stop_names = np.array([(row[1] or "").encode('utf-8') for row in rows])
+
+    tmp_dir = index_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    np.save(os.path.join(tmp_dir, "stop_ids.npy"), stop_ids)
+    np.save(os.path.join(tmp_dir, "stop_names.npy"), stop_names)
+    np.save(os.path.join(tmp_dir, "lat_lon.npy"), np.column_stack([lats[valid], lons[valid]]))
+    np.save(os.path.join(tmp_dir, "xy.npy"), xy[valid])
+    with open(os.path.join(tmp_dir, MANIFEST_FILE), 'w') as f:
+        json.dump({'source_table': STOPS_TABLE, 'crs': PROJECTED_CRS, 'stops': len(rows),
+                   'built_at': time.strftime('%Y-%m-%d %H:%M:%S')}, f, indent=2)
+
+    shutil.rmtree(index_dir, ignore_errors=True)
+    os.replace(tmp_dir, index_dir)
+
+    logger.log(f"Stop index with {len(rows)} stops written to '{index_dir}' in {time.time() - start_time:.1f}s.")
+    return True
+
+def load_stop_index(index_dir=DEFAULT_INDEX_DIR):
+    """
+    Loads the stop index and builds its KD-tree, reusing the already loaded index unless it has
+    been rebuilt since. Returns None if no index has been built.
+    """
+    global _loaded_index, _loaded_index_key
+
+    manifest_path = os.path.join(index_dir, MANIFEST_FILE)
+    if not os.path.exists(manifest_path):
+        return None
+
+    index_key = (os.path.abspath(index_dir), os.path.getmtime(manifest_path))
+    if _loaded_index is not None and _loaded_index_key == index_key:
+        return _loaded_index
+
+    lat_lon = np.load(os.path.join(index_dir, "lat_lon.npy"))
+    index = StopIndex(
+        np.load(os.path.join(index_dir, "stop_ids.npy")),
+        np.load(os.path.join(index_dir, "stop_names.npy")),
+        lat_lon[:, 0],
+        lat_lon[:, 1],
+        np.load(os.path.join(index_dir, "xy.npy")),
+    )
+
+    _loaded_index = index
+    _loaded_index_key = index_key
+    logger.log(f"Loaded stop index with {len(index)} stops from '{index_dir}'.")
+    return index
+
+def get_stop_index(config=helper.affix_root_path("config.json"), index_dir=DEFAULT_INDEX_DIR, STOPS_TABLE="stops"):
+    """
+    Returns the stop index, building it from the database first if it does not exist yet.
+    A failed build is not retried in this process, so callers go straight to their fallback;
+    call build_stop_index directly to try again.
+    """
+    index = load_stop_index(index_dir)
+    build_key = os.path.abspath(index_dir)
+    if index is None and build_key not in _failed_builds:
+        logger.log(f"No stop index found at '{index_dir}'. Building it now...")
+        if build_stop_index(config=config, index_dir=index_dir, STOPS_TABLE=STOPS_TABLE):
+            index = load_stop_index(index_dir)
+        else:
+            _failed_builds.add(build_key)
+            logger.log("Could not build the stop index. Not retrying in this process.")
+    return index
+
+def nearest_stop_features(index, lats, lons, radius_m=DEFAULT_RADIUS_M):
+    """
+    Returns, for each point, a dict with the nearest existing stop's id, name and distance in
+    metres and the number of existing stops within radius_m. Fields are None where the
+    point is invalid or the index is empty.
+    """
+    distances, positions = index.nearest(lats, lons, k=1)
+    counts = index.count_within(lats, lons, radius_m)
+    features = []
+    for distance, position, count in zip(distances[:, 0], positions[:, 0], counts):
+        found = position >= 0
+        features.append({
+            'nearest_stop_id': index.stop_id(position) if found else None,
+            'nearest_stop_name': index.stop_name(position) if found else None,
+            'nearest_stop_distance_m': round(float(distance), 1) if found else None,
+            'nearby_stops_count': int(count) if found else None,
+        })
+    return features
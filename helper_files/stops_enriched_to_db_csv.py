@@ -8,21 +8,18 @@ from mysql.connector import Error
 import helper_files.stops_enrichment_population_density as sepd
 import os
 import helper_files.helper as helper
+import helper_files.artifacts as artifacts
 
-def write_enriched_to_db_csv(input_json_file = helper.affix_root_path("enrich/enriched_stops_data_shops.json"),
+def write_enriched_to_db_csv(input_json_file = helper.affix_root_path("enrich/enriched_stops_data_shops.parquet"),
                               output_csv_file = helper.affix_root_path("data/stops_intermediate.csv"),
                                 config = helper.affix_root_path("config.json"),
-                                  output_filename = helper.affix_root_path("data/stops_enriched.csv")):
+                                  output_filename = helper.affix_root_path("data/stops_enriched.parquet"),
+                                    export_formats = ()):
     """
-    Uses enriched_stops_data_shops.json to create stops_intermediate.csv, load this into mysql, and then create stops_enriched table.
-    This is then exported as a csv for future use.
+    Uses the enriched_stops_data_shops file to create stops_intermediate.csv, load this into mysql, and then create stops_enriched table.
+    This is then exported as a typed Parquet file for future use (export_formats=('csv',) also writes stops_enriched.csv).
     """
-    with open(input_json_file, 'r') as f:
-                stops_data = json.load(f)
-
-    records = [record for record in stops_data.values()]
-
-    df = pd.DataFrame(records)
+    df = artifacts.read_artifact(input_json_file, schema_name='stops_shops')
     df = sepd.process_stops_data(df)
 
     df.to_csv(output_csv_file, index=False, lineterminator='\n')
@@ -57,6 +54,6 @@ def write_enriched_to_db_csv(input_json_file = helper.affix_root_path("enrich/en
     logger.log("Querying table to turn to csv...")
     df = pd.read_sql_query(query, conn)
     logger.log("Query complete.")
-    logger.log("Writing to csv...")
-    df.to_csv(output_filename, index=False, lineterminator='\n')
-    logger.log("CSV writing complete.")
\ No newline at end of file
+    logger.log(f"Writing to '{output_filename}'...")
+    artifacts.write_artifact(df, output_filename, 'stops_enriched', export_formats)
+    logger.log("stops_enriched writing complete.")
\ No newline at end of file
@@ -3,78 +3,61 @@
 import mysql.connector
 import json
 import os
+import pandas as pd
 from tqdm import tqdm
 import helper_files.data_pipeline as dp
 import helper_files.logger as logger
 import helper_files.helper as helper
+import helper_files.postcode_oa_index as postcode_oa_index
+import helper_files.artifacts as artifacts
 
 def generate_oas(OA_LOOKUP="oa_lookup", 
-                 INPUT_JSON_FILE=helper.affix_root_path("enrich/enriched_stops_data_postcode.json"), 
-                 OUTPUT_JSON_FILE=helper.affix_root_path("enriched_stops_data_oas.json"), 
-                 config=helper.affix_root_path("config.json")):
+                 INPUT_JSON_FILE=helper.affix_root_path("enrich/enriched_stops_data_postcode.parquet"), 
+                 OUTPUT_JSON_FILE=helper.affix_root_path("enriched_stops_data_oas.parquet"), 
+                 config=helper.affix_root_path("config.json"),
+                 export_formats=()):
     """
-    Enriches stop data (from a JSON file) with Output Area (OA) and Lower Super Output Area (LSOA)
-    information by looking up postcodes in a database table.
+    Enriches stop data (from a Parquet file, or the legacy JSON file) with Output Area (OA) and Lower
+    Super Output Area (LSOA) information by looking up postcodes in the prebuilt postcode index (built
+    from the OA_LOOKUP table if it does not exist yet). export_formats can add 'json'/'csv' copies of the output.
     """
     logger.log("Starting GenerateOAs function...")
 
     loaded_data = {}
-    conn = None
-    cursor = None
 
     try:
         try:
-            with open(INPUT_JSON_FILE, 'r') as f:
-                loaded_data = json.load(f)
+            loaded_data = artifacts.read_stop_records(INPUT_JSON_FILE, 'stops_postcode')
             logger.log(f"Successfully loaded input data from '{INPUT_JSON_FILE}'. Found {len(loaded_data)} stops.")
         except FileNotFoundError:
-            logger.log(f"Error: Input JSON file '{INPUT_JSON_FILE}' not found. Cannot enrich OA/LSOA data.")
+            logger.log(f"Error: Input file '{INPUT_JSON_FILE}' not found. Cannot enrich OA/LSOA data.")
             return
         except json.JSONDecodeError:
             logger.log(f"Error: Could not decode JSON from input file '{INPUT_JSON_FILE}'.")
             return
 
-        try:
-            with open(config) as json_file:
-                db_config = json.load(json_file)
-        except FileNotFoundError:
-            logger.log(f"Error: Config file '{config}' not found for OA/LSOA enrichment.")
-            return
-        except json.JSONDecodeError:
-            logger.log(f"Error: Could not decode JSON from config file '{config}' for OA/LSOA enrichment.")
+        oa_index = postcode_oa_index.get_postcode_oa_index(config=config, OA_LOOKUP=OA_LOOKUP)
+        if oa_index is None:
+            logger.log(f"Error: Postcode index could not be loaded or built from '{OA_LOOKUP}'. Cannot enrich OA/LSOA data.")
             return
 
-        conn, cursor = dp.connect_to_mysql(db_config)
-        logger.log("Connected to DB for OA/LSOA lookup.")
-
-        query = f"SELECT pcds, oa21cd, lsoa21cd, lsoa21nm FROM {OA_LOOKUP}"
-        logger.log(f"Executing query to load OA lookup data: {query}")
-        cursor.execute(query)
-        oa_lookup_results = cursor.fetchall()
-        oa_lookup_map = {}
-
-        for row in oa_lookup_results:
-            if row['pcds']:
-                postcode_key = str(row['pcds']).replace(' ', '').upper()
-                oa_lookup_map[postcode_key] = {
-                    'oa21cd': row['oa21cd'],
-                    'lsoa21cd': row['lsoa21cd'],
-                    'lsoa21nm': row['lsoa21nm']
-                }
-        logger.log(f"Loaded {len(oa_lookup_map)} postcode lookup entries from '{OA_LOOKUP}'.")
+        stop_ids = list(loaded_data.keys())
+        lookup_results = postcode_oa_index.lookup_postcodes(
+            oa_index, [loaded_data[stop_id].get('postcode') for stop_id in stop_ids]
+        )
+        oa_lookup_map = dict(zip(stop_ids, lookup_results))
 
         logger.log("Enriching stops data with OA/LSOA information...")
         for stop_id, stop_details in tqdm(loaded_data.items(), desc="Enriching stops with OA/LSOA", leave=True):
             postcode = stop_details.get('postcode')
 
             if postcode:
-                normalized_postcode = str(postcode).replace(' ', '').upper()
-                lookup_info = oa_lookup_map.get(normalized_postcode)
+                oa21cd, lsoa21cd, lsoa21nm = oa_lookup_map[stop_id]
 
-                if lookup_info:
-                    stop_details['oa21cd'] = lookup_info['oa21cd']
-                    stop_details['lsoa21cd'] = lookup_info['lsoa21cd']
-                    stop_details['lsoa21nm'] = lookup_info['lsoa21nm']
+                if oa21cd or lsoa21cd:
+                    stop_details['oa21cd'] = oa21cd
+                    stop_details['lsoa21cd'] = lsoa21cd
+                    stop_details['lsoa21nm'] = lsoa21nm
                 else:
                     stop_details['oa21cd'] = None
                     stop_details['lsoa21cd'] = None
@@ -94,32 +77,40 @@ def generate_oas(OA_LOOKUP="oa_lookup",
         os.makedirs(output_dir, exist_ok=True)
         output_file_path = os.path.join(output_dir, OUTPUT_JSON_FILE)
 
-        with open(output_file_path, 'w') as f:
-            json.dump(loaded_data, f, indent=2)
+        artifacts.write_stop_records(loaded_data.values(), output_file_path, 'stops_oas', export_formats)
         logger.log(f"Enriched stop data (with OA/LSOA) saved to '{output_file_path}'.")
 
     except mysql.connector.Error as err:
         logger.log(f"Database error during GenerateOAs: {err}")
     except Exception as e:
         logger.log(f"An unexpected error occurred in GenerateOAs: {e}")
-    finally:
-        if cursor:
-            cursor.close()
-            logger.log("Database cursor closed for OA/LSOA enrichment.")
-        if conn and conn.is_connected():
-            conn.close()
-            logger.log("Database connection closed for OA/LSOA enrichment.")
     logger.log("Finished GenerateOAs function.")
 
+def format_pcds(postcode):
+    """
+    Formats a postcode the way the pcds column stores it: upper case with a single space before the inward code.
+    """
+    temp_postcode = postcode.replace(' ', '').upper()
+    if len(temp_postcode) >= 3:
+        return temp_postcode[:-3] + ' ' + temp_postcode[-3:]
+    return temp_postcode
+
 def get_oa_lsoa_details(postcode, config_path = helper.affix_root_path("config.json")):
     """
-    Looks up OA and LSOA details for a single postcode using a centralized
-    connection method.
+    Looks up OA and LSOA details for a single postcode using the prebuilt postcode index,
+    falling back to querying the database if no index has been built.
     """
     conn = None
     cursor = None
     
     try:
+        oa_index = postcode_oa_index.load_postcode_oa_index()
+        if oa_index is not None:
+            oa21cd, lsoa21cd, lsoa21nm = postcode_oa_index.lookup_postcodes(oa_index, [postcode])[0]
+            if oa21cd is None and lsoa21cd is None:
+                logger.log(f"Postcode '{postcode}' not found in the postcode index.")
+            return oa21cd, lsoa21cd, lsoa21nm
+
         try:
             with open(config_path, 'r') as f:
                 db_config = json.load(f)
@@ -134,11 +125,7 @@ def get_oa_lsoa_details(postcode, config_path = helper.affix_root_path("config.j
         if not conn:
             return None, None, None
 
-        temp_postcode = postcode.replace(' ', '').upper()
-        if len(temp_postcode) >= 3:
-            normalized_postcode = temp_postcode[:-3] + ' ' + temp_postcode[-3:]
-        else:
-            normalized_postcode = temp_postcode
+        normalized_postcode = format_pcds(postcode)
 
         query = "SELECT oa21cd, lsoa21cd, lsoa21nm FROM oa_lookup WHERE pcds = %s"
         cursor.execute(query, (normalized_postcode,))
@@ -158,4 +145,55 @@ def get_oa_lsoa_details(postcode, config_path = helper.affix_root_path("config.j
         if cursor:
             cursor.close()
         if conn and conn.is_connected():
-            conn.close()
\ No newline at end of file
+            conn.close()
+
+def get_oa_lsoa_details_batch(postcodes, config_path = helper.affix_root_path("config.json")):
+    """
+    Looks up OA and LSOA details for many postcodes at once. Uses the prebuilt postcode index,
+    or a single IN query against oa_lookup if no index has been built.
+    Returns a DataFrame with one row per input postcode, in input order.
+    """
+    postcodes = list(postcodes)
+    columns = ['postcode', 'oa21cd', 'lsoa21cd', 'lsoa21nm']
+
+    oa_index = postcode_oa_index.load_postcode_oa_index()
+    if oa_index is not None:
+        results = postcode_oa_index.lookup_postcodes(oa_index, postcodes)
+        return pd.DataFrame([(postcode,) + result for postcode, result in zip(postcodes, results)], columns=columns)
+
+    lookup = {}
+    formatted = [format_pcds(postcode) if isinstance(postcode, str) and postcode else None for postcode in postcodes]
+    distinct_postcodes = sorted({postcode for postcode in formatted if postcode})
+
+    conn = None
+    cursor = None
+    try:
+        if distinct_postcodes:
+            with open(config_path, 'r') as f:
+                db_config = json.load(f)
+
+            conn, cursor = dp.connect_to_mysql(db_config)
+            if conn:
+                placeholders = ', '.join(['%s'] * len(distinct_postcodes))
+                query = f"SELECT pcds, oa21cd, lsoa21cd, lsoa21nm FROM oa_lookup WHERE pcds IN ({placeholders})"
+                cursor.execute(query, tuple(distinct_postcodes))
+                for row in cursor.fetchall():
+                    lookup[row['pcds']] = (row['oa21cd'], row['lsoa21cd'], row['lsoa21nm'])
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config_path}' not found.")
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from '{config_path}'. Check file format.")
+    except Exception as e:
+        logger.log(f"An unexpected error occurred during batch OA/LSOA lookup: {e}")
+    finally:
+        if cursor:
+            cursor.close()
+        if conn and conn.is_connected():
+            conn.close()
+
+    missing = sum(1 for postcode in formatted if postcode and postcode not in lookup)
+    if missing:
+        logger.log(f"{missing} of {len(postcodes)} postcodes not found in the database.")
+
+    rows = [(postcode,) + lookup.get(pcds, (None, None, None)) for postcode, pcds in zip(postcodes, formatted)]
+    return pd.DataFrame(rows, columns=columns)
@@ -1,14 +1,82 @@
 # stops_enirchment_population_density.py
 
 import pandas as pd
+import numpy as np
 import rasterio
+from rasterio.windows import Window
 import pyproj
 import os
 import helper_files.logger as logger
-from tqdm import tqdm
 import os
 import helper_files.helper as helper
 
+def block_windows(src, rows, cols):
+    """
+    Groups pixel positions by the internal raster block that contains them.
+    Returns a list of (window, positions) pairs, one per block that holds at least one position.
+    """
+    block_height, block_width = src.block_shapes[0]
+    blocks_per_row = (src.width + block_width - 1) // block_width
+    block_keys = (rows // block_height) * blocks_per_row + (cols // block_width)
+    unique_keys, inverse = np.unique(block_keys, return_inverse=True)
+    positions_by_block = np.split(np.argsort(inverse, kind='stable'), np.cumsum(np.bincount(inverse))[:-1])
+
+    windows = []
+    for key, positions in zip(unique_keys, positions_by_block):
+        block_row, block_col = divmod(int(key), blocks_per_row)
+        row_off = block_row * block_height
+        col_off = block_col * block_width
+        window = Window(col_off, row_off,
+                        min(block_width, src.width - col_off),
+                        min(block_height, src.height - row_off))
+        windows.append((window, positions))
+    return windows
+
+def sample_raster(src, transformer, lons, lats, read_block=None):
+    """
+    Samples band 1 of an open raster at many WGS84 coordinates at once.
+    Coordinates are transformed in one array call, each raster block containing a point is
+    read once (through read_block(window) if given), and values are gathered with fancy indexing.
+    Returns (values, in_bounds, valid) where values is 0.0 wherever the point is out of bounds
+    or the pixel is NoData.
+    """
+    if read_block is None:
+        read_block = lambda window: src.read(1, window=window)
+
+    lons = np.asarray(lons, dtype=float)
+    lats = np.asarray(lats, dtype=float)
+    values = np.zeros(len(lons), dtype=float)
+
+    eastings, northings = transformer.transform(lons, lats)
+    eastings = np.asarray(eastings, dtype=float)
+    northings = np.asarray(northings, dtype=float)
+
+    inverse_transform = ~src.transform
+    cols_f = inverse_transform.a * eastings + inverse_transform.b * northings + inverse_transform.c
+    rows_f = inverse_transform.d * eastings + inverse_transform.e * northings + inverse_transform.f
+    with np.errstate(invalid='ignore'):
+        rows = np.floor(rows_f)
+        cols = np.floor(cols_f)
+        in_bounds = (np.isfinite(rows) & np.isfinite(cols) &
+                     (rows >= 0) & (rows < src.height) &
+                     (cols >= 0) & (cols < src.width))
+
+    rows = np.where(in_bounds, rows, 0).astype(np.int64)
+    cols = np.where(in_bounds, cols, 0).astype(np.int64)
+    sampled = np.full(len(lons), np.nan, dtype=float)
+
+    positions_in_bounds = np.flatnonzero(in_bounds)
+    for window, block_positions in block_windows(src, rows[positions_in_bounds], cols[positions_in_bounds]):
+        positions = positions_in_bounds[block_positions]
+        block = read_block(window)
+        sampled[positions] = block[rows[positions] - window.row_off, cols[positions] - window.col_off]
+
+    valid = in_bounds & ~np.isnan(sampled)
+    if src.nodata is not None:
+        valid &= sampled != src.nodata
+    values[valid] = sampled[valid]
+    return values, in_bounds, valid
+
 def process_stops_data(stops_df, density_tif_path=helper.affix_root_path('data/population_density.tif')):
     """
     Reads a DataFrame with WGS84 coordinates, looks up population density from a TIF,
@@ -34,31 +102,16 @@ def process_stops_data(stops_df, density_tif_path=helper.affix_root_path('data/p
                 always_xy=True
             )
 
-            population_densities = [0.0] * len(stops_df)
-
-            for index, row in tqdm(stops_df.iterrows(), total=len(stops_df), desc="Processing Stops Population Density"):
-                lon = row['stop_lon']
-                lat = row['stop_lat']
-
-                try:
-                    easting, northing = transformer.transform(lon, lat)
-
-                    if not (src.bounds.left <= easting <= src.bounds.right and
-                            src.bounds.bottom <= northing <= src.bounds.top):
-                        logger.log(f"Warning: Coordinate ({lon}, {lat}) is outside TIF boundaries.")
-                        continue
-
-                    row_idx, col_idx = src.index(easting, northing)
-                    population_value = src.read(1)[row_idx, col_idx]
+            population_densities, in_bounds, valid = sample_raster(
+                src, transformer,
+                pd.to_numeric(stops_df['stop_lon'], errors='coerce').to_numpy(dtype=float),
+                pd.to_numeric(stops_df['stop_lat'], errors='coerce').to_numpy(dtype=float)
+            )
 
-                    if pd.isna(population_value) or population_value == src.nodata:
-                        logger.log(f"Warning: Invalid population value ({population_value}) found for coordinate ({lon}, {lat}).")
-                        continue
-                    
-                    population_densities[index] = float(population_value)
-                except Exception as e:
-                    logger.log(f"\nError processing coordinate ({lon}, {lat}): {e}.")
-                    logger.log(f"Assigning 0.0 for this entry.")
+            if (~in_bounds).any():
+                logger.log(f"Warning: {int((~in_bounds).sum())} coordinates are outside TIF boundaries. Assigning 0.0 for these entries.")
+            if (in_bounds & ~valid).any():
+                logger.log(f"Warning: {int((in_bounds & ~valid).sum())} coordinates have invalid population values. Assigning 0.0 for these entries.")
 
             stops_df['population_density'] = population_densities
 
@@ -5,20 +5,29 @@ import json
 import time
 import requests
 import os
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 import helper_files.logger as logger
 import helper_files.helper as helper
 import helper_files.data_pipeline as dp
+import helper_files.enrichment_checkpoint as checkpoint
+import helper_files.spatial_dedup as spatial_dedup
+import helper_files.api_client as api_client
+
+DEFAULT_POSTCODES_API_URL = "https://api.postcodes.io/postcodes"
 
 def reverse_geocode_postcode(latitude, longitude, 
-                             POSTCODES_API_URL="https://api.postcodes.io/postcodes",
+                             POSTCODES_API_URL=None,
                              radius=2000,
                              max_retries=3,
-                             initial_delay=1):
+                             initial_delay=1,
+                             failure_value=None):
     """
     Reverse geocodes coordinates to a postcode using the Postcodes.io API.
     Includes retry logic for API request failures.
+    Returns None if no postcode is within radius, and failure_value if the lookup itself fails.
     """
+    POSTCODES_API_URL = POSTCODES_API_URL or DEFAULT_POSTCODES_API_URL
     delay = initial_delay
     for attempt in range(max_retries):
         params = {
@@ -29,7 +38,7 @@ def reverse_geocode_postcode(latitude, longitude,
         }
         
         try:
-            response = requests.get(POSTCODES_API_URL, params=params, timeout=30)
+            response = api_client.send('postcodes', 'get', POSTCODES_API_URL, params=params, timeout=30)
             response.raise_for_status()
             response_data = response.json()
 
@@ -41,48 +50,59 @@ def reverse_geocode_postcode(latitude, longitude,
             else:
                 logger.log(f"API Warning (Attempt {attempt + 1}/{max_retries}): Unexpected Postcodes.io response status {response_data.get('status')} for lat: {latitude}, lon: {longitude}.")
                 if attempt < max_retries - 1:
+                    api_client.record_retry('postcodes')
                     logger.log(f"Retrying API request in {delay} seconds...")
                     time.sleep(delay)
                     delay *= 2
                 else:
                     logger.log(f"Max retries reached. Failed to fetch postcode for lat: {latitude}, lon: {longitude}.")
-                    return None
+                    return failure_value
 
         except requests.exceptions.RequestException as e:
             logger.log(f"API Request failed (Attempt {attempt + 1}/{max_retries}) for lat: {latitude}, lon: {longitude}: {e}")
             if attempt < max_retries - 1:
+                api_client.record_retry('postcodes')
                 logger.log(f"Retrying API request in {delay} seconds...")
                 time.sleep(delay)
                 delay *= 2
             else:
                 logger.log(f"Max retries reached. Failed to fetch postcode for lat: {latitude}, lon: {longitude}.")
-                return None
+                return failure_value
         except json.JSONDecodeError as e:
             logger.log(f"Failed to decode JSON response (Attempt {attempt + 1}/{max_retries}) for lat: {latitude}, lon: {longitude}: {e}")
             if attempt < max_retries - 1:
+                api_client.record_retry('postcodes')
                 logger.log(f"Retrying in {delay} seconds...")
                 time.sleep(delay)
                 delay *= 2
             else:
                 logger.log(f"Max retries reached. Invalid JSON response for lat: {latitude}, lon: {longitude}.")
-                return None
+                return failure_value
         except (KeyError, IndexError) as e:
-            logger.log(f"API Error: Unexpected response structure for lat: {latitude}, lon: {longitude}: {e}. Returning None.")
-            return None 
+            logger.log(f"API Error: Unexpected response structure for lat: {latitude}, lon: {longitude}: {e}.")
+            return failure_value
 
-    return None
+    return failure_value
 
 
 def generate_stops_postcode(STOPS_TABLE="stops", 
-                            POSTCODES_API_URL="https://api.postcodes.io/postcodes",
+                            POSTCODES_API_URL=None,
                             output_dir = helper.affix_root_path("enrich"), 
-                            config=helper.affix_root_path("config.json")):
+                            config=helper.affix_root_path("config.json"),
+                            resume=True,
+                            max_stops=None,
+                            dedup_tolerance_m=spatial_dedup.DEFAULT_TOLERANCE_M,
+                            export_formats=()):
     """
     Connects to the database, fetches stop data, reverse geocodes postcodes,
-    and saves the enriched data to a JSON file.
+    and saves the enriched data to a Parquet file (export_formats can add 'json'/'csv' copies).
+    Each result is appended to a JSONL checkpoint as it completes, so a restarted run
+    skips stops already done. Set max_stops to process the remaining stops in chunks;
+    the final file is only written once every stop has been processed.
+    Stops within dedup_tolerance_m of each other share a single reverse geocode lookup.
+    Stops whose lookup fails are not checkpointed, so the next run retries them.
     """
     logger.log("Starting GenerateStopsPostcode function...")
-    enriched_stops_data = {}
 
     try:
         with open(config) as json_file:
@@ -96,6 +116,10 @@ def generate_stops_postcode(STOPS_TABLE="stops",
 
     conn = None
     cursor = None
+    checkpoint_file = None
+
+    output_file_path = os.path.join(output_dir, "enriched_stops_data_postcode.parquet")
+    checkpoint_path = checkpoint.checkpoint_path_for(output_file_path)
 
     try:
         conn, cursor = dp.connect_to_mysql(data)
@@ -112,37 +136,74 @@ def generate_stops_postcode(STOPS_TABLE="stops",
 
         logger.log(f"Found {len(stops)} stops to process for postcode enrichment.")
 
-        for stop_row in tqdm(stops, desc="Enriching Stops with Postcodes", leave=True):
+        enriched_stops_data = checkpoint.load_checkpoint(checkpoint_path) if resume else {}
+        checkpoint_file = checkpoint.open_checkpoint(checkpoint_path, resume=resume)
+
+        pending_stops = [stop_row for stop_row in stops if str(stop_row['stop_id']) not in enriched_stops_data]
+        logger.log(f"{len(stops) - len(pending_stops)} stops already in checkpoint, {len(pending_stops)} remaining.")
+        if max_stops is not None:
+            pending_stops = pending_stops[:max_stops]
+
+        representative_of = spatial_dedup.cluster_stop_ids(
+            [str(stop_row['stop_id']) for stop_row in stops],
+            [stop_row['stop_lat'] for stop_row in stops],
+            [stop_row['stop_lon'] for stop_row in stops],
+            dedup_tolerance_m
+        )
+        postcode_by_representative = {}
+        for stop_id, record in enriched_stops_data.items():
+            postcode_by_representative.setdefault(representative_of.get(stop_id, stop_id), record.get('postcode'))
+        lookups_made = 0
+        failed_stops = 0
+
+        for stop_row in tqdm(pending_stops, desc="Enriching Stops with Postcodes", leave=True):
             stop_id = stop_row['stop_id']
             stop_name = stop_row['stop_name']
             stop_lat = stop_row['stop_lat']
             stop_lon = stop_row['stop_lon']
 
-            postcode = reverse_geocode_postcode(stop_lat, stop_lon, POSTCODES_API_URL)
+            representative = representative_of[str(stop_id)]
+            if representative in postcode_by_representative:
+                postcode = postcode_by_representative[representative]
+            else:
+                postcode = reverse_geocode_postcode(stop_lat, stop_lon, POSTCODES_API_URL, failure_value=checkpoint.LOOKUP_FAILED)
+                lookups_made += 1
+                if postcode is checkpoint.LOOKUP_FAILED:
+                    failed_stops += 1
+                    continue
+                postcode_by_representative[representative] = postcode
 
-            enriched_stops_data[stop_id] = {
+            record = {
                 'stop_id': str(stop_id),
                 'stop_name': stop_name,
                 'stop_lon': stop_lon,
                 'stop_lat': stop_lat,
                 'postcode': postcode
             }
+            checkpoint.append_checkpoint(checkpoint_file, record)
+            enriched_stops_data[str(stop_id)] = record
 
-            time.sleep(0.1)
+        spatial_dedup.report_savings("Postcode enrichment", len(pending_stops), lookups_made, dedup_tolerance_m)
+        if failed_stops:
+            logger.log(f"{failed_stops} postcode lookups failed and were not checkpointed.")
 
-        
-        os.makedirs(output_dir, exist_ok=True)
-        output_file_path = os.path.join(output_dir, "enriched_stops_data_postcode.json")
+        remaining = sum(1 for stop_row in stops if str(stop_row['stop_id']) not in enriched_stops_data)
+        if remaining:
+            logger.log(f"{remaining} stops still to process. Re-run to continue from checkpoint '{checkpoint_path}'.")
+            return
 
-        with open(output_file_path, 'w') as f:
-            json.dump(enriched_stops_data, f, indent=2)
-        logger.log(f"Enriched stop data (with postcodes) saved to '{output_file_path}'.")
+        written = checkpoint.write_final_records(enriched_stops_data,
+                                                 [str(stop_row['stop_id']) for stop_row in stops],
+                                                 output_file_path, 'stops_postcode', export_formats)
+        logger.log(f"Enriched stop data (with postcodes) for {written} stops saved to '{output_file_path}'.")
 
     except mysql.connector.Error as err:
         logger.log(f"Database error during GenerateStopsPostcode: {err}")
     except Exception as e:
         logger.log(f"An unexpected error occurred in GenerateStopsPostcode: {e}")
     finally:
+        if checkpoint_file:
+            checkpoint_file.close()
         if cursor:
             cursor.close()
             logger.log("Database cursor closed for postcode enrichment.")
@@ -150,3 +211,64 @@ def generate_stops_postcode(STOPS_TABLE="stops",
             conn.close()
             logger.log("Database connection closed for postcode enrichment.")
     logger.log("Finished GenerateStopsPostcode function.")
+
+
+def reverse_geocode_postcodes_bulk(coordinates,
+                                   POSTCODES_API_URL=None,
+                                   radius=2000,
+                                   batch_size=100,
+                                   max_retries=3,
+                                   initial_delay=1,
+                                   max_workers=1):
+    """
+    Reverse geocodes many (latitude, longitude) pairs using the Postcodes.io bulk endpoint,
+    which accepts up to 100 geolocations per request. Returns a list of postcodes aligned
+    to the input, with None where no postcode was found or the request failed.
+    With max_workers > 1, up to that many batches are in flight at once under the shared Postcodes.io rate limit.
+    """
+    POSTCODES_API_URL = POSTCODES_API_URL or DEFAULT_POSTCODES_API_URL
+    coordinates = list(coordinates)
+
+    def fetch_batch(batch):
+        payload = {
+            'geolocations': [
+                {'latitude': float(lat), 'longitude': float(lon), 'radius': radius, 'limit': 1}
+                for lat, lon in batch
+            ]
+        }
+
+        delay = initial_delay
+        for attempt in range(max_retries):
+            try:
+                response = api_client.send('postcodes', 'post', POSTCODES_API_URL, json=payload, timeout=60)
+                response.raise_for_status()
+                response_data = response.json()
+
+                if response_data.get('status') != 200 or len(response_data.get('result') or []) != len(batch):
+                    raise ValueError(f"Unexpected Postcodes.io bulk response status {response_data.get('status')}")
+
+                return [item['result'][0]['postcode'] if item.get('result') else None for item in response_data['result']]
+
+            except (requests.exceptions.RequestException, json.JSONDecodeError, ValueError, KeyError, IndexError, TypeError) as e:
+                logger.log(f"Bulk API request failed (Attempt {attempt + 1}/{max_retries}) for {len(batch)} coordinates: {e}")
+                if attempt < max_retries - 1:
+                    api_client.record_retry('postcodes')
+                    logger.log(f"Retrying bulk API request in {delay} seconds...")
+                    time.sleep(delay)
+                    delay *= 2
+                else:
+                    logger.log(f"Max retries reached. Failed to fetch postcodes for {len(batch)} coordinates.")
+        return [None] * len(batch)
+
+    batches = [coordinates[batch_start:batch_start + batch_size] for batch_start in range(0, len(coordinates), batch_size)]
+    if max_workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            batch_postcodes = list(executor.map(fetch_batch, batches))
+    else:
+        batch_postcodes = [fetch_batch(batch) for batch in batches]
+    postcodes = [postcode for batch in batch_postcodes for postcode in batch]
+
+    missing = sum(1 for postcode in postcodes if postcode is None)
+    if missing:
+        logger.log(f"No postcode found for {missing} of {len(coordinates)} coordinates.")
+    return postcodes
@@ -4,16 +4,24 @@ import json
 import requests
 import time
 import os
+from concurrent.futures import ThreadPoolExecutor
 import helper_files.logger as logger
 from tqdm import tqdm
 import helper_files.helper as helper
+import helper_files.enrichment_checkpoint as checkpoint
+import helper_files.spatial_dedup as spatial_dedup
+import helper_files.api_client as api_client
+import helper_files.artifacts as artifacts
 
-def get_shop_count(lat, lon, radius=500, max_retries=3, initial_delay=1):
+DEFAULT_OVERPASS_API_URL = "https://overpass-api.de/api/interpreter"
+
+def get_shop_count(lat, lon, radius=500, max_retries=3, initial_delay=1, overpass_url=None, failure_value=0):
     """
     Fetches the number of shops within a given radius of a coordinate
     using the Overpass API, with retry logic for failed requests.
+    Returns failure_value if every attempt fails.
     """
-    overpass_url = "https://overpass-api.de/api/interpreter"
+    overpass_url = overpass_url or DEFAULT_OVERPASS_API_URL
     overpass_query = (
 f"""[out:json][timeout:90];
 (
@@ -28,7 +36,7 @@ out count;"""
     delay = initial_delay
     for attempt in range(max_retries):
         try:
-            response = requests.post(overpass_url, data=clean_query)
+            response = api_client.send('overpass', 'post', overpass_url, data=clean_query)
             response.raise_for_status()
             data = response.json()
             
@@ -41,60 +49,163 @@ out count;"""
         except requests.exceptions.RequestException as e:
             logger.log(f"API request failed (Attempt {attempt + 1}/{max_retries}): {e}")
             if attempt < max_retries - 1:
+                api_client.record_retry('overpass')
                 logger.log(f"Retrying in {delay} seconds...")
                 time.sleep(delay)
                 delay *= 2
             else:
                 logger.log(f"Max retries reached. Failed to fetch shop count for {lat}, {lon}.")
-                return 0
+                return failure_value
         except json.JSONDecodeError as e:
             logger.log(f"Failed to decode JSON response (Attempt {attempt + 1}/{max_retries}): {e}")
             if attempt < max_retries - 1:
+                api_client.record_retry('overpass')
                 logger.log(f"Retrying in {delay} seconds...")
                 time.sleep(delay)
                 delay *= 2
             else:
                 logger.log(f"Max retries reached. Invalid JSON response for {lat}, {lon}.")
-                return 0
+                return failure_value
         
-    return 0
+    return failure_value
 
-def nearby_shops_enrichment(input_json_file = helper.affix_root_path("enrich/enriched_stops_data_oas.json"), 
-                            output_json_file = helper.affix_root_path("enriched_stops_data_shops.json")):
+def get_shop_counts(coordinates, radius=500, batch_size=25, max_retries=3, initial_delay=1, overpass_url=None, max_workers=1, progress=None):
     """
-    Uses the enriched_stops_data_oas.json file to enrich the data using nearby shop counts using the overpass api.
+    Fetches shop counts for many (latitude, longitude) pairs, sending one Overpass query per
+    batch with a separate 'out count' statement for each coordinate. Returns a list of counts
+    aligned to the input; batches that fail are retried one coordinate at a time.
+    With max_workers > 1, up to that many batches are in flight at once under the shared Overpass rate limit.
+    progress, if given, is called with the number of coordinates in each batch as it completes.
     """
-    try:
-        with open(input_json_file, 'r') as f:
-            stops_data = json.load(f)
+    overpass_url = overpass_url or DEFAULT_OVERPASS_API_URL
+    coordinates = list(coordinates)
 
-        logger.log(f"Processing {len(stops_data)} bus stops...")
-        enriched_stops = {}
-        
-        for stop_id, stop_info in tqdm(stops_data.items(), desc="Nearby shops processing"):
-            logger.log(f"Processing stop ID: {stop_id} at ({stop_info['stop_lat']}, {stop_info['stop_lon']})...")
-            
-            shop_count = get_shop_count(stop_info['stop_lat'], stop_info['stop_lon'])
-            
-            if shop_count is not None:
-                stop_info['shops_nearby_count'] = shop_count
-                enriched_stops[stop_id] = stop_info
-                logger.log(f"Found {shop_count} shops.")
-            else:
-                stop_info['shops_nearby_count'] = -1
-                enriched_stops[stop_id] = stop_info
-                logger.log("API call failed, count not added.")
-                
-            time.sleep(0.3)
+    def fetch_batch(batch):
+        counts = fetch_counts(batch)
+        if progress is not None:
+            progress(len(batch))
+        return counts
+
+    def fetch_counts(batch):
+        statements = "\n".join(
+f"""(
+  node["shop"](around:{radius}, {lat}, {lon});
+  way["shop"](around:{radius}, {lat}, {lon});
+  relation["shop"](around:{radius}, {lat}, {lon});
+);
+out count;"""
+            for lat, lon in batch
+        )
+        clean_query = f"[out:json][timeout:180];\n{statements}".strip()
+
+        delay = initial_delay
+        for attempt in range(max_retries):
+            try:
+                response = api_client.send('overpass', 'post', overpass_url, data=clean_query)
+                response.raise_for_status()
+                elements = [element for element in response.json().get("elements", []) if element.get("type") == "count"]
+                if len(elements) != len(batch):
+                    raise ValueError(f"expected {len(batch)} counts, got {len(elements)}")
+                return [int(element["tags"].get("total", 0)) for element in elements]
+            except (requests.exceptions.RequestException, json.JSONDecodeError, ValueError, KeyError) as e:
+                logger.log(f"Batch API request failed (Attempt {attempt + 1}/{max_retries}): {e}")
+                if attempt < max_retries - 1:
+                    api_client.record_retry('overpass')
+                    logger.log(f"Retrying in {delay} seconds...")
+                    time.sleep(delay)
+                    delay *= 2
+
+        logger.log(f"Max retries reached for batch of {len(batch)} coordinates. Falling back to single queries.")
+        return [get_shop_count(lat, lon, radius=radius, max_retries=max_retries, initial_delay=initial_delay, overpass_url=overpass_url) for lat, lon in batch]
+
+    batches = [coordinates[batch_start:batch_start + batch_size] for batch_start in range(0, len(coordinates), batch_size)]
+    if max_workers > 1 and len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            batch_counts = list(executor.map(fetch_batch, batches))
+    else:
+        batch_counts = [fetch_batch(batch) for batch in batches]
+
+    return [count for counts in batch_counts for count in counts]
+
+def nearby_shops_enrichment(input_json_file = helper.affix_root_path("enrich/enriched_stops_data_oas.parquet"), 
+                            output_json_file = helper.affix_root_path("enriched_stops_data_shops.parquet"),
+                            resume=True,
+                            max_stops=None,
+                            dedup_tolerance_m=spatial_dedup.DEFAULT_TOLERANCE_M,
+                            export_formats=()):
+    """
+    Uses the enriched_stops_data_oas file to enrich the data using nearby shop counts using the overpass api.
+    Each result is appended to a JSONL checkpoint as it completes, so a restarted run
+    skips stops already done. Set max_stops to process the remaining stops in chunks;
+    the final file is only written once every stop has been processed.
+    export_formats can add 'json'/'csv' copies of the output.
+    Stops within dedup_tolerance_m of each other share a single Overpass query.
+    Stops whose lookup fails are not checkpointed, so the next run retries them.
+    """
+    checkpoint_file = None
+    try:
+        stops_data = artifacts.read_stop_records(input_json_file, 'stops_oas')
 
         output_dir = os.path.dirname(input_json_file)
         if not output_dir:
             output_dir = "."
         os.makedirs(output_dir, exist_ok=True)
         output_file_path = os.path.join(output_dir, output_json_file)
+        checkpoint_path = checkpoint.checkpoint_path_for(output_file_path)
+
+        logger.log(f"Processing {len(stops_data)} bus stops...")
+        enriched_stops = checkpoint.load_checkpoint(checkpoint_path) if resume else {}
+        checkpoint_file = checkpoint.open_checkpoint(checkpoint_path, resume=resume)
+
+        pending_stops = [(stop_id, stop_info) for stop_id, stop_info in stops_data.items() if stop_id not in enriched_stops]
+        logger.log(f"{len(stops_data) - len(pending_stops)} stops already in checkpoint, {len(pending_stops)} remaining.")
+        if max_stops is not None:
+            pending_stops = pending_stops[:max_stops]
+
+        representative_of = spatial_dedup.cluster_stop_ids(
+            list(stops_data.keys()),
+            [stop_info['stop_lat'] for stop_info in stops_data.values()],
+            [stop_info['stop_lon'] for stop_info in stops_data.values()],
+            dedup_tolerance_m
+        )
+        count_by_representative = {}
+        for stop_id, stop_info in enriched_stops.items():
+            count_by_representative.setdefault(representative_of.get(stop_id, stop_id), stop_info.get('shops_nearby_count'))
+        lookups_made = 0
+        failed_stops = 0
+        
+        for stop_id, stop_info in tqdm(pending_stops, desc="Nearby shops processing"):
+            logger.log(f"Processing stop ID: {stop_id} at ({stop_info['stop_lat']}, {stop_info['stop_lon']})...")
+
+            representative = representative_of[stop_id]
+            if representative in count_by_representative:
+                shop_count = count_by_representative[representative]
+                logger.log(f"Reusing shop count from co-located stop {representative}.")
+            else:
+                shop_count = get_shop_count(stop_info['stop_lat'], stop_info['stop_lon'], failure_value=checkpoint.LOOKUP_FAILED)
+                lookups_made += 1
+                if shop_count is checkpoint.LOOKUP_FAILED:
+                    failed_stops += 1
+                    logger.log("API call failed, stop left for the next run.")
+                    continue
+                count_by_representative[representative] = shop_count
+
+            stop_info['shops_nearby_count'] = shop_count
+            logger.log(f"Found {shop_count} shops.")
+
+            checkpoint.append_checkpoint(checkpoint_file, stop_info)
+            enriched_stops[stop_id] = stop_info
+
+        spatial_dedup.report_savings("Nearby shops enrichment", len(pending_stops), lookups_made, dedup_tolerance_m)
+        if failed_stops:
+            logger.log(f"{failed_stops} shop lookups failed and were not checkpointed.")
+
+        remaining = sum(1 for stop_id in stops_data if stop_id not in enriched_stops)
+        if remaining:
+            logger.log(f"{remaining} stops still to process. Re-run to continue from checkpoint '{checkpoint_path}'.")
+            return
 
-        with open(output_file_path, 'w') as f:
-            json.dump(enriched_stops, f, indent=2)
+        checkpoint.write_final_records(enriched_stops, list(stops_data.keys()), output_file_path, 'stops_shops', export_formats)
             
         logger.log(f"\nProcessing complete! Enriched data saved to '{output_file_path}'.")
         
@@ -103,4 +214,7 @@ def nearby_shops_enrichment(input_json_file = helper.affix_root_path("enrich/enr
     except json.JSONDecodeError:
         logger.log(f"Error: The file '{input_json_file}' is not a valid JSON file.")
     except Exception as e:
-        logger.log(f"An unexpected error occurred: {e}")
\ No newline at end of file
+        logger.log(f"An unexpected error occurred: {e}")
+    finally:
+        if checkpoint_file:
+            checkpoint_file.close()
\ No newline at end of file
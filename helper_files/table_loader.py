@@ -0,0 +1,151 @@
+# table_loader.py
+
+import os
+import tempfile
+import time
+import pandas as pd
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+
+LOAD_METHODS = ('auto', 'local_infile', 'insert')
+INSERT_BATCH_SIZE = 5000
+# Indexed text columns need a bounded length; GTFS ids fit comfortably.
+KEY_COLUMN_TYPE = "VARCHAR(255)"
+
+def column_definitions(df, index_columns=()):
+    """MySQL column definitions for a DataFrame: DOUBLE, BIGINT or TINYINT(1) by dtype, TEXT otherwise."""
+    definitions = []
+    for column in df.columns:
+        dtype = df[column].dtype
+        if column in index_columns:
+            sql_type = KEY_COLUMN_TYPE
+        elif pd.api.types.is_bool_dtype(dtype):
+            sql_type = "TINYINT(1)"
+        elif pd.api.types.is_integer_dtype(dtype):
+            sql_type = "BIGINT"
+        elif pd.api.types.is_float_dtype(dtype):
+            sql_type = "DOUBLE"
+        else:
+            sql_type = "TEXT"
+        definitions.append(f"`{column}` {sql_type}")
+    return ", ".join(definitions)
+
+def _python_rows(df):
+    """Rows of plain Python values with None for missing ones, as the connector expects."""
+    rows = []
+    for row in df.itertuples(index=False, name=None):
+        rows.append(tuple(None if pd.isna(value) else (value.item() if hasattr(value, 'item') else value) for value in row))
+    return rows
+
+def write_load_file(df, path):
+    """
+    Writes df as a CSV that LOAD DATA reads back exactly: missing values as \\N and backslashes in
+    text escaped, with fields quoted only where needed.
+    """
+    text = df.copy()
+    for column in text.columns:
+        if pd.api.types.is_bool_dtype(text[column].dtype):
+            text[column] = text[column].astype('Int8')
+        elif not pd.api.types.is_numeric_dtype(text[column].dtype):
+            values = text[column].astype(object)
+            text[column] = values.where(values.notna(), None).map(lambda value: value if value is None else str(value).replace('\\', '\\\\'))
+    text.to_csv(path, index=False, na_rep='\\N', lineterminator='\n')
+
+def load_local_infile(cursor, df, staging_table):
+    """Loads df into staging_table with client-side LOAD DATA LOCAL INFILE."""
+    handle, path = tempfile.mkstemp(suffix=".csv")
+    os.close(handle)
+    try:
+        write_load_file(df, path)
+        columns = ", ".join(f"`{column}`" for column in df.columns)
+        cursor.execute(
+            f"LOAD DATA LOCAL INFILE %s INTO TABLE `{staging_table}` CHARACTER SET utf8mb4 "
+            f"FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '\"' ESCAPED BY '\\\\' "
+            f"LINES TERMINATED BY '\\n' IGNORE 1 ROWS ({columns})",
+            (path.replace('\\', '/'),))
+    finally:
+        os.remove(path)
+
+def insert_batches(cursor, df, staging_table, batch_size=INSERT_BATCH_SIZE):
+    """Inserts df into staging_table as multi-row INSERTs of batch_size rows (executemany batches them)."""
+    columns = ", ".join(f"`{column}`" for column in df.columns)
+    statement = f"INSERT INTO `{staging_table}` ({columns}) VALUES ({', '.join(['%s'] * len(df.columns))})"
+    for start in range(0, len(df), batch_size):
+        cursor.executemany(statement, _python_rows(df.iloc[start:start + batch_size]))
+
+def table_exists(cursor, table):
+    cursor.execute("SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = DATABASE() AND table_name = %s", (table,))
+    return cursor.fetchone()[0] > 0
+
+def bulk_load_table(db_config, df, table, index_columns=(), method='auto', batch_size=INSERT_BATCH_SIZE):
+    """
+    Replaces a table with the contents of df without readers ever seeing it half loaded: rows go
+    into a fresh staging table, its indexes are built once loading is done, and a single RENAME
+    TABLE swaps it in for the old table (which is then dropped).
+    method 'local_infile' uses client-side LOAD DATA LOCAL INFILE (the server needs local_infile=ON),
+    'insert' uses batched multi-row INSERTs in one transaction, and 'auto' tries the first and falls
+    back to the second. Returns a dict with the table, rows, method used and seconds, or None on failure.
+    """
+    if method not in LOAD_METHODS:
+        raise ValueError(f"Unknown load method '{method}'. Use one of {list(LOAD_METHODS)}.")
+    start_time = time.time()
+    staging_table = f"{table}_staging"
+    old_table = f"{table}_old"
+
+    conn, dict_cursor = dp.connect_to_mysql(db_config, allow_local_infile=method != 'insert')
+    if conn is None:
+        return None
+    dict_cursor.close()
+    cursor = conn.cursor()
+
+    try:
+        cursor.execute(f"DROP TABLE IF EXISTS `{staging_table}`")
+        cursor.execute(f"CREATE TABLE `{staging_table}` ({column_definitions(df, index_columns)}) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4")
+
+        used_method = None
+        if method in ('auto', 'local_infile'):
+            try:
+                load_local_infile(cursor, df, staging_table)
+                conn.commit()
+                used_method = 'local_infile'
+            except mysql.connector.Error as err:
+                if method == 'local_infile':
+                    raise
+                logger.log(f"LOAD DATA LOCAL is not available ({err}). Falling back to batched inserts.")
+                conn.rollback()
+                cursor.execute(f"TRUNCATE TABLE `{staging_table}`")
+        if used_method is None:
+            insert_batches(cursor, df, staging_table, batch_size)
+            conn.commit()
+            used_method = 'insert'
+
+        cursor.execute(f"SELECT COUNT(*) FROM `{staging_table}`")
+        loaded_rows = cursor.fetchone()[0]
+        if loaded_rows != len(df):
+            raise mysql.connector.Error(msg=f"Loaded {loaded_rows} rows into '{staging_table}' but expected {len(df)}.")
+
+        if index_columns:
+            cursor.execute(f"ALTER TABLE `{staging_table}` " + ", ".join(f"ADD INDEX `idx_{column}` (`{column}`)" for column in index_columns))
+
+        if table_exists(cursor, table):
+            cursor.execute(f"DROP TABLE IF EXISTS `{old_table}`")
+            cursor.execute(f"RENAME TABLE `{table}` TO `{old_table}`, `{staging_table}` TO `{table}`")
+            cursor.execute(f"DROP TABLE `{old_table}`")
+        else:
+            cursor.execute(f"RENAME TABLE `{staging_table}` TO `{table}`")
+    except mysql.connector.Error as err:
+        logger.log(f"Database error while loading '{table}': {err}. '{table}' was left unchanged.")
+        try:
+            conn.rollback()
+            cursor.execute(f"DROP TABLE IF EXISTS `{staging_table}`")
+        except mysql.connector.Error:
+            pass
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+    summary = {'table': table, 'rows': len(df), 'method': used_method, 'seconds': round(time.time() - start_time, 1)}
+    logger.log(f"Loaded {len(df)} rows into '{table}' with {used_method} in {summary['seconds']}s.")
+    return summary
@@ -0,0 +1,127 @@
+# trip_cube.py
+
+import json
+import time
+import numpy as np
+import pandas as pd
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.artifacts as artifacts
+import helper_files.trips_enriched as te
+
+DEFAULT_OUTPUT_PATH = helper.affix_root_path("data/trip_cube.parquet")
+DAYS = ['monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday']
+DIMENSIONS = ['route_id', 'route_short_name', 'direction_id', 'day_of_week', 'departure_hour']
+
+# Measures that add up across cells; trip_convenience_score is averaged over scored_trips instead.
+ADDITIVE_MEASURES = ['trips', 'total_distance_km', 'estimated_fuel_usage_liters', 'total_idle_seconds', 'scored_trips']
+
+TRIP_COLUMNS = ['trip_id', 'route_id', 'service_id', 'direction_id', 'total_distance_km',
+                'estimated_fuel_usage_liters', 'total_idle_seconds', 'trip_convenience_score']
+
+def service_days(calendar_df):
+    """Turns the calendar's weekday flags into one (service_id, day_of_week) row per day the service runs."""
+    days = calendar_df.melt(id_vars='service_id', value_vars=DAYS, var_name='day_of_week', value_name='runs')
+    days = days[pd.to_numeric(days['runs'], errors='coerce') == 1]
+    return days[['service_id', 'day_of_week']].drop_duplicates()
+
+def build_cube(trips_df, first_departures_df, calendar_df, routes_df=None):
+    """
+    Aggregates enriched trips by route, direction, service day and departure hour. A trip counts
+    once for every weekday its service runs on in the calendar; its hour is that of its first
+    departure (GTFS hours past midnight stay as 24, 25, ... so they remain on their service day).
+    Returns one row per cell with trip counts, total distance, fuel and idle time, and the mean
+    convenience score over the scored_trips that have one.
+    """
+    trips = trips_df.merge(first_departures_df, on='trip_id', how='left')
+    trips['departure_hour'] = pd.to_numeric(trips['first_departure_seconds'], errors='coerce') // 3600
+    trips = trips.merge(service_days(calendar_df), on='service_id', how='inner')
+    if routes_df is not None:
+        trips = trips.merge(routes_df[['route_id', 'route_short_name']].drop_duplicates('route_id'), on='route_id', how='left')
+    else:
+        trips['route_short_name'] = None
+
+    scores = pd.to_numeric(trips['trip_convenience_score'], errors='coerce')
+    trips['scored_trips'] = scores.notna().astype(int)
+    trips['convenience_score_sum'] = scores.fillna(0)
+    grouped = trips.groupby(DIMENSIONS, dropna=False, sort=False)
+    cube = grouped.agg(
+        trips=('trip_id', 'size'),
+        total_distance_km=('total_distance_km', 'sum'),
+        estimated_fuel_usage_liters=('estimated_fuel_usage_liters', 'sum'),
+        total_idle_seconds=('total_idle_seconds', 'sum'),
+        scored_trips=('scored_trips', 'sum'),
+        convenience_score_sum=('convenience_score_sum', 'sum'),
+    ).reset_index()
+    return _finish(cube)
+
+def _finish(cube):
+    """Derives the mean convenience score from its running sum and orders the cells for reading."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cube['trip_convenience_score'] = np.where(cube['scored_trips'] > 0, cube['convenience_score_sum'] / cube['scored_trips'], np.nan)
+    cube = cube.drop(columns='convenience_score_sum')
+    day_order = {day: position for position, day in enumerate(DAYS)}
+    cube = cube.sort_values([column for column in DIMENSIONS if column in cube],
+                            key=lambda values: values.map(day_order) if values.name == 'day_of_week' else values)
+    return cube.reset_index(drop=True)
+
+def rollup(cube_df, by):
+    """
+    Re-aggregates the cube to coarser dimensions (e.g. ['route_id', 'day_of_week']) without going
+    back to trip-level data: additive measures are summed and the convenience score is re-weighted
+    by scored_trips.
+    """
+    cube = cube_df.copy()
+    cube['convenience_score_sum'] = cube['trip_convenience_score'].fillna(0) * cube['scored_trips']
+    rolled = cube.groupby(list(by), dropna=False, sort=False)[ADDITIVE_MEASURES + ['convenience_score_sum']].sum().reset_index()
+    return _finish(rolled)
+
+def build_trip_cube(config=helper.affix_root_path("config.json"),
+                    trips_enriched_path=helper.affix_root_path("data/trips_enriched.csv"),
+                    output_filename=DEFAULT_OUTPUT_PATH,
+                    export_formats=()):
+    """
+    Builds the route/direction/day/hour cube from trips_enriched, the calendar, routes and each
+    trip's first stop_times departure, and writes it as a small columnar extract for dashboards
+    and ad-hoc queries. Returns the cube, or None on failure.
+    """
+    logger.log("Building trip analytics cube...")
+    start_time = time.time()
+
+    try:
+        with open(config) as json_file:
+            db_config = json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config}' not found for trip cube build.")
+        return None
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config}' for trip cube build.")
+        return None
+
+    try:
+        trips = artifacts.read_artifact(trips_enriched_path, columns=TRIP_COLUMNS, schema_name='trips_enriched')
+    except (FileNotFoundError, ValueError, KeyError) as e:
+        logger.log(f"Error: Could not read enriched trips from '{trips_enriched_path}': {e}")
+        return None
+
+    conn, cursor = dp.connect_to_mysql(db_config)
+    if conn is None:
+        logger.log("Failed to connect to the database. Exiting.")
+        return None
+    try:
+        calendar = te.get_df_from_query(cursor, f"SELECT service_id, {', '.join(DAYS)} FROM calendar")
+        routes = te.get_df_from_query(cursor, "SELECT route_id, route_short_name FROM routes")
+        first_departures = te.get_df_from_query(cursor, "SELECT trip_id, MIN(TIME_TO_SEC(departure_time)) AS first_departure_seconds FROM stop_times GROUP BY trip_id")
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during trip cube build: {err}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+    cube = build_cube(trips, first_departures, calendar, routes)
+    cube = artifacts.write_artifact(cube, output_filename, schema_name='trip_cube', export_formats=export_formats)
+    logger.log(f"Trip cube with {len(cube)} cells from {len(trips)} trips written to '{output_filename}' in {time.time() - start_time:.1f}s.")
+    return cube
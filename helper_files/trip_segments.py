@@ -0,0 +1,280 @@
+# trip_segments.py
+
+import json
+import time
+import numpy as np
+import pandas as pd
+import mysql.connector
+import helper_files.data_pipeline as dp
+import helper_files.logger as logger
+import helper_files.helper as helper
+import helper_files.artifacts as artifacts
+import helper_files.shape_distance as shape_distance
+import helper_files.shape_cache as shape_cache
+import helper_files.stop_index as stop_index
+import helper_files.trips_enriched as te
+
+DEFAULT_OUTPUT_PATH = helper.affix_root_path("data/trip_segments.parquet")
+
+# Stops further than this from every vertex of their trip's shape are measured in a straight line instead.
+MAX_SNAP_DISTANCE_M = 200
+# On loops and out-and-back shapes a stop can be near several parts of the shape; the earliest part
+# (after the previous stop) within this much of the nearest vertex is taken.
+SNAP_TOLERANCE_M = 25
+
+# Units feeds use for shape_dist_traveled, in km per unit. The unit is recognised by comparing a shape's
+# shape_dist_traveled span with its measured length; shapes whose ratio matches none are measured instead.
+SHAPE_DIST_UNITS_KM = {'km': 1.0, 'm': 0.001, 'mi': 1.609344, 'ft': 0.0003048}
+SHAPE_DIST_UNIT_TOLERANCE = 0.1
+
+DISTANCE_SOURCES = ['shape_dist_traveled', 'shape', 'straight_line']
+_STRAIGHT_LINE = DISTANCE_SOURCES.index('straight_line')
+
+def shape_dist_traveled_km(shape_dist, measured_km):
+    """
+    Converts one shape's shape_dist_traveled values (in point order) to km from its first point,
+    or returns None if they are missing, decrease anywhere or are in no recognisable unit.
+    measured_km is the shape's cumulative measured length at each point.
+    """
+    values = pd.to_numeric(pd.Series(shape_dist), errors='coerce').to_numpy(dtype=float)
+    if len(values) < 2 or np.isnan(values).any() or (np.diff(values) < 0).any():
+        return None
+    span = values[-1] - values[0]
+    if span <= 0 or measured_km[-1] <= 0:
+        return None
+    ratio = measured_km[-1] / span
+    for km_per_unit in SHAPE_DIST_UNITS_KM.values():
+        if abs(ratio / km_per_unit - 1) <= SHAPE_DIST_UNIT_TOLERANCE:
+            return (values - values[0]) * km_per_unit
+    return None
+
+def snap_to_shape(vertex_xy, stop_xy, max_distance_m=MAX_SNAP_DISTANCE_M, tolerance_m=SNAP_TOLERANCE_M):
+    """
+    Finds the shape vertex for each of a trip's stops (projected metres, in stop order), keeping the
+    stops in order along the shape. All stop-to-vertex distances are computed at once; when the plain
+    nearest vertices already run in order they are used as they are, otherwise (loops, out-and-back
+    shapes) the stops are walked in order, each taking the earliest vertex at or after the previous
+    stop's that is within tolerance_m of the nearest such vertex.
+    Returns vertex positions, with -1 for stops more than max_distance_m from the shape or without a location.
+    """
+    positions = np.full(len(stop_xy), -1, dtype=np.int64)
+    if len(vertex_xy) == 0 or len(stop_xy) == 0:
+        return positions
+
+    distances = np.hypot(stop_xy[:, None, 0] - vertex_xy[None, :, 0], stop_xy[:, None, 1] - vertex_xy[None, :, 1])
+    distances[np.isnan(distances)] = np.inf
+    nearest = distances.argmin(axis=1)
+    snapped = distances[np.arange(len(stop_xy)), nearest] <= max_distance_m
+    if (np.diff(nearest[snapped]) >= 0).all():
+        positions[snapped] = nearest[snapped]
+        return positions
+
+    previous = 0
+    for stop in np.flatnonzero(snapped):
+        remaining = distances[stop, previous:]
+        best = remaining.min()
+        if best > max_distance_m:
+            continue
+        close = remaining <= best + tolerance_m
+        start = int(np.argmax(close))
+        end = start + (int(np.argmin(close[start:])) if not close[start:].all() else len(close) - start)
+        previous += start + int(np.argmin(remaining[start:end]))
+        positions[stop] = previous
+    return positions
+
+class ShapeProjector:
+    """
+    Places stops along their trip's shape, in km from the shape's first point. Shapes and stops are
+    projected once, and each distinct (shape, stop sequence) pattern is snapped once, since most
+    trips repeat a pattern. Distances along a shape come from shape_dist_traveled where it is usable,
+    otherwise from the shape distance cache.
+    """
+    def __init__(self, shapes_df, stops_df, distance_cache=None):
+        order, self.shape_ids, self.offsets = shape_distance.shape_point_order(shapes_df)
+        self.shape_positions = {shape_id: position for position, shape_id in enumerate(self.shape_ids)}
+        lats = pd.to_numeric(shapes_df['shape_pt_lat'], errors='coerce').to_numpy(dtype=float)[order]
+        lons = pd.to_numeric(shapes_df['shape_pt_lon'], errors='coerce').to_numpy(dtype=float)[order]
+        self.vertex_xy = stop_index.project(lats, lons)
+
+        distance_cache = distance_cache or shape_cache.get_cache()
+        distance_cache.distances(shapes_df)
+        distance_cache.save()
+        measured = [distance_cache.cumulative_km(shape_id) for shape_id in self.shape_ids]
+        shape_dist = shapes_df['shape_dist_traveled'].to_numpy()[order] if 'shape_dist_traveled' in shapes_df else None
+
+        along = []
+        self.sources = np.zeros(len(self.shape_ids), dtype=np.int8)
+        for position, (start, end) in enumerate(zip(self.offsets[:-1], self.offsets[1:])):
+            km = shape_dist_traveled_km(shape_dist[start:end], measured[position]) if shape_dist is not None else None
+            if km is None:
+                km = measured[position]
+                self.sources[position] = DISTANCE_SOURCES.index('shape')
+            along.append(km)
+        self.along_km = np.concatenate(along) if along else np.zeros(0)
+
+        self.stop_lookup = {stop_id: row for row, stop_id in enumerate(stops_df['stop_id'])}
+        self.stop_lats = pd.to_numeric(stops_df['stop_lat'], errors='coerce').to_numpy(dtype=float)
+        self.stop_lons = pd.to_numeric(stops_df['stop_lon'], errors='coerce').to_numpy(dtype=float)
+        self.stop_xy = stop_index.project(self.stop_lats, self.stop_lons)
+        self.patterns = {}
+
+    def stop_rows(self, stop_ids):
+        """Positions of stop_ids in the stops table, with -1 for unknown stops."""
+        return np.array([self.stop_lookup.get(stop_id, -1) for stop_id in stop_ids], dtype=np.int64)
+
+    def stop_coordinates(self, stop_ids):
+        """Returns (lats, lons) of stop_ids, NaN for unknown stops."""
+        rows = self.stop_rows(stop_ids)
+        known = rows >= 0
+        return np.where(known, self.stop_lats[rows], np.nan), np.where(known, self.stop_lons[rows], np.nan)
+
+    def stop_distances(self, shape_id, stop_ids):
+        """
+        Returns (km along the shape for each stop, NaN where a stop could not be placed, distance source code)
+        for a trip's stops in order.
+        """
+        key = (shape_id, stop_ids)
+        pattern = self.patterns.get(key)
+        if pattern is not None:
+            return pattern
+
+        position = self.shape_positions.get(shape_id)
+        if position is None:
+            pattern = (np.full(len(stop_ids), np.nan), _STRAIGHT_LINE)
+        else:
+            start, end = self.offsets[position], self.offsets[position + 1]
+            rows = self.stop_rows(stop_ids)
+            stop_xy = np.where((rows >= 0)[:, None], self.stop_xy[rows], np.nan)
+            vertices = snap_to_shape(self.vertex_xy[start:end], stop_xy)
+            pattern = (np.where(vertices >= 0, self.along_km[start + vertices], np.nan), self.sources[position])
+        self.patterns[key] = pattern
+        return pattern
+
+def trip_segments(stop_times_df, trips_df, projector):
+    """
+    Builds the stop-to-stop segments of complete trips. stop_times_df has trip_id, stop_id,
+    arrival_seconds and departure_seconds, ordered by trip and stop_sequence; trips_df is indexed by
+    trip_id with route_id, service_id, direction_id and shape_id.
+    Each segment's distance is the difference of its stops' positions along the shape, or the straight
+    line between them where either stop could not be placed or the positions run backwards. Run time is
+    the next stop's arrival minus this stop's departure; speed is NaN where the run time is not positive.
+    """
+    trip_ids = stop_times_df['trip_id'].to_numpy()
+    stop_ids = stop_times_df['stop_id'].to_numpy()
+    starts = np.flatnonzero(np.r_[True, trip_ids[1:] != trip_ids[:-1]])
+    ends = np.r_[starts[1:], len(trip_ids)]
+    trip_info = trips_df.reindex(trip_ids[starts])
+
+    along = np.empty(len(trip_ids))
+    sources = np.empty(len(trip_ids), dtype=np.int8)
+    for shape_id, start, end in zip(trip_info['shape_id'].to_numpy(), starts, ends):
+        along[start:end], sources[start:end] = projector.stop_distances(shape_id, tuple(stop_ids[start:end]))
+
+    from_rows = np.flatnonzero(trip_ids[1:] == trip_ids[:-1])
+    to_rows = from_rows + 1
+    along_km = along[to_rows] - along[from_rows]
+    on_shape = np.isfinite(along_km) & (along_km >= 0)
+    lats, lons = projector.stop_coordinates(stop_ids)
+    straight_km = shape_distance.point_distances_km(lats[from_rows], lons[from_rows], lats[to_rows], lons[to_rows])
+    distance_km = np.where(on_shape, along_km, straight_km)
+    source = np.where(on_shape, sources[from_rows], _STRAIGHT_LINE)
+
+    arrival = pd.to_numeric(stop_times_df['arrival_seconds'], errors='coerce').to_numpy(dtype=float)
+    departure = pd.to_numeric(stop_times_df['departure_seconds'], errors='coerce').to_numpy(dtype=float)
+    run_seconds = arrival[to_rows] - departure[from_rows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed_kmh = np.where(run_seconds > 0, distance_km / (run_seconds / 3600), np.nan)
+
+    trip_rows = np.repeat(np.arange(len(starts)), ends - starts)[from_rows]
+    segments = pd.DataFrame({
+        'trip_id': trip_ids[from_rows],
+        'route_id': trip_info['route_id'].to_numpy()[trip_rows],
+        'service_id': trip_info['service_id'].to_numpy()[trip_rows],
+        'direction_id': trip_info['direction_id'].to_numpy()[trip_rows],
+        'shape_id': trip_info['shape_id'].to_numpy()[trip_rows],
+        'segment_index': from_rows - starts[trip_rows],
+        'from_stop_id': stop_ids[from_rows],
+        'to_stop_id': stop_ids[to_rows],
+        'departure_seconds': departure[from_rows],
+        'run_seconds': run_seconds,
+        'distance_km': distance_km,
+        'speed_kmh': speed_kmh,
+        'distance_source': np.asarray(DISTANCE_SOURCES, dtype=object)[source],
+    })
+    return artifacts.apply_schema(segments, 'trip_segments')
+
+def build_trip_segments(config=helper.affix_root_path("config.json"),
+                        output_filename=DEFAULT_OUTPUT_PATH,
+                        chunk_size=te.DEFAULT_CHUNK_SIZE,
+                        export_formats=(),
+                        shape_cache_path=shape_cache.DEFAULT_CACHE_PATH):
+    """
+    Builds the stop-to-stop segment table for every trip in the feed: distance, scheduled run time
+    and speed of each segment, with its trip, route, service and direction. trips, stops and shapes
+    are read whole; stop_times is streamed chunk_size rows at a time in trip order.
+    Returns the segments DataFrame, or None on failure.
+    """
+    logger.log("Building trip segments...")
+    start_time = time.time()
+
+    try:
+        with open(config) as json_file:
+            db_config = json.load(json_file)
+    except FileNotFoundError:
+        logger.log(f"Error: Config file '{config}' not found for trip segment build.")
+        return None
+    except json.JSONDecodeError:
+        logger.log(f"Error: Could not decode JSON from config file '{config}' for trip segment build.")
+        return None
+
+    conn, cursor = dp.connect_to_mysql(db_config)
+    if conn is None:
+        logger.log("Failed to connect to the database. Exiting.")
+        return None
+    try:
+        trips = te.get_df_from_query(cursor, "SELECT trip_id, route_id, service_id, direction_id, shape_id FROM trips")
+        stops = te.get_df_from_query(cursor, "SELECT stop_id, stop_lat, stop_lon FROM stops")
+        shapes = te.get_df_from_query(cursor, "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence, shape_dist_traveled FROM shapes")
+    finally:
+        cursor.close()
+        conn.close()
+
+    projector = ShapeProjector(shapes, stops, shape_cache.get_cache(shape_cache_path))
+    del shapes
+    trips = trips.drop_duplicates('trip_id').set_index('trip_id')
+
+    chunks = []
+    stop_times_query = ("SELECT trip_id, stop_id, TIME_TO_SEC(arrival_time) AS arrival_seconds, TIME_TO_SEC(departure_time) AS departure_seconds "
+                        "FROM stop_times ORDER BY BINARY trip_id, stop_sequence")
+    try:
+        for stop_times_chunk in te.stream_query_chunks(db_config, stop_times_query, 'trip_id', chunk_size):
+            chunks.append(trip_segments(stop_times_chunk, trips, projector))
+    except mysql.connector.Error as err:
+        logger.log(f"Database error while building trip segments: {err}")
+        return None
+
+    segments = pd.concat(chunks, ignore_index=True) if chunks else artifacts.apply_schema(pd.DataFrame(), 'trip_segments')
+    artifacts.write_artifact(segments, output_filename, export_formats=export_formats)
+
+    sources = segments['distance_source'].value_counts().to_dict()
+    logger.log(f"{len(segments)} segments for {segments['trip_id'].nunique()} trips ({len(projector.patterns)} stop patterns) "
+               f"written to '{output_filename}' in {time.time() - start_time:.1f}s. Distance sources: {sources}")
+    return segments
+
+def segment_hotspots(segments_df, min_trips=5):
+    """
+    Summarises segments across the feed by stop pair: trip count, median distance, median and
+    10th percentile speed and median run time. Returns the pairs with at least min_trips timed
+    trips, slowest median speed first.
+    """
+    timed = segments_df[segments_df['speed_kmh'].notna()]
+    grouped = timed.groupby(['from_stop_id', 'to_stop_id'], observed=True)
+    hotspots = pd.DataFrame({
+        'trips': grouped.size(),
+        'routes': grouped['route_id'].nunique(),
+        'distance_km': grouped['distance_km'].median(),
+        'median_run_seconds': grouped['run_seconds'].median(),
+        'median_speed_kmh': grouped['speed_kmh'].median(),
+        'p10_speed_kmh': grouped['speed_kmh'].quantile(0.1),
+    })
+    return hotspots[hotspots['trips'] >= min_trips].sort_values('median_speed_kmh').reset_index()
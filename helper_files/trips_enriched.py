@@ -1,25 +1,44 @@
 # trips_enriched.py
 
 import pandas as pd
-from geopy.distance import geodesic
 import numpy as np
 import mysql.connector
 import json
+import hashlib
+import io
 import helper_files.data_pipeline as dp
 import helper_files.logger as logger
 import math
 import os
+import time
+import tracemalloc
 import helper_files.helper as helper
+import helper_files.shape_distance as shape_distance
+import helper_files.shape_cache as shape_cache
+import helper_files.fuel_model as fuel_model
+import helper_files.artifacts as artifacts
+import helper_files.table_loader as table_loader
 
-def calculate_shape_distance(points_df):
-    """Calculates the total geodesic distance for a single shape."""
-    total_distance = 0
-    if len(points_df) > 1:
-        for i in range(len(points_df) - 1):
-            point1 = (points_df.iloc[i]['shape_pt_lat'], points_df.iloc[i]['shape_pt_lon'])
-            point2 = (points_df.iloc[i+1]['shape_pt_lat'], points_df.iloc[i+1]['shape_pt_lon'])
-            total_distance += geodesic(point1, point2).km
-    return total_distance
+DEFAULT_CHUNK_SIZE = 100000
+
+# Bump when the enrichment itself changes, so incremental runs recompute every trip once.
+FINGERPRINT_VERSION = 1
+ID_BATCH_SIZE = 10000
+# Above this share of changed trips an incremental run re-enriches every trip in one pass instead.
+INCREMENTAL_MAX_SHARE = 0.5
+
+TRIPS_ENRICHED_TABLE = "trips_enriched"
+TRIPS_ENRICHED_INDEX_COLUMNS = ['trip_id', 'route_id', 'service_id', 'shape_id', 'block_id']
+GROUP_CONCAT_MAX_LEN = 1 << 30
+TRIP_TABLE_COLUMNS = ['route_id', 'service_id', 'trip_id', 'trip_headsign', 'trip_short_name', 'direction_id',
+                      'block_id', 'shape_id', 'wheelchair_accessible', 'bikes_allowed']
+
+def calculate_shape_distance(points_df, method=shape_distance.DEFAULT_METHOD):
+    """
+    Calculates the total distance in km for a single shape whose points are already in order.
+    Use shape_distance.shape_distances_km to measure many shapes at once.
+    """
+    return shape_distance.path_length_km(points_df['shape_pt_lat'], points_df['shape_pt_lon'], method)
 
 def calculate_estimated_idle_time(
     trip_row,
@@ -50,24 +69,45 @@ def calculate_estimated_idle_time(
 
     return total_estimated_dwell_time_seconds
 
-def estimate_fuel(row, fuel_rate_moving=0.47, fuel_rate_idling=2.0):
-    """Estimates fuel usage for a trip based on distance and idle time. fuel_rate_moving in L/km, fuel_rate_idling in L/h"""
-    moving_fuel = float(row['total_distance_km']) * fuel_rate_moving
-    idling_fuel = 0
-    if fuel_rate_idling != 0:
-        idling_fuel = (float(row['total_idle_seconds']) / 3600) * fuel_rate_idling
-    return moving_fuel + idling_fuel
+def estimate_idle_seconds_by_trip(
+    stop_times_df,
+    enriched_stops_df,
+    base_dwell_time_seconds=5,
+    log_dwell_time_factor=5
+):
+    """
+    Vectorised calculate_estimated_idle_time for every trip at once. The dwell time of each stop
+    is computed once from shops_nearby_count with log1p, joined onto stop_times (stops without an
+    enriched row dwell base_dwell_time_seconds) and summed per trip.
+    Returns a Series of estimated idle seconds indexed by trip_id. A negative shop count (the
+    failed lookup marker) counts as no shops, and a missing one makes the trip's total NaN, as before.
+    """
+    shops = pd.to_numeric(enriched_stops_df['shops_nearby_count'], errors='coerce')
+    shops = shops[~shops.index.duplicated(keep='first')]
+    stop_dwell_seconds = base_dwell_time_seconds + log_dwell_time_factor * np.log1p(shops.mask(shops < 0, 0))
+
+    stop_ids = stop_times_df['stop_id']
+    dwell_seconds = stop_ids.map(stop_dwell_seconds).where(stop_ids.isin(stop_dwell_seconds.index), float(base_dwell_time_seconds))
 
-def get_df_from_query(cursor, query):
+    grouped = dwell_seconds.groupby(stop_times_df['trip_id'], sort=False)
+    totals = grouped.sum()
+    totals[dwell_seconds.isna().groupby(stop_times_df['trip_id'], sort=False).any()] = np.nan
+    return totals.rename('estimated_total_idle_seconds')
+
+def get_df_from_query(cursor, query, params=None):
     """Executes a query and returns a pandas DataFrame."""
-    cursor.execute(query)
+    cursor.execute(query, params)
     data = cursor.fetchall()
     column_names = [i[0] for i in cursor.description]
     return pd.DataFrame(data, columns=column_names)
 
-def enrich_trips_from_database(db_config, fuel_rate_moving, fuel_rate_idling, output_filename = helper.affix_root_path('data/trips_enriched.csv')):
+def enrich_trips_from_database(db_config, fuel_rate_moving=None, fuel_rate_idling=None, output_filename = helper.affix_root_path('data/trips_enriched.csv'),
+                               vehicle_profiles_path=fuel_model.DEFAULT_PROFILES_PATH, shape_cache_path=shape_cache.DEFAULT_CACHE_PATH):
     """
     Connects to the database, reads GTFS tables, and enriches trips with fuel data.
+    Fuel uses each trip's vehicle profile (assigned by block or route in vehicle_profiles_path),
+    except that a given fuel_rate_moving or fuel_rate_idling applies to every trip.
+    Shape lengths come from the persistent cache at shape_cache_path; only new or changed shapes are measured.
     """
     logger.log("Connecting to the database...")
     conn, cursor = dp.connect_to_mysql(db_config)
@@ -117,9 +157,7 @@ def enrich_trips_from_database(db_config, fuel_rate_moving, fuel_rate_idling, ou
         logger.log("Database connection closed.")
 
     logger.log("Calculating total distance for each shape...")
-    shapes_sorted = shapes.sort_values(by=['shape_id', 'shape_pt_sequence'])
-    shape_distances = shapes_sorted.groupby('shape_id').apply(calculate_shape_distance).reset_index()
-    shape_distances.rename(columns={0: 'total_distance_km'}, inplace=True)
+    shape_distances = shape_cache.cached_shape_distances_km(shapes, shape_cache_path)
 
     logger.log("Calculating average convenience score for each trip...")
     trip_stop_scores_df = pd.merge(
@@ -147,12 +185,8 @@ def enrich_trips_from_database(db_config, fuel_rate_moving, fuel_rate_idling, ou
 
     trips_enriched.rename(columns={'total_idle_seconds': 'scheduled_total_idle_seconds'}, inplace=True)
 
-    trips_enriched['estimated_total_idle_seconds'] = trips_enriched.apply(
-        lambda row: calculate_estimated_idle_time(
-            row,
-            all_stop_times_df=stop_times,
-            enriched_stops_df=enriched_stops
-        ), axis=1)
+    idle_seconds_by_trip = estimate_idle_seconds_by_trip(stop_times, enriched_stops)
+    trips_enriched['estimated_total_idle_seconds'] = idle_seconds_by_trip.reindex(trips_enriched['trip_id'], fill_value=0.0).to_numpy()
 
     trips_enriched['scheduled_total_idle_seconds'] = trips_enriched['scheduled_total_idle_seconds'].astype(float)
     trips_enriched['estimated_total_idle_seconds'] = trips_enriched['estimated_total_idle_seconds'].astype(float)
@@ -162,19 +196,394 @@ def enrich_trips_from_database(db_config, fuel_rate_moving, fuel_rate_idling, ou
     trips_enriched['total_distance_km'] = trips_enriched['total_distance_km'].astype(float)
     
     logger.log("Estimating fuel usage for all trips...")
-    trips_enriched['estimated_fuel_usage_liters'] = trips_enriched.apply(
-        lambda row: estimate_fuel(row, fuel_rate_moving, fuel_rate_idling), axis=1)
+    profiles_df, assignments, default_profile = fuel_model.load_vehicle_profiles(vehicle_profiles_path)
+    trip_fuel = fuel_model.estimate_trip_fuel(trips_enriched, profiles_df, assignments, default_profile,
+                                              fuel_rate_moving=fuel_rate_moving, fuel_rate_idling=fuel_rate_idling)
+    trips_enriched['vehicle_profile'] = trip_fuel['vehicle_profile']
+    trips_enriched['estimated_fuel_usage_liters'] = trip_fuel['estimated_fuel_usage_liters']
     
     
     trips_enriched.to_csv(output_filename, index=False)
+    discard_fingerprints(output_filename)
     logger.log(f"\nTrip enrichment complete. Results saved to '{output_filename}'")
     
     return trips_enriched
 
-def generate_trips_enriched(fuel_rate_moving=0.47, fuel_rate_idling=2.0, config_file=helper.affix_root_path("config.json")):
+def stream_query_chunks(db_config, query, key_column, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Runs a query ordered by key_column on its own connection with an unbuffered cursor, so rows
+    stay on the server until fetched, and yields DataFrames of about chunk_size rows. Rows sharing
+    a key are never split across chunks: the last key of each fetch is held back until it is complete.
+    """
+    conn, dict_cursor = dp.connect_to_mysql(db_config)
+    if conn is None:
+        raise mysql.connector.Error(msg="Could not connect to the database for streaming.")
+    dict_cursor.close()
+
+    cursor = conn.cursor(buffered=False)
+    try:
+        cursor.execute(query)
+        columns = [i[0] for i in cursor.description]
+        carry = None
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunk = pd.DataFrame(rows, columns=columns)
+            if carry is not None:
+                chunk = pd.concat([carry, chunk], ignore_index=True)
+            keys = chunk[key_column].to_numpy()
+            is_last_key = keys == keys[-1]
+            carry = chunk[is_last_key]
+            if not is_last_key.all():
+                yield chunk[~is_last_key].reset_index(drop=True)
+        if carry is not None and len(carry):
+            yield carry.reset_index(drop=True)
+    finally:
+        try:
+            cursor.close()
+        except mysql.connector.Error:
+            pass
+        conn.close()
+
+def trip_stop_stats(stop_times_df, enriched_stops_df):
+    """
+    Per-trip totals from stop_times rows (trip_id, stop_id, idle_seconds): scheduled idle seconds,
+    average customer_convenience_score of the trip's stops and estimated idle seconds.
+    Returns a DataFrame indexed by trip_id.
+    """
+    trip_ids = stop_times_df['trip_id']
+    scores = stop_times_df['stop_id'].map(enriched_stops_df['customer_convenience_score'][~enriched_stops_df.index.duplicated()])
+    stats = pd.DataFrame({
+        'scheduled_total_idle_seconds': pd.to_numeric(stop_times_df['idle_seconds'], errors='coerce').astype(float).groupby(trip_ids, sort=False).sum(),
+        'trip_convenience_score': pd.to_numeric(scores, errors='coerce').astype(float).groupby(trip_ids, sort=False).mean(),
+    })
+    stats['estimated_total_idle_seconds'] = estimate_idle_seconds_by_trip(stop_times_df, enriched_stops_df)
+    return stats
+
+def finish_trip_rows(trips_df, shape_km, trip_stats_df, fuel_settings):
+    """
+    Adds distance, idle time, convenience and fuel columns to a set of trips, in the same column
+    order as the in-memory enrichment. shape_km maps shape_id to total_distance_km.
+    """
+    trips_df = trips_df.copy()
+    trips_df['total_distance_km'] = trips_df['shape_id'].map(shape_km).fillna(0).astype(float)
+    stats = trip_stats_df.reindex(trips_df['trip_id'])
+    trips_df['scheduled_total_idle_seconds'] = stats['scheduled_total_idle_seconds'].fillna(0).to_numpy(dtype=float)
+    trips_df['trip_convenience_score'] = stats['trip_convenience_score'].to_numpy()
+    trips_df['estimated_total_idle_seconds'] = stats['estimated_total_idle_seconds'].to_numpy(dtype=float)
+    trips_df['estimated_total_idle_seconds'] = trips_df['estimated_total_idle_seconds'].where(trips_df['trip_id'].isin(trip_stats_df.index), 0.0)
+    trips_df['total_idle_seconds'] = trips_df['scheduled_total_idle_seconds'] + trips_df['estimated_total_idle_seconds']
+
+    trip_fuel = fuel_model.estimate_trip_fuel(trips_df, *fuel_settings)
+    trips_df['vehicle_profile'] = trip_fuel['vehicle_profile']
+    trips_df['estimated_fuel_usage_liters'] = trip_fuel['estimated_fuel_usage_liters']
+    return trips_df
+
+def enrich_trips_streaming(db_config, fuel_rate_moving=None, fuel_rate_idling=None,
+                           output_filename=helper.affix_root_path('data/trips_enriched.csv'),
+                           vehicle_profiles_path=fuel_model.DEFAULT_PROFILES_PATH,
+                           chunk_size=DEFAULT_CHUNK_SIZE, report_memory=False, shape_cache_path=shape_cache.DEFAULT_CACHE_PATH):
+    """
+    Bounded-memory version of enrich_trips_from_database. shapes and stop_times are streamed in
+    shape_id and trip_id order, chunk_size rows at a time; only per-shape distances, the trips table
+    and stops_enriched are held in memory. Each stop_times chunk completes a set of trips, which are
+    enriched and appended to the output CSV straight away (trips with no stop_times come last).
+    The output has the same columns as the in-memory version, with rows in trip_id order.
+    Returns a dict with row and chunk counts, seconds and, with report_memory, the peak Python
+    allocation traced by tracemalloc (which slows allocations, so leave it off outside benchmarks).
+    """
+    tracing = report_memory and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start()
+    try:
+        summary = _stream_trips(db_config, fuel_rate_moving, fuel_rate_idling, output_filename,
+                                vehicle_profiles_path, chunk_size, shape_cache_path)
+        if summary is None:
+            return None
+        if report_memory:
+            summary['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+    finally:
+        if tracing:
+            tracemalloc.stop()
+    logger.log(f"\nStreaming trip enrichment complete. Results saved to '{output_filename}': {summary}")
+    return summary
+
+def _stream_trips(db_config, fuel_rate_moving, fuel_rate_idling, output_filename, vehicle_profiles_path, chunk_size, shape_cache_path):
+    """The streaming pass behind enrich_trips_streaming. Returns the row and chunk summary, or None on failure."""
+    start_time = time.time()
+    conn, cursor = dp.connect_to_mysql(db_config)
+    if conn is None:
+        logger.log("Failed to connect to the database. Exiting.")
+        return None
+    try:
+        logger.log("Reading trips and stops_enriched tables...")
+        trips = get_df_from_query(cursor, "SELECT * FROM trips")
+        enriched_stops = get_df_from_query(cursor, "SELECT stop_id, shops_nearby_count, customer_convenience_score FROM stops_enriched")
+        enriched_stops = enriched_stops.set_index('stop_id')
+    finally:
+        cursor.close()
+        conn.close()
+
+    fuel_settings = fuel_model.load_vehicle_profiles(vehicle_profiles_path) + (fuel_rate_moving, fuel_rate_idling)
+    trips_by_id = trips.set_index('trip_id', drop=False)
+    distance_cache = shape_cache.get_cache(shape_cache_path)
+    shape_km = {}
+    shape_chunks = 0
+    stop_time_chunks = 0
+    rows_written = 0
+    tmp_path = output_filename + ".tmp"
+
+    try:
+        logger.log(f"Streaming shapes in chunks of {chunk_size} rows...")
+        for shapes_chunk in stream_query_chunks(
+                db_config,
+                "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence FROM shapes ORDER BY BINARY shape_id, shape_pt_sequence",
+                'shape_id', chunk_size):
+            distances = distance_cache.distances(shapes_chunk)
+            shape_km.update(zip(distances['shape_id'], distances['total_distance_km']))
+            shape_chunks += 1
+
+        distance_cache.save()
+
+        logger.log(f"Streaming stop_times in chunks of {chunk_size} rows and enriching trips as they complete...")
+        seen_trip_ids = set()
+        stop_times_query = ("SELECT trip_id, stop_id, TIME_TO_SEC(departure_time) - TIME_TO_SEC(arrival_time) AS idle_seconds "
+                            "FROM stop_times ORDER BY BINARY trip_id, stop_sequence")
+        for stop_times_chunk in stream_query_chunks(db_config, stop_times_query, 'trip_id', chunk_size):
+            stats = trip_stop_stats(stop_times_chunk, enriched_stops)
+            chunk_trip_ids = stats.index[stats.index.isin(trips_by_id.index)]
+            seen_trip_ids.update(stats.index)
+            chunk_trips = finish_trip_rows(trips_by_id.loc[chunk_trip_ids].reset_index(drop=True), shape_km, stats, fuel_settings)
+            chunk_trips.to_csv(tmp_path, mode='w' if rows_written == 0 else 'a', header=rows_written == 0, index=False)
+            rows_written += len(chunk_trips)
+            stop_time_chunks += 1
+
+        remaining = trips[~trips['trip_id'].isin(seen_trip_ids)]
+        empty_stats = pd.DataFrame(columns=['scheduled_total_idle_seconds', 'trip_convenience_score', 'estimated_total_idle_seconds'])
+        remaining = finish_trip_rows(remaining, shape_km, empty_stats, fuel_settings)
+        remaining.to_csv(tmp_path, mode='w' if rows_written == 0 else 'a', header=rows_written == 0, index=False)
+        rows_written += len(remaining)
+    except mysql.connector.Error as err:
+        logger.log(f"Database error while streaming trip enrichment: {err}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return None
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, output_filename)
+    discard_fingerprints(output_filename)
+
+    return {'trips': rows_written, 'shapes': len(shape_km), 'shape_chunks': shape_chunks, 'stop_time_chunks': stop_time_chunks, 'chunk_size': chunk_size,
+            'seconds': round(time.time() - start_time, 1)}
+
+def _sql_text(columns, prefix=''):
+    """CONCAT_WS arguments for columns, with NULL kept distinct from an empty string."""
+    return ", ".join(f"COALESCE(CAST({prefix}{column} AS CHAR), '<null>')" for column in columns)
+
+# One row per trip with MD5s of its trips row, its stop_times (sequence, stop, times and the stop's
+# enrichment values, in stop order) and its shape points, computed in the database so only the hashes are read.
+FINGERPRINT_QUERY = f"""
+SELECT
+    t.trip_id,
+    MD5(CONCAT_WS('|', {_sql_text(TRIP_TABLE_COLUMNS, 't.')})) AS trip_hash,
+    s.stops_hash,
+    sh.shape_hash
+FROM
+    trips t
+LEFT JOIN (
+    SELECT
+        st.trip_id,
+        MD5(GROUP_CONCAT(
+            CONCAT_WS('|', {_sql_text(['stop_sequence', 'stop_id', 'arrival_time', 'departure_time'], 'st.')},
+                      {_sql_text(['shops_nearby_count', 'customer_convenience_score'], 'se.')})
+            ORDER BY st.stop_sequence SEPARATOR ';')) AS stops_hash
+    FROM
+        stop_times st
+    LEFT JOIN
+        stops_enriched se ON se.stop_id = st.stop_id
+    GROUP BY
+        st.trip_id
+) s ON s.trip_id = t.trip_id
+LEFT JOIN (
+    SELECT
+        shape_id,
+        MD5(GROUP_CONCAT(
+            CONCAT_WS(',', {_sql_text(['shape_pt_sequence', 'shape_pt_lat', 'shape_pt_lon'])})
+            ORDER BY shape_pt_sequence SEPARATOR ';')) AS shape_hash
+    FROM
+        shapes
+    GROUP BY
+        shape_id
+) sh ON sh.shape_id = t.shape_id
+"""
+
+def fingerprints_path_for(output_filename):
+    """Returns the fingerprint file that sits alongside a trips_enriched output."""
+    return os.path.splitext(output_filename)[0] + ".fingerprints.parquet"
+
+def discard_fingerprints(output_filename):
+    """Removes the fingerprints of an output that has just been rebuilt some other way, so they cannot vouch for it."""
+    fingerprints_path = fingerprints_path_for(output_filename)
+    if os.path.exists(fingerprints_path):
+        os.remove(fingerprints_path)
+
+def settings_fingerprint(fuel_settings):
+    """Hash of everything besides the database that trip rows depend on: fuel settings, distance method and version."""
+    profiles_df, assignments, default_profile, fuel_rate_moving, fuel_rate_idling = fuel_settings
+    payload = json.dumps({
+        'version': FINGERPRINT_VERSION,
+        'distance_method': shape_distance.DEFAULT_METHOD,
+        'profiles': profiles_df.to_dict(orient='index'),
+        'assignments': assignments,
+        'default_profile': default_profile,
+        'fuel_rate_moving': fuel_rate_moving,
+        'fuel_rate_idling': fuel_rate_idling,
+    }, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+def trip_fingerprints(cursor, settings_key):
+    """
+    Returns a DataFrame of trip_id and fingerprint for every trip. A fingerprint changes when the trip's
+    row, stop sequence or times, its stops' enrichment values, its shape points or the settings change.
+    """
+    cursor.execute(f"SET SESSION group_concat_max_len = {GROUP_CONCAT_MAX_LEN}")
+    hashes = get_df_from_query(cursor, FINGERPRINT_QUERY)
+    parts = hashes[['trip_hash', 'stops_hash', 'shape_hash']].astype(object).where(hashes[['trip_hash', 'stops_hash', 'shape_hash']].notna(), '')
+    combined = parts['trip_hash'].astype(str) + '|' + parts['stops_hash'].astype(str) + '|' + parts['shape_hash'].astype(str) + '|' + settings_key
+    return pd.DataFrame({
+        'trip_id': hashes['trip_id'],
+        'fingerprint': [hashlib.blake2b(value.encode('utf-8'), digest_size=16).hexdigest() for value in combined],
+    })
+
+def get_df_for_ids(cursor, query, ids):
+    """Runs a query with an '{ids}' placeholder for batches of ID_BATCH_SIZE ids and returns all rows as one DataFrame."""
+    ids = list(ids)
+    frames = []
+    for start in range(0, max(len(ids), 1), ID_BATCH_SIZE):
+        batch = ids[start:start + ID_BATCH_SIZE] or [None]
+        frames.append(get_df_from_query(cursor, query.format(ids=", ".join(["%s"] * len(batch))), tuple(batch)))
+    return pd.concat(frames, ignore_index=True)
+
+def enrich_trips_incremental(db_config, fuel_rate_moving=None, fuel_rate_idling=None,
+                             output_filename=helper.affix_root_path('data/trips_enriched.csv'),
+                             vehicle_profiles_path=fuel_model.DEFAULT_PROFILES_PATH,
+                             shape_cache_path=shape_cache.DEFAULT_CACHE_PATH):
+    """
+    Updates an existing trips_enriched output for the trips whose inputs changed since it was written.
+    Every trip's fingerprint is computed in the database and compared with the fingerprints saved
+    alongside the output; only new and changed trips are read and enriched, removed trips are dropped,
+    and all other rows are kept exactly as written. Without a previous output and its fingerprints,
+    when its columns differ, or when more than INCREMENTAL_MAX_SHARE of trips changed, every trip is
+    enriched with enrich_trips_from_database instead.
+    Returns a dict with trip, changed and removed counts and seconds, or None on failure.
+    """
+    start_time = time.time()
+    fuel_settings = fuel_model.load_vehicle_profiles(vehicle_profiles_path) + (fuel_rate_moving, fuel_rate_idling)
+    fingerprints_path = fingerprints_path_for(output_filename)
+
+    conn, cursor = dp.connect_to_mysql(db_config)
+    if conn is None:
+        logger.log("Failed to connect to the database. Exiting.")
+        return None
+
+    new_rows = None
+    try:
+        logger.log("Fingerprinting trip inputs in the database...")
+        current = trip_fingerprints(cursor, settings_fingerprint(fuel_settings))
+        changed_ids = current['trip_id'].tolist()
+        removed_ids = set()
+
+        existing = None
+        if os.path.exists(output_filename) and os.path.exists(fingerprints_path):
+            previous = artifacts.read_artifact(fingerprints_path)
+            previous_fingerprints = dict(zip(previous['trip_id'], previous['fingerprint']))
+            changed = current['fingerprint'].to_numpy() != current['trip_id'].map(previous_fingerprints).to_numpy()
+            changed_ids = current['trip_id'][changed].tolist()
+            removed_ids = set(previous['trip_id']) - set(current['trip_id'])
+            logger.log(f"{len(changed_ids)} of {len(current)} trips are new or changed; {len(removed_ids)} were removed.")
+            if not changed_ids and not removed_ids:
+                logger.log(f"'{output_filename}' is up to date.")
+                return {'trips': len(current), 'changed': 0, 'removed': 0, 'seconds': round(time.time() - start_time, 1)}
+            if len(changed_ids) <= INCREMENTAL_MAX_SHARE * len(current):
+                existing = pd.read_csv(output_filename, dtype=str, keep_default_na=False)
+        else:
+            logger.log(f"No fingerprints for '{output_filename}'.")
+
+        if existing is not None:
+            trips = get_df_for_ids(cursor, "SELECT * FROM trips WHERE trip_id IN ({ids})", changed_ids)
+            stop_times = get_df_for_ids(cursor, "SELECT trip_id, stop_id, TIME_TO_SEC(departure_time) - TIME_TO_SEC(arrival_time) AS idle_seconds "
+                                                "FROM stop_times WHERE trip_id IN ({ids}) ORDER BY trip_id, stop_sequence", changed_ids)
+            shapes = get_df_for_ids(cursor, "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence FROM shapes WHERE shape_id IN ({ids})",
+                                    trips['shape_id'].dropna().unique())
+            enriched_stops = get_df_for_ids(cursor, "SELECT stop_id, shops_nearby_count, customer_convenience_score FROM stops_enriched WHERE stop_id IN ({ids})",
+                                            stop_times['stop_id'].dropna().unique())
+    except mysql.connector.Error as err:
+        logger.log(f"Database error during incremental trip enrichment: {err}")
+        return None
+    finally:
+        cursor.close()
+        conn.close()
+
+    if existing is not None:
+        distance_cache = shape_cache.get_cache(shape_cache_path)
+        distances = distance_cache.distances(shapes)
+        distance_cache.save()
+        stats = trip_stop_stats(stop_times, enriched_stops.set_index('stop_id'))
+        new_rows = finish_trip_rows(trips, dict(zip(distances['shape_id'], distances['total_distance_km'])), stats, fuel_settings)
+        # Written and read back as text so new rows are formatted exactly as a full run would write them.
+        new_rows = pd.read_csv(io.StringIO(new_rows.to_csv(index=False)), dtype=str, keep_default_na=False)
+        if list(existing.columns) != list(new_rows.columns):
+            logger.log(f"Columns of '{output_filename}' differ from the current enrichment.")
+            new_rows = None
+
+    if new_rows is None:
+        logger.log("Enriching every trip...")
+        if enrich_trips_from_database(db_config, fuel_rate_moving, fuel_rate_idling, output_filename,
+                                      vehicle_profiles_path, shape_cache_path) is None:
+            return None
+        changed_ids = current['trip_id'].tolist()
+        trip_count = len(current)
+    else:
+        new_rows = pd.concat([existing[~existing['trip_id'].isin(set(changed_ids) | removed_ids)], new_rows], ignore_index=True)
+        trip_order = {trip_id: position for position, trip_id in enumerate(current['trip_id'])}
+        new_rows = new_rows.iloc[np.argsort(new_rows['trip_id'].map(trip_order).to_numpy(dtype=float), kind='stable')]
+        tmp_path = output_filename + ".tmp"
+        new_rows.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, output_filename)
+        trip_count = len(new_rows)
+    artifacts.write_artifact(current, fingerprints_path)
+
+    summary = {'trips': trip_count, 'changed': len(changed_ids), 'removed': len(removed_ids), 'seconds': round(time.time() - start_time, 1)}
+    logger.log(f"\nIncremental trip enrichment complete. Results saved to '{output_filename}': {summary}")
+    return summary
+
+def write_trips_enriched_to_db(db_config, trips_enriched_path=helper.affix_root_path('data/trips_enriched.csv'),
+                               table=TRIPS_ENRICHED_TABLE, method='auto'):
+    """
+    Loads the trips_enriched output into an indexed database table (trip, route, service, shape and
+    block ids), swapping it in atomically so SQL consumers never see a partial table.
+    method is 'auto', 'local_infile' or 'insert' (see table_loader.bulk_load_table).
+    """
+    try:
+        trips_enriched = artifacts.read_artifact(trips_enriched_path, schema_name='trips_enriched')
+    except (FileNotFoundError, ValueError) as e:
+        logger.log(f"Error: Could not read enriched trips from '{trips_enriched_path}': {e}")
+        return None
+    index_columns = [column for column in TRIPS_ENRICHED_INDEX_COLUMNS if column in trips_enriched]
+    return table_loader.bulk_load_table(db_config, trips_enriched, table, index_columns, method)
+
+def generate_trips_enriched(fuel_rate_moving=None, fuel_rate_idling=None, config_file=helper.affix_root_path("config.json"), chunk_size=None,
+                            incremental=False, write_to_db=False, db_load_method='auto'):
     """
     Main function to generate the enriched trips data.
-    Loads config, and runs the enrichment.
+    Loads config, and runs the enrichment. Fuel rates default to the vehicle profiles in vehicle_profiles.json.
+    With chunk_size set, shapes and stop_times are streamed chunk_size rows at a time to bound memory.
+    With incremental set, only trips whose inputs changed since the last incremental run are recomputed.
+    With write_to_db set, the result is also loaded into the trips_enriched table.
     """
     try:
         with open(config_file, 'r') as f:
@@ -183,12 +592,30 @@ def generate_trips_enriched(fuel_rate_moving=0.47, fuel_rate_idling=2.0, config_
         logger.log(f"Error loading database configuration from {config_file}: {e}")
         return None
 
-    enriched_df = enrich_trips_from_database(
-        db_config=db_config,
-        fuel_rate_moving=fuel_rate_moving,
-        fuel_rate_idling=fuel_rate_idling
-    )
-    
-    if enriched_df is not None:
-        logger.log("\nFirst 5 rows of the new 'trips_enriched' table:")
-        logger.log(enriched_df[['trip_id', 'route_id', 'shape_id', 'total_distance_km', 'scheduled_total_idle_seconds', 'estimated_total_idle_seconds', 'estimated_fuel_usage_liters', 'trip_convenience_score']].head())
+    if incremental:
+        result = enrich_trips_incremental(
+            db_config=db_config,
+            fuel_rate_moving=fuel_rate_moving,
+            fuel_rate_idling=fuel_rate_idling
+        )
+    elif chunk_size:
+        result = enrich_trips_streaming(
+            db_config=db_config,
+            fuel_rate_moving=fuel_rate_moving,
+            fuel_rate_idling=fuel_rate_idling,
+            chunk_size=chunk_size
+        )
+    else:
+        result = enrich_trips_from_database(
+            db_config=db_config,
+            fuel_rate_moving=fuel_rate_moving,
+            fuel_rate_idling=fuel_rate_idling
+        )
+
+        if result is not None:
+            logger.log("\nFirst 5 rows of the new 'trips_enriched' table:")
+            logger.log(result[['trip_id', 'route_id', 'shape_id', 'total_distance_km', 'scheduled_total_idle_seconds', 'estimated_total_idle_seconds', 'estimated_fuel_usage_liters', 'trip_convenience_score']].head())
+
+    if result is not None and write_to_db:
+        write_trips_enriched_to_db(db_config, method=db_load_method)
+    return result
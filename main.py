@@ -7,7 +7,10 @@ import helper_files.stops_enrichment_oas as oa_enrich
 import helper_files.stops_enrichment_shops as shop_enrich
 import helper_files.stops_enriched_to_db_csv as build_enrich
 import helper_files.trips_enriched as trip_enrich
+import helper_files.trip_segments as trip_segments
+import helper_files.trip_cube as trip_cube
 import helper_files.data_pipeline as data_pipeline
+import helper_files.enrichment_pipeline as enrichment_pipeline
 import helper_files.kmeans_enrichment as k_means
 import helper_files.avg_weekly_frequency_per_hour_prediction as service_prediction
 import helper_files.logger as logger
@@ -50,9 +53,13 @@ try:
     # shop_enrich.nearby_shops_enrichment()
     # logger.log("Nearby shop enrichment complete.")
 
-    # logger.log("Building stops_intermediate and stops_enriched and stops_enriched.csv...")
+    # logger.log("Building stops_intermediate and stops_enriched and stops_enriched.parquet...")
     # build_enrich.write_enriched_to_db_csv()
-    # logger.log("stops_enriched and stops_enriched.csv build complete.")
+    # logger.log("stops_enriched and stops_enriched.parquet build complete.")
+
+    # logger.log("Building stops_enriched and stops_enriched.parquet with the in-memory enrichment pipeline (replaces the postcode, OA, shop and stops_enriched steps above)...")
+    # enrichment_pipeline.build_stops_enriched()
+    # logger.log("stops_enriched and stops_enriched.parquet build complete.")
 
     # logger.log("Building kmeans categorisation...")
     # k_means.kmeans_model()
@@ -66,6 +73,14 @@ try:
     # trip_enrich.generate_trips_enriched()
     # logger.log("Completed trips_enriched.csv")
 
+    # logger.log("Building trip_segments.parquet...")
+    # trip_segments.build_trip_segments()
+    # logger.log("Completed trip_segments.parquet")
+
+    # logger.log("Building trip_cube.parquet...")
+    # trip_cube.build_trip_cube(export_formats=('csv',))
+    # logger.log("Completed trip_cube.parquet")
+
     logger.log("All application tasks completed successfully.")
 
 except Exception as e:
@@ -0,0 +1,26 @@
+DROP TABLE IF EXISTS census_features;
+CREATE TABLE census_features (
+    oa21cd varchar(9) NOT NULL PRIMARY KEY,
+    oa21pop int,
+    employed_total int,
+    bus_commute_total int
+);
+
+INSERT IGNORE INTO census_features (oa21cd, oa21pop, employed_total, bus_commute_total)
+SELECT
+    t1.geography AS oa21cd,
+    t1.total AS oa21pop,
+    t61.travel_total_16_plus_employed AS employed_total,
+    t61.travel_bus AS bus_commute_total
+FROM ts001 AS t1
+LEFT JOIN ts061 AS t61 ON t61.geography = t1.geography
+WHERE t1.geography IS NOT NULL AND t1.geography <> '';
+
+INSERT IGNORE INTO census_features (oa21cd, oa21pop, employed_total, bus_commute_total)
+SELECT
+    t61.geography AS oa21cd,
+    NULL AS oa21pop,
+    t61.travel_total_16_plus_employed AS employed_total,
+    t61.travel_bus AS bus_commute_total
+FROM ts061 AS t61
+WHERE t61.geography IS NOT NULL AND t61.geography <> '';
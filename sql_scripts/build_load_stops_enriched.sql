@@ -75,16 +75,14 @@ SELECT
     CASE WHEN si.lsoa21nm = "" THEN NULL ELSE si.lsoa21nm END AS lsoa21nm,
     si.shops_nearby_count,
     si.population_density,
-    t1.total AS oa21pop,
+    cf.oa21pop,
     pe.total AS `postcode_pop`,
-    t61.travel_total_16_plus_employed AS `employed_total`,
-    t61.travel_bus AS `bus_commute_total`,
+    cf.employed_total AS `employed_total`,
+    cf.bus_commute_total AS `bus_commute_total`,
     sf.avg_weekly_frequency_per_hour
 FROM stops_intermediate AS si
 LEFT JOIN stops_frequency AS sf ON sf.stop_id = si.stop_id
-LEFT JOIN ts001 AS t1 ON t1.geography = si.oa21cd
-LEFT JOIN ts007a AS t7a ON t7a.geography = si.oa21cd
-LEFT JOIN ts061 AS t61 ON t61.geography = si.oa21cd
+LEFT JOIN census_features AS cf ON cf.oa21cd = si.oa21cd
 LEFT JOIN postcode_estimates AS pe ON pe.postcode = CASE WHEN LENGTH(si.postcode) > 7 THEN REPLACE(si.postcode, ' ', '') ELSE si.postcode END;
 
 DROP TABLE IF EXISTS stops_intermediate;
@@ -0,0 +1,79 @@
+# trips_benchmark.py
+
+import argparse
+import atexit
+import time
+import numpy as np
+import pandas as pd
+import helper_files.logger as logger
+import helper_files.trips_enriched as te
+
+
+LOG_FILE_NAME = "trips_benchmark_activity.log"
+LOG_FILE_MODE = "w" # 'a' will append to the file if it exists, 'w' will overwrite it
+
+parser = argparse.ArgumentParser(description="Benchmarks the row-by-row and vectorised trip idle time estimates on synthetic GTFS data.")
+parser.add_argument("--trips", default="250,1000,4000", help="Comma separated trip counts to run.")
+parser.add_argument("--stops-per-trip", type=int, default=30)
+parser.add_argument("--stops", type=int, default=5000, help="Distinct stops the trips are drawn from.")
+parser.add_argument("--unenriched-share", type=float, default=0.05, help="Share of stops with no stops_enriched row.")
+parser.add_argument("--max-row-seconds", type=float, default=120.0,
+                    help="Skip the row-by-row version for larger sizes once a run takes longer than this.")
+parser.add_argument("--seed", type=int, default=0)
+args = parser.parse_args()
+
+print(f"Initializing application logger to '{LOG_FILE_NAME}'...")
+logger.initialize_logger(LOG_FILE_NAME, mode=LOG_FILE_MODE)
+
+atexit.register(logger.close_logger)
+print("Logger setup complete.")
+
+def synthetic_trips(trip_count, rng):
+    """Builds trips, stop_times (trip_id, stop_id) and stops_enriched (indexed by stop_id) frames."""
+    stop_ids = np.array([f"STOP_{i}" for i in range(args.stops)], dtype=object)
+    trip_ids = np.array([f"TRIP_{i}" for i in range(trip_count)], dtype=object)
+    stop_times = pd.DataFrame({
+        'trip_id': np.repeat(trip_ids, args.stops_per_trip),
+        'stop_id': rng.choice(stop_ids, size=trip_count * args.stops_per_trip),
+    })
+    enriched = stop_ids[rng.random(len(stop_ids)) >= args.unenriched_share]
+    enriched_stops = pd.DataFrame({'shops_nearby_count': rng.poisson(6, len(enriched))}, index=pd.Index(enriched, name='stop_id'))
+    trips = pd.DataFrame({'trip_id': trip_ids})
+    return trips, stop_times, enriched_stops
+
+rng = np.random.default_rng(args.seed)
+results = []
+run_rows = True
+for trip_count in [int(value) for value in args.trips.split(",")]:
+    trips, stop_times, enriched_stops = synthetic_trips(trip_count, rng)
+
+    start_time = time.perf_counter()
+    vectorised = te.estimate_idle_seconds_by_trip(stop_times, enriched_stops).reindex(trips['trip_id'], fill_value=0.0).to_numpy()
+    vectorised_seconds = time.perf_counter() - start_time
+
+    row_seconds = None
+    max_difference = None
+    if run_rows:
+        start_time = time.perf_counter()
+        row_by_row = trips.apply(lambda row: te.calculate_estimated_idle_time(row, all_stop_times_df=stop_times, enriched_stops_df=enriched_stops), axis=1).to_numpy(dtype=float)
+        row_seconds = time.perf_counter() - start_time
+        max_difference = float(np.max(np.abs(row_by_row - vectorised)))
+        run_rows = row_seconds <= args.max_row_seconds
+
+    row = {
+        'trips': trip_count,
+        'stop_times': len(stop_times),
+        'row_by_row_seconds': round(row_seconds, 3) if row_seconds is not None else None,
+        'vectorised_seconds': round(vectorised_seconds, 4),
+        'speed_up': round(row_seconds / vectorised_seconds, 1) if row_seconds is not None else None,
+        'max_abs_difference': max_difference,
+    }
+    results.append(row)
+    logger.log(f"Idle time benchmark: {row}")
+
+print(f"\n{'trips':>7} {'stop_times':>10} {'row-by-row s':>13} {'vectorised s':>13} {'speed-up':>9} {'max diff':>10}")
+for row in results:
+    row_by_row = f"{row['row_by_row_seconds']:.3f}" if row['row_by_row_seconds'] is not None else "skipped"
+    speed_up = f"{row['speed_up']:.1f}x" if row['speed_up'] is not None else "-"
+    difference = f"{row['max_abs_difference']:.1e}" if row['max_abs_difference'] is not None else "-"
+    print(f"{row['trips']:>7} {row['stop_times']:>10} {row_by_row:>13} {row['vectorised_seconds']:>13.4f} {speed_up:>9} {difference:>10}")